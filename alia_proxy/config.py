@@ -1,6 +1,6 @@
 import os
 from typing import Dict, Optional, List, Union
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 import toml
 
@@ -12,7 +12,24 @@ class ProviderConfig(BaseModel):
 
     type: str  # 提供商类型 (如: openai, anthropic, ollama)
     api_key: Optional[Union[str, List[str]]] = None  # API 密钥 (单个或多个)
+    key_cooldown: float = 30.0  # Key 被限流 (429) 且无 Retry-After 时的冷却时间 (秒)
+    key_auth_cooldown: float = (
+        600.0  # Key 鉴权失败或额度耗尽 (401/402/403) 时的冷却时间 (秒)
+    )
     base_url: Optional[str] = None  # 基础 URL (用于自建或代理服务)
+    timeout: float = 60.0  # 上游请求超时 (秒)
+    connect_timeout: Optional[float] = None  # 建立连接的超时 (秒)，默认同 timeout
+    first_token_timeout: Optional[float] = (
+        None  # 流式请求等待首个数据块的时限 (秒)，超时后降级到下一个候选项
+    )
+    idle_timeout: Optional[float] = None  # 流式响应相邻数据块之间的最长间隔 (秒)
+    total_timeout: Optional[float] = None  # 单次上游调用的总时限 (秒)
+    http2: bool = False  # 是否启用 HTTP/2 (需要安装 h2: pip install alia-proxy[http2])
+    max_connections: int = 100  # 连接池最大连接数
+    max_keepalive_connections: int = 20  # 连接池最大保活连接数
+    keepalive_expiry: float = 30.0  # 空闲保活连接的过期时间 (秒)
+    passthrough: bool = True  # 协议一致时直接透传上游响应字节 (不做解析与重新编码)
+    max_concurrency: Optional[int] = None  # 该提供商的并发上限 (覆盖 limiter.max_limit)
 
     model_config = ConfigDict(extra="allow")
 
@@ -24,7 +41,156 @@ class MappingConfig(BaseModel):
 
     targets: List[str]  # 目标模型列表 (provider/model)
     fallbacks: List[str] = []  # 降级备选模型列表 (provider/model)
-    strategy: str = "round-robin"  # 策略: round-robin (默认), random
+    strategy: str = (
+        "round-robin"  # 策略: round-robin (默认), random, weighted, least-latency, least-inflight
+    )
+    weights: Optional[List[float]] = None  # weighted 策略: 与 targets 一一对应的权重
+    dispatch: str = "sequential"  # 调度方式: sequential (默认，依次降级), hedge, race
+    hedge_delay: Optional[float] = (
+        None  # hedge: 首个候选项多久未返回后并发请求下一个候选项 (秒)，默认取观测到的 P95
+    )
+    race_count: int = 2  # race: 同时发起请求的候选项数量
+    coalesce: bool = False  # 合并完全相同的并发非流式请求 (只调用一次上游)
+    cache: Optional[bool] = (
+        None  # 响应缓存: true 总是缓存，false 从不缓存，默认仅缓存确定性请求
+    )
+    semantic_threshold: Optional[float] = (
+        None  # 语义缓存: 余弦相似度达到该阈值 (0~1) 时返回缓存的响应，未设置时不使用语义缓存
+    )
+    first_token_timeout: Optional[float] = None  # 覆盖提供商的 first_token_timeout
+    idle_timeout: Optional[float] = None  # 覆盖提供商的 idle_timeout
+    total_timeout: Optional[float] = None  # 覆盖提供商的 total_timeout
+
+    @model_validator(mode="after")
+    def check_weights(self) -> "MappingConfig":
+        if self.weights is not None and len(self.weights) != len(self.targets):
+            raise ValueError("weights must have the same length as targets")
+        if self.strategy == "weighted" and not self.weights:
+            raise ValueError("weighted strategy requires weights")
+        return self
+
+
+class CircuitBreakerConfig(BaseModel):
+    """
+    熔断器配置。
+    """
+
+    enabled: bool = True  # 是否启用熔断
+    failure_threshold: int = 5  # 连续失败达到该次数后熔断
+    recovery_timeout: float = 30.0  # 熔断后等待多久进入半开状态并放行探测请求 (秒)
+    half_open_max_calls: int = 1  # 半开状态下同时允许的探测请求数
+
+
+class LimiterConfig(BaseModel):
+    """
+    上游自适应并发限制配置。
+    """
+
+    enabled: bool = False  # 是否启用并发限制 (默认关闭，不改变已有部署的并发行为)
+    per_model: bool = False  # 是否按 (提供商, 模型) 分别限流 (默认按提供商)
+    initial_limit: int = 32  # 初始并发上限
+    min_limit: int = 1  # 并发上限的下限
+    max_limit: int = 256  # 并发上限的上限
+    queue_size: int = 256  # 排队等待的最大请求数
+    queue_timeout: float = 30.0  # 排队等待的最长时间 (秒)
+
+
+class CacheConfig(BaseModel):
+    """
+    聊天响应缓存配置。
+    """
+
+    enabled: bool = False  # 是否启用响应缓存
+    ttl: float = 86400.0  # 缓存有效期 (秒)
+    max_entries: int = 10000  # 内存层最大条目数
+    max_bytes: int = 64 * 1024 * 1024  # 内存层最大字节数
+    disk: bool = False  # 是否启用磁盘层 (重启后仍然有效)
+    disk_dir: str = "data/cache"  # 磁盘层目录
+    disk_max_bytes: int = 1024 * 1024 * 1024  # 磁盘层最大字节数
+
+
+class EmbeddingsCacheConfig(BaseModel):
+    """
+    嵌入向量缓存配置。
+    """
+
+    enabled: bool = False  # 是否启用嵌入向量缓存
+    max_bytes: int = 256 * 1024 * 1024  # 最大占用字节数 (向量以 float32 存储)
+
+
+class SemanticCacheConfig(BaseModel):
+    """
+    语义响应缓存配置 (需要安装 numpy)。相似度阈值在各映射的 semantic_threshold 中配置。
+    """
+
+    enabled: bool = False  # 是否启用语义缓存
+    embedding_model: Optional[str] = (
+        None  # 用于向量化请求的嵌入模型 (provider/model 或映射别名)
+    )
+    message_window: int = 1  # 参与向量化的最近非系统消息条数 (1 表示仅最后一条用户消息)
+    ttl: float = 86400.0  # 缓存有效期 (秒)
+    max_entries: int = 10000  # 索引容量，超出后淘汰最久未使用的条目
+    persist: bool = False  # 是否持久化索引 (向量保存为内存映射文件)
+    index_dir: str = "data/semantic_cache"  # 持久化目录
+
+
+class EmbeddingsBatchConfig(BaseModel):
+    """
+    嵌入请求微批处理配置。
+    """
+
+    enabled: bool = False  # 是否启用微批处理
+    max_delay: float = 0.005  # 批次最长收集时间 (秒)
+    max_batch_size: int = 64  # 每批最多包含的输入数，达到后立即发送
+    max_request_size: int = 8  # 参与合并的单个请求最多包含的输入数 (更大的请求直接发送)
+
+
+class LogWriterConfig(BaseModel):
+    """
+    请求日志后台批量写入配置。
+    """
+
+    enabled: bool = True  # 是否启用后台批量写入 (关闭时在请求路径上直接写入数据库)
+    queue_size: int = 10000  # 内存队列最多缓存的日志条数
+    batch_size: int = 200  # 每批写入的最大条数，队列积累到该数量时立即写入
+    flush_interval: float = 0.5  # 最长写入间隔 (秒)
+    overflow: str = (
+        "block"  # 队列已满时的策略: block (等待，超时后丢弃), drop-new, drop-oldest
+    )
+    block_timeout: float = 1.0  # block 策略下的最长等待时间 (秒)
+    minute_rollup_retention: int = 90  # 按分钟汇总的分析数据保留天数 (0 表示永久保留)
+
+
+class CompressionConfig(BaseModel):
+    """
+    请求内容压缩配置。
+    """
+
+    enabled: bool = True  # 写入时压缩 prompt / response
+    min_size: int = 512  # 小于该字节数的内容不压缩
+    level: int = 6  # zlib 压缩级别 (1~9)
+    dedupe: bool = True  # 按消息拆分 prompt 并去重存储 (相同的消息只存储一次)
+    migrate: bool = False  # 启动后在后台压缩旧版本写入的未压缩内容 (需显式开启)
+    migrate_batch: int = 500  # 每批迁移的行数
+    migrate_interval: float = 1.0  # 批次之间的间隔 (秒)
+    migrate_retries: int = 5  # 一批连续失败多少次后放弃迁移
+    migrate_max_backoff: float = 60.0  # 失败后重试的最长间隔 (秒)
+
+
+class DatabaseConfig(BaseModel):
+    """
+    SQLite 数据库性能配置 (仅对 SQLite 数据库文件生效)。
+    """
+
+    sqlite_profile: bool = False  # 启用调优的 PRAGMA 与只读连接池 (需显式开启)
+    synchronous: str = "NORMAL"  # WAL 模式下 NORMAL 只在检查点时同步磁盘
+    cache_size: int = -65536  # 每个连接的页缓存大小 (负数表示 KiB)
+    mmap_size: int = 268435456  # 内存映射读取的最大字节数
+    busy_timeout: int = 5000  # 数据库被其他连接锁定时的最长等待时间 (毫秒)
+    read_pool_size: int = 4  # 只读连接数 (0 表示读写共用一个连接)
+    content_path: Optional[str] = (
+        None  # 请求内容单独存储的数据库文件 (如 data/alia-content.db)
+    )
 
 
 class Settings(BaseSettings):
@@ -39,6 +205,20 @@ class Settings(BaseSettings):
     providers: Dict[str, ProviderConfig] = {}  # 注册的提供商配置列表
     mapping: Dict[str, Union[str, List[str], MappingConfig]] = {}  # 模型映射表
     hot_reload: bool = False  # 是否启用热重载配置
+    circuit_breaker: CircuitBreakerConfig = CircuitBreakerConfig()  # 熔断器配置
+    limiter: LimiterConfig = LimiterConfig()  # 并发限制配置
+    cache: CacheConfig = CacheConfig()  # 响应缓存配置
+    semantic_cache: SemanticCacheConfig = SemanticCacheConfig()  # 语义响应缓存配置
+    embeddings_cache: EmbeddingsCacheConfig = (
+        EmbeddingsCacheConfig()
+    )  # 嵌入向量缓存配置
+    embeddings_batch: EmbeddingsBatchConfig = (
+        EmbeddingsBatchConfig()
+    )  # 嵌入请求微批处理配置
+    log_writer: LogWriterConfig = LogWriterConfig()  # 请求日志批量写入配置
+    compression: CompressionConfig = CompressionConfig()  # 请求内容压缩配置
+    database: DatabaseConfig = DatabaseConfig()  # SQLite 数据库性能配置
+    disconnect_poll_interval: float = 0.5  # 流式响应中检测客户端断开的间隔 (秒)
 
     model_config = SettingsConfigDict(env_prefix="ALIA_")
 
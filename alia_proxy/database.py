@@ -0,0 +1,268 @@
+"""
+数据库连接。
+SQLite 数据库文件可启用性能配置 (database.sqlite_profile，默认关闭):
+- WAL 日志、synchronous=NORMAL、更大的页缓存与内存映射读取，以及 busy_timeout。
+- 默认连接 (default) 是唯一的写连接: 日志写入、内容迁移与删除都通过它串行执行；
+  仪表盘的统计、日志查询与导出通过只读连接池执行 (WAL 模式下读取与写入互不阻塞)。
+- 可选将请求内容 (RequestContent / ContentBlob) 存储在单独的数据库文件中，附加 (ATTACH) 到每个连接上，
+  大块内容不再与日志元数据共用同一个文件。
+内存数据库与其他数据库按 database_url 直接连接，不受影响。
+"""
+
+import os
+import re
+from itertools import count
+from typing import Any, Dict, List, Optional
+from tortoise import Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.backends.base.config_generator import expand_db_url
+from tortoise.backends.sqlite.client import SqliteClient
+from tortoise.utils import get_schema_sql
+from .config import settings, DatabaseConfig
+from .models import ContentBlob, RequestContent
+from .schema import upgrade_schema
+
+# 内容数据库附加到连接上的名称
+CONTENT_SCHEMA = "content"
+# 存储在内容数据库中的模型
+CONTENT_MODELS = (RequestContent, ContentBlob)
+# 按数据库文件生效的 PRAGMA (需要为附加的内容数据库单独设置)
+PER_DATABASE_PRAGMAS = (
+    "journal_mode",
+    "journal_size_limit",
+    "synchronous",
+    "cache_size",
+    "mmap_size",
+)
+
+
+class ProfiledSqliteClient(SqliteClient):
+    """
+    建立连接后附加内容数据库的 SQLite 客户端。
+    连接参数中的 PRAGMA 由 SqliteClient 在主数据库上设置，附加的数据库按相同的参数单独设置。
+    """
+
+    def __init__(
+        self, file_path: str, content_path: Optional[str] = None, **kwargs: Any
+    ):
+        super().__init__(file_path, **kwargs)
+        self.content_path = content_path
+
+    @property
+    def busy(self) -> bool:
+        """
+        连接是否正在执行查询或事务。
+        """
+        return self._lock.locked()
+
+    async def _execute(self, sql: str, values: Optional[list] = None):
+        cursor = await self._connection.execute(sql, values or [])
+        await cursor.close()
+
+    async def create_connection(self, with_db: bool) -> None:
+        # 不依赖 _post_connect (并非所有支持的 Tortoise 版本都会在建立连接后调用)
+        connected = self._connection is not None
+        await super().create_connection(with_db)
+        if not connected:
+            await self._attach_content()
+
+    async def _attach_content(self):
+        if self.content_path is None:
+            return
+        directory = os.path.dirname(self.content_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        await self._execute(
+            f"ATTACH DATABASE ? AS {CONTENT_SCHEMA}", [self.content_path]
+        )
+        for pragma in PER_DATABASE_PRAGMAS:
+            if pragma in self.pragmas:
+                await self._execute(
+                    f"PRAGMA {CONTENT_SCHEMA}.{pragma}={self.pragmas[pragma]}"
+                )
+
+
+# Tortoise 按连接配置中的 engine 模块查找客户端类
+client_class = ProfiledSqliteClient
+
+
+def _bind_content_models(split: bool):
+    """
+    设置内容模型所在的数据库 (在 Tortoise.init 之前调用，模型的表在初始化时确定)。
+    外键约束无法跨数据库建立，内容单独存储时取消 RequestContent.log 的约束。
+    """
+    for model in CONTENT_MODELS:
+        model._meta.schema = CONTENT_SCHEMA if split else None
+    RequestContent._meta.fields_map["log"].db_constraint = not split
+
+
+class Database:
+    """
+    数据库连接的初始化与读写分流。
+    """
+
+    def __init__(self):
+        self.readers: List[str] = []  # 只读连接名称
+        self.split = False  # 请求内容是否存储在单独的数据库文件中
+        self._next = count()
+
+    @property
+    def config(self) -> DatabaseConfig:
+        return settings.database
+
+    def tortoise_config(self, db_url: str) -> Dict[str, Any]:
+        """
+        根据数据库连接字符串生成 Tortoise 配置。
+        SQLite 数据库文件启用性能配置时，default 为写连接，read_0 ~ read_n 为只读连接。
+        """
+        connections: Dict[str, Any] = {"default": db_url}
+        db = expand_db_url(db_url)
+        credentials = db["credentials"]
+        if (
+            db["engine"] == "tortoise.backends.sqlite"
+            and credentials["file_path"] != ":memory:"
+        ):
+            config = self.config
+            credentials["content_path"] = config.content_path
+            if config.sqlite_profile:
+                credentials.update(
+                    synchronous=config.synchronous,
+                    cache_size=config.cache_size,
+                    mmap_size=config.mmap_size,
+                    busy_timeout=config.busy_timeout,
+                )
+                for i in range(config.read_pool_size):
+                    connections[f"read_{i}"] = {
+                        "engine": __name__,
+                        "credentials": {**credentials, "query_only": "ON"},
+                    }
+            connections["default"] = {"engine": __name__, "credentials": credentials}
+        return {
+            "connections": connections,
+            "apps": {
+                "models": {
+                    "models": ["alia_proxy.models"],
+                    "default_connection": "default",
+                }
+            },
+        }
+
+    async def init(self, db_url: Optional[str] = None):
+        """
+        初始化数据库连接，并创建或升级数据库结构 (在 lifespan 中调用)。
+        """
+        config = self.tortoise_config(db_url or settings.database_url)
+        default = config["connections"]["default"]
+        self.readers = [name for name in config["connections"] if name != "default"]
+        self.split = (
+            isinstance(default, dict)
+            and default["credentials"]["content_path"] is not None
+        )
+        _bind_content_models(self.split)
+        await Tortoise.init(config=config)
+
+        # 先为旧版本的表补齐新增的列，再创建缺失的表与索引
+        await upgrade_schema()
+        await self._generate_schemas()
+        if self.split and await self._move_content():
+            # 移动后内容表名解析到内容数据库，为其中旧版本的表补齐新增的列
+            await upgrade_schema()
+
+    async def _generate_schemas(self):
+        """
+        在写连接上创建缺失的表与索引。
+        SQLite 的建表语句不包含模型的 schema，内容表需要显式指定所在的数据库。
+        """
+        conn = Tortoise.get_connection("default")
+        sql = get_schema_sql(conn, safe=True)
+        if self.split:
+            for model in CONTENT_MODELS:
+                table = model._meta.db_table
+                sql = sql.replace(
+                    f'TABLE IF NOT EXISTS "{table}"',
+                    f'TABLE IF NOT EXISTS "{CONTENT_SCHEMA}"."{table}"',
+                )
+                sql = re.sub(
+                    rf'INDEX IF NOT EXISTS ("\w+") ON "{table}"',
+                    rf'INDEX IF NOT EXISTS "{CONTENT_SCHEMA}".\1 ON "{table}"',
+                    sql,
+                )
+        if sql.strip():
+            await conn.execute_script(sql)
+
+    async def _move_content(self) -> bool:
+        """
+        将旧版本存储在主数据库中的请求内容移动到内容数据库 (首次启用 content_path 时)。
+        :return: 是否移动了数据
+        """
+        conn = Tortoise.get_connection("default")
+        moved = False
+        for model in CONTENT_MODELS:
+            table = model._meta.db_table
+            _, rows = await conn.execute_query(
+                "SELECT 1 FROM main.sqlite_master WHERE type = 'table' AND name = ?",
+                [table],
+            )
+            if not rows:
+                continue
+            _, columns = await conn.execute_query(f'PRAGMA main.table_info("{table}")')
+            names = ", ".join(f'"{column["name"]}"' for column in columns)
+            await conn.execute_script(
+                "BEGIN; "
+                f'INSERT OR IGNORE INTO "{CONTENT_SCHEMA}"."{table}" ({names}) '
+                f'SELECT {names} FROM "main"."{table}"; '
+                f'DROP TABLE "main"."{table}"; '
+                "COMMIT;"
+            )
+            print(f"已将 {table} 移动到内容数据库 {self.config.content_path}")
+            moved = True
+        return moved
+
+    def reader(self) -> BaseDBAsyncClient:
+        """
+        选择一个只读连接 (优先选择空闲的连接，都在使用中时轮流分配)。
+        未启用只读连接池时返回默认连接。
+        """
+        if not self.readers:
+            return Tortoise.get_connection("default")
+        clients = [Tortoise.get_connection(name) for name in self.readers]
+        start = next(self._next) % len(clients)
+        clients = clients[start:] + clients[:start]
+        return next((client for client in clients if not client.busy), clients[0])
+
+    async def delete_orphaned_content(self) -> int:
+        """
+        删除所属日志已不存在的请求内容 (删除日志后调用)。
+        内容存储在单独的数据库文件中时，删除日志不会级联删除内容。
+        :return: 删除的内容行数
+        """
+        if not self.split:
+            return 0
+        conn = Tortoise.get_connection("default")
+        deleted, _ = await conn.execute_query(
+            f'DELETE FROM "{CONTENT_SCHEMA}"."requestcontent" '
+            'WHERE log_id NOT IN (SELECT id FROM "main"."requestlog")'
+        )
+        return deleted
+
+    async def close(self):
+        """
+        关闭全部连接 (在 lifespan 中调用)。
+        """
+        await Tortoise.close_connections()
+        self.readers = []
+        self.split = False
+        _bind_content_models(False)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "readers": len(self.readers),
+            "busy_readers": sum(
+                Tortoise.get_connection(name).busy for name in self.readers
+            ),
+            "content_split": self.split,
+        }
+
+
+# 全局数据库连接管理
+database = Database()
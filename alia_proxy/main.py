@@ -3,7 +3,6 @@ import uvicorn
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
-from tortoise import Tortoise
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
@@ -11,6 +10,11 @@ import asyncio
 from .routers import openai, media, export, common, anthropic
 from .config import settings
 from .providers.factory import ProviderFactory
+from .services.semantic import semantic_cache
+from .services.logger import log_writer
+from .services.compression import content_migrator
+from .services.rollups import backfill as backfill_rollups
+from .database import database
 
 
 async def config_watcher():
@@ -44,14 +48,20 @@ async def lifespan(app: FastAPI):
     # 启动配置监听任务
     watcher_task = asyncio.create_task(config_watcher())
 
-    await Tortoise.init(
-        db_url=settings.database_url,
-        modules={"models": ["alia_proxy.models"]},
-    )
-    await Tortoise.generate_schemas()
+    # 建立数据库连接，并创建或升级数据库结构
+    await database.init()
+    # 升级后首次启动时从原始日志回填分析汇总表 (在日志写入器启动之前)
+    await backfill_rollups()
+    log_writer.start()
+    content_migrator.start()
     yield
     watcher_task.cancel()
-    await Tortoise.close_connections()
+    await semantic_cache.save()
+    await ProviderFactory.close_all()
+    await content_migrator.stop()
+    # 写入队列中剩余的日志后再关闭数据库连接
+    await log_writer.stop()
+    await database.close()
 
 
 app = FastAPI(
@@ -112,10 +122,11 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
 async def global_exception_handler(request: Request, exc: Exception):
     """
     捕获应用运行时的所有未处理异常。
-    返回 500 内部错误响应。
+    返回 500 内部错误响应 (异常自带 status_code 时使用该状态码，如熔断时的 503)。
     """
+    status_code = getattr(exc, "status_code", 500)
     return JSONResponse(
-        status_code=500,
+        status_code=status_code if isinstance(status_code, int) else 500,
         content={
             "error": {
                 "message": str(exc),
@@ -25,12 +25,19 @@ class RequestLog(Model):
     total_tokens = fields.IntField(default=0, db_index=True)  # 总消耗 Token 数
     status_code = fields.IntField(db_index=True)  # HTTP 状态码
     latency = fields.FloatField(default=0.0, db_index=True)  # 请求耗时 (秒)
+    ttft = fields.FloatField(
+        null=True, db_index=True
+    )  # 首个数据块延迟 (秒，仅流式请求)
     is_streaming = fields.BooleanField(default=False, db_index=True)  # 是否为流式请求
     ip_address = fields.CharField(max_length=45, null=True, db_index=True)  # IP 地址
     metadata = fields.JSONField(null=True)  # 额外的元数据
+    attempt_count = fields.IntField(
+        default=1
+    )  # 上游调用次数 (含降级、对冲与竞速，缓存命中为 0)
 
     content: fields.OneToOneRelation["RequestContent"]
     media: fields.ReverseRelation["MediaResource"]
+    attempts: fields.ReverseRelation["RequestAttempt"]
 
     class Meta:  # type: ignore
         table = "requestlog"
@@ -40,6 +47,28 @@ class RequestLog(Model):
         ]
 
 
+class RequestAttempt(Model):
+    """
+    上游调用记录。
+    一次请求发生了降级、对冲或竞速 (多于一次上游调用) 时，每次调用 (含最终成功的调用) 各记录一条；
+    只有一次上游调用的请求不写入调用记录，由请求日志本身描述。
+    """
+
+    id = fields.IntField(pk=True)
+    log = fields.ForeignKeyField(
+        "models.RequestLog", related_name="attempts", on_delete=fields.CASCADE
+    )
+    attempt = fields.IntField()  # 调用序号 (从 1 开始，对应候选项顺序)
+    provider = fields.CharField(max_length=100, db_index=True)  # 提供商名称
+    model = fields.CharField(max_length=100)  # 模型名称
+    status_code = fields.IntField(db_index=True)  # 状态码 (取消的调用为 499)
+    latency = fields.FloatField(default=0.0)  # 调用耗时 (秒，含排队时间)
+    error = fields.TextField(null=True)  # 错误详情
+
+    class Meta:  # type: ignore
+        table = "requestattempt"
+
+
 class RequestContent(Model):
     """
     请求内容模型。
@@ -50,14 +79,37 @@ class RequestContent(Model):
     log = fields.OneToOneField(
         "models.RequestLog", related_name="content", on_delete=fields.CASCADE
     )
-    prompt = fields.TextField(null=True)  # 请求内容
-    response = fields.TextField(null=True)  # 响应内容
+    prompt = fields.TextField(null=True)  # 请求内容 (未压缩)
+    response = fields.TextField(null=True)  # 响应内容 (未压缩)
     error = fields.TextField(null=True)  # 错误详情
+    codec = fields.CharField(
+        max_length=16, null=True
+    )  # 压缩编码 (NULL 表示尚未检查，plain 表示未压缩)
+    prompt_blob = fields.BinaryField(null=True)  # 压缩后的请求内容
+    prompt_refs = fields.JSONField(
+        null=True
+    )  # 请求内容按消息拆分后的有序 ContentBlob 哈希列表 (消息去重存储)
+    response_blob = fields.BinaryField(null=True)  # 压缩后的响应内容
 
     class Meta:  # type: ignore
         table = "requestcontent"
 
 
+class ContentBlob(Model):
+    """
+    内容寻址的文本块 (如单条消息)。
+    相同的内容只存储一次，由 RequestContent.prompt_refs 按哈希引用。
+    """
+
+    hash = fields.CharField(max_length=64, primary_key=True)  # 原文的 SHA-256
+    codec = fields.CharField(max_length=16)  # 压缩编码 (plain 表示未压缩)
+    data = fields.BinaryField()  # 内容 (按 codec 编码)
+    size = fields.IntField(default=0)  # 原文字节数
+
+    class Meta:  # type: ignore
+        table = "contentblob"
+
+
 class MediaResource(Model):
     """
     媒体资源模型。
@@ -75,3 +127,78 @@ class MediaResource(Model):
 
     class Meta:  # type: ignore
         table = "mediaresource"
+
+
+class Rollup(Model):
+    """
+    分析数据的预聚合 (按时间段与 (提供商, 模型, 端点, 状态码) 汇总的请求日志)。
+    由日志写入器在写入日志的同一事务内累加，用于分析与统计接口，避免每次扫描原始日志。
+    直方图的区间定义见 services/rollups.py。
+    """
+
+    id = fields.IntField(pk=True)
+    bucket = fields.DatetimeField()  # 时间段的起始时间
+    hour = fields.SmallIntField(default=0)  # 起始时间的小时 (0~23，用于按小时统计)
+    provider = fields.CharField(max_length=100, db_index=True)  # 提供商名称
+    model = fields.CharField(max_length=100, db_index=True)  # 模型名称
+    endpoint = fields.CharField(max_length=100)  # 端点名称
+    status_code = fields.IntField()  # HTTP 状态码
+    requests = fields.IntField(default=0)  # 请求数
+    attempts = fields.IntField(default=0)  # 上游调用次数之和
+    retried = fields.IntField(default=0)  # 多于一次上游调用的请求数
+    prompt_tokens = fields.BigIntField(default=0)  # 提示词 Token 数之和
+    completion_tokens = fields.BigIntField(default=0)  # 补全词 Token 数之和
+    total_tokens = fields.BigIntField(default=0)  # 总 Token 数之和
+    latency_sum = fields.FloatField(default=0.0)  # 请求耗时之和 (秒)
+    latency_hist_0 = fields.IntField(default=0)  # 耗时直方图
+    latency_hist_1 = fields.IntField(default=0)
+    latency_hist_2 = fields.IntField(default=0)
+    latency_hist_3 = fields.IntField(default=0)
+    latency_hist_4 = fields.IntField(default=0)
+    streams = fields.IntField(default=0)  # 记录了首个数据块延迟的流式请求数
+    ttft_sum = fields.FloatField(default=0.0)  # 首个数据块延迟之和 (秒)
+    ttft_hist_0 = fields.IntField(default=0)  # 首个数据块延迟直方图
+    ttft_hist_1 = fields.IntField(default=0)
+    ttft_hist_2 = fields.IntField(default=0)
+    ttft_hist_3 = fields.IntField(default=0)
+    ttft_hist_4 = fields.IntField(default=0)
+    throughput_count = fields.IntField(default=0)  # 有输出速度的流式请求数
+    throughput_sum = fields.FloatField(default=0.0)  # 输出速度之和 (Token/秒)
+    throughput_hist_0 = fields.IntField(default=0)  # 输出速度直方图
+    throughput_hist_1 = fields.IntField(default=0)
+    throughput_hist_2 = fields.IntField(default=0)
+    throughput_hist_3 = fields.IntField(default=0)
+    throughput_hist_4 = fields.IntField(default=0)
+
+    class Meta:  # type: ignore
+        abstract = True
+
+
+class RollupMinute(Rollup):
+    """
+    按分钟汇总的请求日志 (RPM / TPM)。
+    """
+
+    class Meta:  # type: ignore
+        table = "rollupminute"
+        unique_together = (("bucket", "provider", "model", "endpoint", "status_code"),)
+
+
+class RollupHour(Rollup):
+    """
+    按小时汇总的请求日志 (摘要、分布与按小时统计)。
+    """
+
+    class Meta:  # type: ignore
+        table = "rolluphour"
+        unique_together = (("bucket", "provider", "model", "endpoint", "status_code"),)
+
+
+class RollupDay(Rollup):
+    """
+    按天汇总的请求日志 (趋势与全局统计)。
+    """
+
+    class Meta:  # type: ignore
+        table = "rollupday"
+        unique_together = (("bucket", "provider", "model", "endpoint", "status_code"),)
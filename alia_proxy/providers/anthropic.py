@@ -1,4 +1,3 @@
-import httpx
 import json
 import time
 from typing import Any, Dict, Optional, AsyncGenerator, List
@@ -15,6 +14,39 @@ from .base import (
     EmbeddingsRequest,
     EmbeddingsResponse,
 )
+from .prompt_cache import PrefixTracker, apply_breakpoints
+
+
+class AnthropicConfig(ProviderConfig):
+    """
+    Anthropic 提供商配置。
+    """
+
+    prompt_cache: bool = (
+        False  # 自动为重复出现的长前缀插入提示词缓存断点 (cache_control)
+    )
+    prompt_cache_min_tokens: int = 1024  # 前缀估算 Token 数低于该值时不插入断点
+    prompt_cache_ttl: float = 300.0  # 前缀在多长时间内再次出现才视为稳定前缀 (秒)
+
+
+def anthropic_usage(usage: Dict[str, Any]) -> Usage:
+    """
+    将 Anthropic 的 usage 块转换为 Usage。
+    input_tokens 不含缓存部分，提示词 Token 数为 input_tokens 与缓存读写 Token 数之和。
+    """
+    cache_write = usage.get("cache_creation_input_tokens")
+    cache_read = usage.get("cache_read_input_tokens")
+    prompt_tokens = (
+        usage.get("input_tokens", 0) + (cache_write or 0) + (cache_read or 0)
+    )
+    completion_tokens = usage.get("output_tokens", 0)
+    return Usage(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        cache_read_tokens=cache_read,
+        cache_write_tokens=cache_write,
+    )
 
 
 class AnthropicProvider(BaseProvider):
@@ -23,10 +55,16 @@ class AnthropicProvider(BaseProvider):
     负责处理与 Anthropic API 的通信，并将响应映射为 OpenAI 兼容格式。
     """
 
+    Config = AnthropicConfig
+    api_key_header = "x-api-key"
+
     def __init__(self, config: ProviderConfig):
+        if not isinstance(config, AnthropicConfig):
+            config = AnthropicConfig(**config.model_dump())
         if not config.base_url:
             config.base_url = "https://api.anthropic.com/v1"
         super().__init__(config)
+        self._prefixes = PrefixTracker()  # 近期请求的前缀哈希 (用于自动缓存断点)
 
     async def embeddings(self, request: EmbeddingsRequest) -> EmbeddingsResponse:
         """
@@ -101,166 +139,169 @@ class AnthropicProvider(BaseProvider):
             mapped.append({"role": m.role, "content": content})
         return mapped
 
-    async def chat(self, request: ChatRequest) -> ChatResponse:
+    def _build_payload(self, request: ChatRequest) -> Dict[str, Any]:
         """
-        发送非流式聊天请求到 Anthropic。
-        包含对系统消息、工具调用、停止序列等的处理。
+        将 OpenAI 格式的请求转换为 Anthropic 消息请求体。
+        包含对系统消息、工具调用、停止序列等的处理；开启 prompt_cache 时自动插入缓存断点。
         """
-        timeout = getattr(self.config, "timeout", 60.0)
-        async with httpx.AsyncClient() as client:
-            headers = {
-                "x-api-key": self.api_key,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json",
-            }
-
-            # 提取并合并所有系统消息
-            system_messages = [
-                m.content for m in request.messages if m.role == "system"
-            ]
-            system_message = (
-                "\n".join([str(m) for m in system_messages])
-                if system_messages
-                else None
+        # 提取并合并所有系统消息
+        system_messages = [m.content for m in request.messages if m.role == "system"]
+        system_message = (
+            "\n".join([str(m) for m in system_messages]) if system_messages else None
+        )
+        # 过滤掉系统消息
+        messages = [m for m in request.messages if m.role != "system"]
+
+        payload = {
+            "model": request.model,
+            "messages": self._map_messages(messages),
+            "max_tokens": request.max_tokens or 4096,
+            "temperature": request.temperature,
+            "top_p": request.top_p,
+        }
+
+        if request.stop:
+            payload["stop_sequences"] = (
+                [request.stop] if isinstance(request.stop, str) else request.stop
             )
-            # 过滤掉系统消息
-            messages = [m for m in request.messages if m.role != "system"]
-
-            payload = {
-                "model": request.model,
-                "messages": self._map_messages(messages),
-                "max_tokens": request.max_tokens or 4096,
-                "temperature": request.temperature,
-                "top_p": request.top_p,
-            }
-
-            if request.stop:
-                payload["stop_sequences"] = (
-                    [request.stop] if isinstance(request.stop, str) else request.stop
-                )
 
-            if system_message:
-                payload["system"] = system_message
-
-            if request.tools:
-                payload["tools"] = [
-                    {
-                        "name": t.function.name,
-                        "description": t.function.description or "",
-                        "input_schema": t.function.parameters
-                        or {"type": "object", "properties": {}},
-                    }
-                    for t in request.tools
-                ]
-                # 处理工具选择策略转换
-                if request.tool_choice:
-                    if request.tool_choice == "auto":
-                        payload["tool_choice"] = {"type": "auto"}
-                    elif request.tool_choice == "required":
-                        payload["tool_choice"] = {"type": "any"}
-                    elif isinstance(request.tool_choice, dict):
-                        func_name = request.tool_choice.get("function", {}).get("name")
-                        if func_name:
-                            payload["tool_choice"] = {
-                                "type": "tool",
-                                "name": func_name,
-                            }
+        if system_message:
+            payload["system"] = system_message
+
+        if request.tools:
+            payload["tools"] = [
+                {
+                    "name": t.function.name,
+                    "description": t.function.description or "",
+                    "input_schema": t.function.parameters
+                    or {"type": "object", "properties": {}},
+                }
+                for t in request.tools
+            ]
+            # 处理工具选择策略转换
+            if request.tool_choice:
+                if request.tool_choice == "auto":
+                    payload["tool_choice"] = {"type": "auto"}
+                elif request.tool_choice == "required":
+                    payload["tool_choice"] = {"type": "any"}
+                elif isinstance(request.tool_choice, dict):
+                    func_name = request.tool_choice.get("function", {}).get("name")
+                    if func_name:
+                        payload["tool_choice"] = {
+                            "type": "tool",
+                            "name": func_name,
+                        }
 
-            response = await client.post(
-                f"{self.base_url}/messages",
-                headers=headers,
-                json=payload,
-                timeout=timeout,
+        if self.config.prompt_cache:
+            apply_breakpoints(
+                payload,
+                self._prefixes,
+                self.config.prompt_cache_min_tokens,
+                self.config.prompt_cache_ttl,
             )
-            response.raise_for_status()
-            data = response.json()
-
-            # 解析 Anthropic 内容块 (text + tool_use)
-            content_text = ""
-            tool_calls_list = []
-            for block in data.get("content", []):
-                if block["type"] == "text":
-                    content_text += block["text"]
-                elif block["type"] == "tool_use":
-                    tool_calls_list.append(
-                        ToolCall(
-                            id=block["id"],
-                            type="function",
-                            function=ToolCallFunction(
-                                name=block["name"],
-                                arguments=json.dumps(block["input"]),
-                            ),
-                        )
-                    )
+        return payload
 
-            return ChatResponse(
-                id=data["id"],
-                created=int(time.time()),
-                model=data["model"],
-                choices=[
-                    ChatCompletionChoice(
-                        index=0,
-                        message=ChatMessage(
-                            role="assistant",
-                            content=content_text or None,
-                            tool_calls=tool_calls_list if tool_calls_list else None,
-                        ),
-                        finish_reason=(
-                            "tool_calls" if tool_calls_list else data.get("stop_reason")
+    async def chat(self, request: ChatRequest) -> ChatResponse:
+        """
+        发送非流式聊天请求到 Anthropic。
+        包含对系统消息、工具调用、停止序列等的处理。
+        """
+        headers = {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json",
+        }
+
+        payload = self._build_payload(request)
+
+        response = await self.client.post(
+            f"{self.base_url}/messages",
+            headers=headers,
+            json=payload,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        data = response.json()
+
+        # 解析 Anthropic 内容块 (text + tool_use)
+        content_text = ""
+        tool_calls_list = []
+        for block in data.get("content", []):
+            if block["type"] == "text":
+                content_text += block["text"]
+            elif block["type"] == "tool_use":
+                tool_calls_list.append(
+                    ToolCall(
+                        id=block["id"],
+                        type="function",
+                        function=ToolCallFunction(
+                            name=block["name"],
+                            arguments=json.dumps(block["input"]),
                         ),
                     )
-                ],
-                usage=Usage(
-                    prompt_tokens=data["usage"]["input_tokens"],
-                    completion_tokens=data["usage"]["output_tokens"],
-                    total_tokens=data["usage"]["input_tokens"]
-                    + data["usage"]["output_tokens"],
-                ),
-            )
+                )
+
+        return ChatResponse(
+            id=data["id"],
+            created=int(time.time()),
+            model=data["model"],
+            choices=[
+                ChatCompletionChoice(
+                    index=0,
+                    message=ChatMessage(
+                        role="assistant",
+                        content=content_text or None,
+                        tool_calls=tool_calls_list if tool_calls_list else None,
+                    ),
+                    finish_reason=(
+                        "tool_calls" if tool_calls_list else data.get("stop_reason")
+                    ),
+                )
+            ],
+            usage=anthropic_usage(data["usage"]),
+        )
 
     async def chat_native(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """
         原生 Anthropic 消息接口。
         """
-        timeout = getattr(self.config, "timeout", 60.0)
-        async with httpx.AsyncClient() as client:
-            headers = {
-                "x-api-key": self.api_key,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json",
-            }
-            response = await client.post(
-                f"{self.base_url}/messages",
-                headers=headers,
-                json=payload,
-                timeout=timeout,
-            )
-            response.raise_for_status()
-            return response.json()
-
-    async def stream_native(self, payload: Dict[str, Any]) -> AsyncGenerator[str, None]:
+        headers = {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json",
+        }
+        response = await self.client.post(
+            f"{self.base_url}/messages",
+            headers=headers,
+            json=payload,
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    async def stream_native(
+        self, payload: Dict[str, Any]
+    ) -> AsyncGenerator[bytes, None]:
         """
         原生 Anthropic 消息流接口。
+        原样返回上游 SSE 字节，保留事件帧结构。
         """
-        timeout = getattr(self.config, "timeout", 60.0)
-        async with httpx.AsyncClient() as client:
-            headers = {
-                "x-api-key": self.api_key,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json",
-            }
-            payload["stream"] = True
-            async with client.stream(
-                "POST",
-                f"{self.base_url}/messages",
-                headers=headers,
-                json=payload,
-                timeout=timeout,
-            ) as response:
-                response.raise_for_status()
-                async for line in response.aiter_lines():
-                    if line:
-                        yield line
+        headers = {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json",
+        }
+        payload["stream"] = True
+        async with self.client.stream(
+            "POST",
+            f"{self.base_url}/messages",
+            headers=headers,
+            json=payload,
+            timeout=self.timeout,
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                yield chunk
 
     async def stream(
         self, request: ChatRequest
@@ -269,85 +310,70 @@ class AnthropicProvider(BaseProvider):
         发送流式聊天请求到 Anthropic。
         实时将 Anthropic 的事件流转换为 OpenAI 的 data: 格式。
         """
-        timeout = getattr(self.config, "timeout", 60.0)
-        async with httpx.AsyncClient() as client:
-            headers = {
-                "x-api-key": self.api_key,
-                "anthropic-version": "2023-06-01",
-                "content-type": "application/json",
-            }
-
-            system_message = next(
-                (m.content for m in request.messages if m.role == "system"), None
-            )
-            messages = [m for m in request.messages if m.role != "system"]
-
-            payload = {
-                "model": request.model,
-                "messages": self._map_messages(messages),
-                "max_tokens": request.max_tokens or 4096,
-                "temperature": request.temperature,
-                "top_p": request.top_p,
-                "stream": True,
-            }
-
-            if request.stop:
-                payload["stop_sequences"] = (
-                    [request.stop] if isinstance(request.stop, str) else request.stop
-                )
-
-            if system_message:
-                payload["system"] = system_message
+        headers = {
+            "x-api-key": self.api_key,
+            "anthropic-version": "2023-06-01",
+            "content-type": "application/json",
+        }
+
+        payload = self._build_payload(request)
+        payload["stream"] = True
+
+        async with self.client.stream(
+            "POST",
+            f"{self.base_url}/messages",
+            headers=headers,
+            json=payload,
+            timeout=self.timeout,
+        ) as response:
+            response.raise_for_status()
+            message_id = ""
+            model_name = ""
+            usage = Usage()
+            async for line in response.aiter_lines():
+                if line.startswith("data: "):
+                    data_str = line[6:]
+                    event_data = json.loads(data_str)
+                    event_type = event_data.get("type")
+
+                    if event_type == "message_start":
+                        message_id = event_data["message"]["id"]
+                        model_name = event_data["message"]["model"]
+                        usage = anthropic_usage(event_data["message"].get("usage", {}))
+                        yield {
+                            "id": message_id,
+                            "object": "chat.completion.chunk",
+                            "created": int(time.time()),
+                            "model": model_name,
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "delta": {"role": "assistant", "content": ""},
+                                    "finish_reason": None,
+                                }
+                            ],
+                            "usage": usage.stream_dict(),
+                        }
 
-            if request.tools:
-                payload["tools"] = [
-                    {
-                        "name": t.function.name,
-                        "description": t.function.description or "",
-                        "input_schema": t.function.parameters
-                        or {"type": "object", "properties": {}},
-                    }
-                    for t in request.tools
-                ]
-                # 处理工具选择策略转换
-                if request.tool_choice:
-                    if request.tool_choice == "auto":
-                        payload["tool_choice"] = {"type": "auto"}
-                    elif request.tool_choice == "required":
-                        payload["tool_choice"] = {"type": "any"}
-                    elif isinstance(request.tool_choice, dict):
-                        func_name = request.tool_choice.get("function", {}).get("name")
-                        if func_name:
-                            payload["tool_choice"] = {
-                                "type": "tool",
-                                "name": func_name,
+                    elif event_type == "content_block_delta":
+                        delta = event_data["delta"]
+                        block_index = event_data.get("index", 0)
+                        if delta["type"] == "text_delta":
+                            yield {
+                                "id": message_id,
+                                "object": "chat.completion.chunk",
+                                "created": int(time.time()),
+                                "model": model_name,
+                                "choices": [
+                                    {
+                                        "index": 0,
+                                        "delta": {"content": delta["text"]},
+                                        "finish_reason": None,
+                                    }
+                                ],
                             }
-
-            async with client.stream(
-                "POST",
-                f"{self.base_url}/messages",
-                headers=headers,
-                json=payload,
-                timeout=60.0,
-            ) as response:
-                response.raise_for_status()
-                message_id = ""
-                model_name = ""
-                prompt_tokens = 0
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
-                        data_str = line[6:]
-                        event_data = json.loads(data_str)
-                        event_type = event_data.get("type")
-
-                        if event_type == "message_start":
-                            message_id = event_data["message"]["id"]
-                            model_name = event_data["message"]["model"]
-                            prompt_tokens = (
-                                event_data["message"]
-                                .get("usage", {})
-                                .get("input_tokens", 0)
-                            )
+                        elif delta["type"] == "input_json_delta":
+                            # 处理工具调用参数流
                             yield {
                                 "id": message_id,
                                 "object": "chat.completion.chunk",
@@ -356,99 +382,27 @@ class AnthropicProvider(BaseProvider):
                                 "choices": [
                                     {
                                         "index": 0,
-                                        "delta": {"role": "assistant", "content": ""},
+                                        "delta": {
+                                            "tool_calls": [
+                                                {
+                                                    "index": block_index,
+                                                    "function": {
+                                                        "arguments": delta[
+                                                            "partial_json"
+                                                        ]
+                                                    },
+                                                }
+                                            ]
+                                        },
                                         "finish_reason": None,
                                     }
                                 ],
-                                "usage": {
-                                    "prompt_tokens": prompt_tokens,
-                                    "completion_tokens": 0,
-                                    "total_tokens": prompt_tokens,
-                                },
                             }
 
-                        elif event_type == "content_block_delta":
-                            delta = event_data["delta"]
-                            block_index = event_data.get("index", 0)
-                            if delta["type"] == "text_delta":
-                                yield {
-                                    "id": message_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": model_name,
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {"content": delta["text"]},
-                                            "finish_reason": None,
-                                        }
-                                    ],
-                                }
-                            elif delta["type"] == "input_json_delta":
-                                # 处理工具调用参数流
-                                yield {
-                                    "id": message_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": model_name,
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {
-                                                "tool_calls": [
-                                                    {
-                                                        "index": block_index,
-                                                        "function": {
-                                                            "arguments": delta[
-                                                                "partial_json"
-                                                            ]
-                                                        },
-                                                    }
-                                                ]
-                                            },
-                                            "finish_reason": None,
-                                        }
-                                    ],
-                                }
-
-                        elif event_type == "content_block_start":
-                            block_index = event_data.get("index", 0)
-                            if event_data["content_block"]["type"] == "tool_use":
-                                block = event_data["content_block"]
-                                yield {
-                                    "id": message_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": int(time.time()),
-                                    "model": model_name,
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {
-                                                "tool_calls": [
-                                                    {
-                                                        "index": block_index,
-                                                        "id": block["id"],
-                                                        "type": "function",
-                                                        "function": {
-                                                            "name": block["name"],
-                                                            "arguments": "",
-                                                        },
-                                                    }
-                                                ]
-                                            },
-                                            "finish_reason": None,
-                                        }
-                                    ],
-                                }
-
-                        elif event_type == "message_delta":
-                            stop_reason = event_data["delta"].get("stop_reason")
-                            finish_reason = stop_reason
-                            if stop_reason == "end_turn":
-                                finish_reason = "stop"
-                            elif stop_reason == "tool_use":
-                                finish_reason = "tool_calls"
-
+                    elif event_type == "content_block_start":
+                        block_index = event_data.get("index", 0)
+                        if event_data["content_block"]["type"] == "tool_use":
+                            block = event_data["content_block"]
                             yield {
                                 "id": message_id,
                                 "object": "chat.completion.chunk",
@@ -457,26 +411,61 @@ class AnthropicProvider(BaseProvider):
                                 "choices": [
                                     {
                                         "index": 0,
-                                        "delta": {},
-                                        "finish_reason": finish_reason,
+                                        "delta": {
+                                            "tool_calls": [
+                                                {
+                                                    "index": block_index,
+                                                    "id": block["id"],
+                                                    "type": "function",
+                                                    "function": {
+                                                        "name": block["name"],
+                                                        "arguments": "",
+                                                    },
+                                                }
+                                            ]
+                                        },
+                                        "finish_reason": None,
                                     }
                                 ],
-                                "usage": (
-                                    {
-                                        "prompt_tokens": prompt_tokens,
+                            }
+
+                    elif event_type == "message_delta":
+                        stop_reason = event_data["delta"].get("stop_reason")
+                        finish_reason = stop_reason
+                        if stop_reason == "end_turn":
+                            finish_reason = "stop"
+                        elif stop_reason == "tool_use":
+                            finish_reason = "tool_calls"
+
+                        yield {
+                            "id": message_id,
+                            "object": "chat.completion.chunk",
+                            "created": int(time.time()),
+                            "model": model_name,
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "delta": {},
+                                    "finish_reason": finish_reason,
+                                }
+                            ],
+                            "usage": (
+                                usage.model_copy(
+                                    update={
                                         "completion_tokens": event_data["usage"][
                                             "output_tokens"
                                         ],
-                                        "total_tokens": prompt_tokens
+                                        "total_tokens": usage.prompt_tokens
                                         + event_data["usage"]["output_tokens"],
                                     }
-                                    if "usage" in event_data
-                                    else None
-                                ),
-                            }
+                                ).stream_dict()
+                                if "usage" in event_data
+                                else None
+                            ),
+                        }
 
-                        elif event_type == "message_stop":
-                            break
+                    elif event_type == "message_stop":
+                        break
 
     async def image_gen(self, prompt: str, model: str) -> Dict[str, Any]:
         """
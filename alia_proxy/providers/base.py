@@ -1,7 +1,13 @@
+import importlib.util
+import json
+import time
 from abc import ABC, abstractmethod
+from functools import cached_property
 from typing import Any, Dict, List, Optional, AsyncGenerator, Union, Type
-from pydantic import BaseModel
+import httpx
+from pydantic import BaseModel, Field
 from ..config import ProviderConfig
+from .keypool import KeyPool
 
 
 class Function(BaseModel):
@@ -88,14 +94,35 @@ class ChatRequest(BaseModel):
     )
 
 
+# 只用于日志的缓存 Token 数字段
+CACHE_USAGE_FIELDS = ("cache_read_tokens", "cache_write_tokens")
+
+
 class Usage(BaseModel):
     """
     Token 使用量统计模型。
+    缓存 Token 数不属于 OpenAI 的响应格式，只用于日志，序列化响应时排除。
     """
 
     prompt_tokens: int = 0  # 提示词 Token 数
     completion_tokens: int = 0  # 补全词 Token 数
     total_tokens: int = 0  # 总 Token 数
+    cache_read_tokens: Optional[int] = Field(
+        default=None, exclude=True
+    )  # 命中提示词缓存的 Token 数 (上游返回时)
+    cache_write_tokens: Optional[int] = Field(
+        default=None, exclude=True
+    )  # 写入提示词缓存的 Token 数 (上游返回时)
+
+    def stream_dict(self) -> Dict[str, Any]:
+        """
+        流式数据块中的 usage，附带缓存 Token 数供 OpenAIStreamTap 记录日志 (编码时移除，不发送给客户端)。
+        """
+        usage = self.model_dump(exclude_none=True)
+        for name in CACHE_USAGE_FIELDS:
+            if getattr(self, name) is not None:
+                usage[name] = getattr(self, name)
+        return usage
 
 
 class ChatCompletionChoice(BaseModel):
@@ -123,6 +150,49 @@ class ChatResponse(BaseModel):
     usage: Usage  # Token 使用情况
 
 
+class RawChatResponse:
+    """
+    未经解析的上游聊天完成响应。
+    响应体原样返回给客户端，日志所需的字段 (id, usage, 首个选项内容) 仅在首次访问时解析。
+    """
+
+    def __init__(self, body: bytes, media_type: str = "application/json"):
+        self.body = body  # 上游原始响应体
+        self.media_type = media_type  # 上游响应的 Content-Type
+
+    @cached_property
+    def data(self) -> Dict[str, Any]:
+        """
+        解析后的响应体 (惰性)。
+        """
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    @property
+    def id(self) -> Optional[str]:
+        return self.data.get("id")
+
+    @cached_property
+    def usage(self) -> Usage:
+        return Usage(**(self.data.get("usage") or {}))
+
+    @property
+    def content(self) -> str:
+        """
+        首个选项的消息内容 (用于日志)。
+        """
+        choices = self.data.get("choices") or []
+        if not choices:
+            return ""
+        content = (choices[0].get("message") or {}).get("content")
+        if isinstance(content, list):
+            return json.dumps(content, ensure_ascii=False)
+        return content or ""
+
+
 class EmbeddingsRequest(BaseModel):
     """
     嵌入请求模型。
@@ -154,6 +224,8 @@ class BaseProvider(ABC):
     """
 
     Config: Type[ProviderConfig] = ProviderConfig
+    supports_passthrough: bool = False  # 上游是否使用 OpenAI 兼容协议 (可直接透传)
+    api_key_header: str = "Authorization"  # 携带 API Key 的请求头
 
     def __init__(self, config: ProviderConfig):
         """
@@ -163,28 +235,111 @@ class BaseProvider(ABC):
         self.config = config
         raw_key = config.api_key
         if isinstance(raw_key, list):
-            self._api_keys = raw_key
+            api_keys = raw_key
         elif isinstance(raw_key, str):
-            self._api_keys = [raw_key]
+            api_keys = [raw_key]
         else:
-            self._api_keys = []
+            api_keys = []
 
-        self._key_index = 0
+        self.key_pool = KeyPool(
+            api_keys,
+            cooldown=config.key_cooldown,
+            auth_cooldown=config.key_auth_cooldown,
+        )
         self.base_url = config.base_url
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        获取该提供商实例共享的 HTTP 客户端。
+        客户端在首次使用时创建，并在实例的整个生命周期内复用连接池 (Keep-Alive)。
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = self._create_client()
+        return self._client
+
+    def _create_client(self) -> httpx.AsyncClient:
+        """
+        根据提供商配置创建带连接池的 HTTP 客户端。
+        """
+        http2 = self.config.http2
+        if http2 and importlib.util.find_spec("h2") is None:
+            print("未安装 h2，HTTP/2 已禁用 (pip install alia-proxy[http2])")
+            http2 = False
+        return httpx.AsyncClient(
+            http2=http2,
+            event_hooks={
+                "request": [self._on_request],
+                "response": [self._on_response],
+            },
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.config.max_connections,
+                max_keepalive_connections=self.config.max_keepalive_connections,
+                keepalive_expiry=self.config.keepalive_expiry,
+            ),
+        )
+
+    @property
+    def timeout(self) -> httpx.Timeout:
+        """
+        上游请求的超时设置: 连接超时可单独配置，读写与等待连接池使用 timeout。
+        """
+        connect = self.config.connect_timeout
+        return httpx.Timeout(
+            self.config.timeout,
+            connect=connect if connect is not None else self.config.timeout,
+        )
+
+    async def aclose(self):
+        """
+        关闭共享的 HTTP 客户端，释放连接池中的所有连接。
+        """
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
 
     @property
     def api_key(self) -> str:
         """
-        获取当前使用的 API Key。
-        支持多 Key 轮换逻辑。
+        获取本次请求使用的 API Key。
+        由 Key 池根据各 Key 的健康状况选择，跳过处于冷却期的 Key。
         """
-        if not self._api_keys:
-            return ""
-        key = self._api_keys[self._key_index]
-        # 轮换到下一个 Key
-        if len(self._api_keys) > 1:
-            self._key_index = (self._key_index + 1) % len(self._api_keys)
-        return key
+        return self.key_pool.acquire()
+
+    def _request_key(self, request: httpx.Request) -> Optional[str]:
+        """
+        从上游请求头中取回本次使用的 API Key。
+        """
+        value = request.headers.get(self.api_key_header)
+        if not value:
+            return None
+        if value.startswith("Bearer "):
+            value = value[7:]
+        return value
+
+    async def _on_request(self, request: httpx.Request):
+        """
+        HTTP 客户端请求钩子: 记录请求开始时间。
+        """
+        request.extensions["alia_start"] = time.perf_counter()
+
+    async def _on_response(self, response: httpx.Response):
+        """
+        HTTP 客户端响应钩子: 将响应结果反馈给 Key 池。
+        """
+        key = self._request_key(response.request)
+        if not key:
+            return
+        start = response.request.extensions.get("alia_start")
+        latency = time.perf_counter() - start if start is not None else None
+        self.key_pool.report(
+            key,
+            response.status_code,
+            latency=latency,
+            retry_after=response.headers.get("retry-after"),
+        )
 
     @abstractmethod
     async def chat(self, request: ChatRequest) -> ChatResponse:
@@ -210,6 +365,31 @@ class BaseProvider(ABC):
         if False:
             yield {}
 
+    async def chat_raw(self, request: ChatRequest) -> RawChatResponse:
+        """
+        执行非流式聊天完成，原样返回上游响应体。
+        仅 supports_passthrough 为 True 的提供商需要实现。
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support raw response passthrough"
+        )
+
+    async def stream_raw(self, request: ChatRequest) -> AsyncGenerator[bytes, None]:
+        """
+        执行流式聊天完成，原样返回上游的 SSE 字节。
+        仅 supports_passthrough 为 True 的提供商需要实现。
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} does not support raw stream passthrough"
+        )
+        yield b""
+
+    def can_passthrough(self) -> bool:
+        """
+        当前实例是否启用了响应透传。
+        """
+        return self.supports_passthrough and self.config.passthrough
+
     @abstractmethod
     async def image_gen(self, prompt: str, model: str) -> Dict[str, Any]:
         """
@@ -1,11 +1,16 @@
+import asyncio
 import random
-from typing import Dict, Optional, Tuple, Type, List, Union
+from typing import Dict, Optional, Set, Tuple, Type, List, Union
 from .openai import OpenAIProvider
 from .anthropic import AnthropicProvider
 from .ollama import OllamaProvider
 from ..config import settings, MappingConfig
+from ..services.telemetry import telemetry, TELEMETRY_STRATEGIES
 from .base import BaseProvider
 
+# 基于遥测的路由策略中随机探索的概率 (使较慢的目标也能持续获得新样本)
+EXPLORATION_RATE = 0.05
+
 
 class ProviderFactory:
     """
@@ -20,15 +25,57 @@ class ProviderFactory:
         "ollama": OllamaProvider,
     }
     _mapping_indices: Dict[str, int] = {}  # 存储 mapping 轮换的当前索引
+    _retired: Set[BaseProvider] = set()  # 已从缓存移除、等待关闭连接池的实例
+    _close_tasks: Set[asyncio.Task] = set()  # 延迟关闭任务 (保持引用防止被回收)
+    retire_grace_period: float = 300.0  # 旧实例连接池的延迟关闭时间 (秒)
 
     @classmethod
     def clear_cache(cls):
         """
         清空实例缓存。用于配置重载时。
+        旧实例的连接池会在宽限期后关闭，以便正在进行的请求 (如长流式响应) 正常完成。
         """
+        retired = list(cls._instances.values())
         cls._instances.clear()
         cls._mapping_indices.clear()
 
+        if not retired:
+            return
+        cls._retired.update(retired)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中，等待 close_all 统一关闭
+            return
+        task = loop.create_task(cls._close_retired(retired))
+        cls._close_tasks.add(task)
+        task.add_done_callback(cls._close_tasks.discard)
+
+    @classmethod
+    async def _close_retired(cls, providers: List[BaseProvider]):
+        """
+        宽限期结束后关闭旧实例的连接池。
+        """
+        await asyncio.sleep(cls.retire_grace_period)
+        for provider in providers:
+            cls._retired.discard(provider)
+            await provider.aclose()
+
+    @classmethod
+    async def close_all(cls):
+        """
+        关闭所有提供商实例 (包括等待关闭的旧实例) 的连接池。
+        用于应用关闭时。
+        """
+        for task in list(cls._close_tasks):
+            task.cancel()
+        providers = list(cls._instances.values()) + list(cls._retired)
+        cls._instances.clear()
+        cls._retired.clear()
+        cls._mapping_indices.clear()
+        for provider in providers:
+            await provider.aclose()
+
     @classmethod
     def register(cls, provider_type: str, provider_class: Type[BaseProvider]):
         """
@@ -41,7 +88,7 @@ class ProviderFactory:
         """
         解析请求中的模型字段。
         支持从 settings.mapping 进行别名映射。
-        支持多目标映射及轮换/随机策略。
+        支持多目标映射及轮换/随机/加权/最低延迟/最少并发策略。
         期望格式: <提供商配置名>/<模型标识符> (例如: gpt4-main/gpt-4o)
         :return: (提供商名称, 模型名称, 降级列表)
         """
@@ -51,10 +98,12 @@ class ProviderFactory:
             config = settings.mapping[model_field]
 
             # 处理 MappingConfig 对象
+            weights = None
             if isinstance(config, MappingConfig):
                 targets = config.targets
                 strategy = config.strategy
                 fallbacks = config.fallbacks
+                weights = config.weights
             # 处理 List[str] 简写
             elif isinstance(config, list):
                 targets = config
@@ -70,6 +119,13 @@ class ProviderFactory:
             # 根据策略选择目标
             if strategy == "random":
                 target = random.choice(targets)
+            elif strategy == "weighted" and weights:
+                target = random.choices(targets, weights=weights)[0]
+            elif strategy in TELEMETRY_STRATEGIES:
+                if len(targets) > 1 and random.random() < EXPLORATION_RATE:
+                    target = random.choice(targets)
+                else:
+                    target = min(targets, key=lambda t: cls.target_score(t, strategy))
             else:  # round-robin
                 idx = cls._mapping_indices.get(model_field, 0)
                 target = targets[idx]
@@ -86,6 +142,22 @@ class ProviderFactory:
             f"Invalid model field format: {model_field}. Expected: <provider>/<model> or a mapped alias."
         )
 
+    @staticmethod
+    def target_score(target: str, strategy: str) -> tuple:
+        """
+        目标 (<提供商配置名>/<模型标识符>) 在基于遥测的策略下的排序键，数值越小越优先。
+        """
+        instance_name, _, model = target.partition("/")
+        return telemetry.score(instance_name, model, strategy)
+
+    @classmethod
+    def get_mapping(cls, model_field: str) -> Optional[MappingConfig]:
+        """
+        获取模型字段命中的完整映射配置 (简写形式的映射返回 None)。
+        """
+        config = settings.mapping.get(model_field)
+        return config if isinstance(config, MappingConfig) else None
+
     @classmethod
     def get_provider(cls, name: str) -> BaseProvider:
         """
@@ -0,0 +1,207 @@
+"""
+API Key 池。
+记录每个 Key 的请求结果，对被限流 (429) 或失效 (401/403) 的 Key 进行冷却，
+并按近期成功率与延迟加权选择 Key。
+"""
+
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, List, Optional
+
+# 平滑系数: 数值越大，越偏重最近的请求结果
+EWMA_ALPHA = 0.2
+# 最低权重，保证表现较差的 Key 仍有机会被选中并恢复
+MIN_WEIGHT = 0.05
+
+
+def mask_key(key: str) -> str:
+    """
+    对 API Key 进行脱敏，仅保留首尾各 4 位。
+    """
+    if len(key) > 8:
+        return f"{key[:4]}...{key[-4:]}"
+    return "****"
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    解析 Retry-After 响应头 (秒数或 HTTP 日期)，返回需要等待的秒数。
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class KeyStats:
+    """
+    单个 API Key 的运行状态。
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.requests = 0  # 总请求数
+        self.successes = 0  # 成功次数
+        self.failures = 0  # 失败次数 (限流、鉴权失败、上游错误)
+        self.consecutive_failures = 0  # 连续失败次数
+        self.success_rate = 1.0  # 成功率 (EWMA)
+        self.latency: Optional[float] = None  # 首字节延迟 (EWMA, 秒)
+        self.cooldown_until = 0.0  # 冷却截止时间 (time.monotonic)
+        self.last_status: Optional[int] = None  # 最近一次响应状态码
+        self.current_weight = 0.0  # 平滑加权轮询的当前权重
+
+    def in_cooldown(self, now: float) -> bool:
+        return self.cooldown_until > now
+
+    def weight(self, default_latency: float) -> float:
+        """
+        选择权重: 成功率越高、延迟越低，权重越大。
+        """
+        latency = self.latency if self.latency is not None else default_latency
+        return max(self.success_rate, MIN_WEIGHT) / max(latency, 0.05)
+
+
+class KeyPool:
+    """
+    API Key 池。
+    使用平滑加权轮询 (Smooth Weighted Round-Robin) 在可用的 Key 之间选择；
+    在没有任何观测数据时，其行为等同于普通轮询。
+    """
+
+    def __init__(
+        self,
+        keys: List[str],
+        cooldown: float = 30.0,
+        auth_cooldown: float = 600.0,
+    ):
+        """
+        :param keys: API Key 列表
+        :param cooldown: 429 且未返回 Retry-After 时的默认冷却时间 (秒)
+        :param auth_cooldown: 401/402/403 (Key 失效或额度耗尽) 时的冷却时间 (秒)
+        """
+        self._stats: Dict[str, KeyStats] = {key: KeyStats(key) for key in keys}
+        self.cooldown = cooldown
+        self.auth_cooldown = auth_cooldown
+
+    def __len__(self) -> int:
+        return len(self._stats)
+
+    def acquire(self) -> str:
+        """
+        选择一个 API Key。
+        优先选择不在冷却期的 Key；如果全部处于冷却期，则返回最早恢复的 Key。
+        """
+        if not self._stats:
+            return ""
+        stats = list(self._stats.values())
+        if len(stats) == 1:
+            return stats[0].key
+
+        now = time.monotonic()
+        available = [s for s in stats if not s.in_cooldown(now)]
+        if not available:
+            return min(stats, key=lambda s: s.cooldown_until).key
+
+        observed = [s.latency for s in available if s.latency is not None]
+        default_latency = sum(observed) / len(observed) if observed else 1.0
+
+        total = 0.0
+        for s in available:
+            weight = s.weight(default_latency)
+            s.current_weight += weight
+            total += weight
+        best = max(available, key=lambda s: s.current_weight)
+        best.current_weight -= total
+        return best.key
+
+    def report(
+        self,
+        key: str,
+        status_code: int,
+        latency: Optional[float] = None,
+        retry_after: Optional[str] = None,
+    ):
+        """
+        记录一次请求结果。
+        :param key: 使用的 API Key
+        :param status_code: 上游响应状态码
+        :param latency: 首字节延迟 (秒)
+        :param retry_after: 上游返回的 Retry-After 响应头
+        """
+        stats = self._stats.get(key)
+        if stats is None:
+            return
+
+        stats.requests += 1
+        stats.last_status = status_code
+        if latency is not None and status_code < 400:
+            stats.latency = (
+                latency
+                if stats.latency is None
+                else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * stats.latency
+            )
+
+        if status_code == 429 or status_code in (401, 402, 403) or status_code >= 500:
+            outcome = 0.0
+            stats.failures += 1
+            stats.consecutive_failures += 1
+        elif status_code < 400:
+            outcome = 1.0
+            stats.successes += 1
+            stats.consecutive_failures = 0
+        else:
+            # 其他 4xx 通常是请求本身的问题，与 Key 无关
+            return
+        stats.success_rate = (
+            EWMA_ALPHA * outcome + (1 - EWMA_ALPHA) * stats.success_rate
+        )
+
+        # 冷却: 限流按 Retry-After (连续限流时指数退避)，鉴权失败长时间冷却
+        if status_code == 429:
+            wait = parse_retry_after(retry_after)
+            if wait is None:
+                wait = min(
+                    self.cooldown * 2 ** (stats.consecutive_failures - 1),
+                    self.auth_cooldown,
+                )
+            stats.cooldown_until = time.monotonic() + wait
+        elif status_code in (401, 402, 403):
+            stats.cooldown_until = time.monotonic() + self.auth_cooldown
+
+    def reset(self):
+        """
+        清除所有 Key 的冷却状态。
+        """
+        for stats in self._stats.values():
+            stats.cooldown_until = 0.0
+            stats.consecutive_failures = 0
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """
+        获取所有 Key 的统计信息 (Key 已脱敏)。
+        """
+        now = time.monotonic()
+        return [
+            {
+                "index": i,
+                "key": mask_key(s.key),
+                "requests": s.requests,
+                "successes": s.successes,
+                "failures": s.failures,
+                "success_rate": round(s.success_rate, 4),
+                "latency": round(s.latency, 4) if s.latency is not None else None,
+                "last_status": s.last_status,
+                "cooldown_remaining": round(max(s.cooldown_until - now, 0.0), 1),
+            }
+            for i, s in enumerate(self._stats.values())
+        ]
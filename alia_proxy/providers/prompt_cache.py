@@ -0,0 +1,144 @@
+"""
+Anthropic 提示词缓存断点的自动插入。
+按缓存顺序 (tools -> system -> messages) 计算每个边界处的前缀哈希，并跟踪近期请求中出现过的前缀：
+同一前缀在有效期内再次出现即视为稳定前缀，在其末尾插入 cache_control 断点。
+"""
+
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple
+
+# Anthropic 单个请求最多允许的缓存断点数
+MAX_BREAKPOINTS = 4
+# 最多跟踪的前缀数量
+MAX_PREFIXES = 4096
+# 估算 Token 数时每个 Token 对应的字符数
+CHARS_PER_TOKEN = 4
+
+EPHEMERAL = {"type": "ephemeral"}
+
+
+class Boundary(NamedTuple):
+    """
+    请求体中一个可以插入断点的位置。
+    """
+
+    kind: str  # tools, system 或 message
+    index: int  # message 的位置 (tools / system 为 -1)
+    digest: bytes  # 截至该位置的前缀哈希
+    tokens: int  # 截至该位置的前缀估算 Token 数
+
+
+class PrefixTracker:
+    """
+    近期出现过的前缀哈希 (按最近出现时间进行 LRU 淘汰)。
+    """
+
+    def __init__(self):
+        self._seen: "OrderedDict[bytes, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def seen(self, digest: bytes, ttl: float, now: float) -> bool:
+        last_seen = self._seen.get(digest)
+        return last_seen is not None and now - last_seen <= ttl
+
+    def record(self, digests: List[bytes], now: float):
+        for digest in digests:
+            self._seen[digest] = now
+            self._seen.move_to_end(digest)
+        while len(self._seen) > MAX_PREFIXES:
+            self._seen.popitem(last=False)
+
+
+def boundaries(payload: Dict[str, Any]) -> List[Boundary]:
+    """
+    按 Anthropic 的缓存顺序计算每个边界处的累积前缀哈希。
+    哈希以模型名为种子，不同模型的缓存互不共享。
+    """
+    digest = hashlib.sha256(payload["model"].encode())
+    size = 0
+    result = []
+
+    def add(kind: str, index: int, segment: Any):
+        nonlocal size
+        text = json.dumps(
+            segment, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+        )
+        digest.update(text.encode())
+        size += len(text)
+        result.append(
+            Boundary(kind, index, digest.copy().digest(), size // CHARS_PER_TOKEN)
+        )
+
+    if payload.get("tools"):
+        add("tools", -1, payload["tools"])
+    if payload.get("system"):
+        add("system", -1, payload["system"])
+    for i, message in enumerate(payload["messages"]):
+        add("message", i, message)
+    return result
+
+
+def _with_breakpoint(content: Any) -> Any:
+    """
+    在内容的最后一个块上添加 cache_control。字符串内容转换为单个文本块。
+    """
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, "cache_control": EPHEMERAL}]
+    blocks = list(content)
+    blocks[-1] = {**blocks[-1], "cache_control": EPHEMERAL}
+    return blocks
+
+
+def _mark(payload: Dict[str, Any], boundary: Boundary):
+    if boundary.kind == "tools":
+        payload["tools"][-1] = {**payload["tools"][-1], "cache_control": EPHEMERAL}
+    elif boundary.kind == "system":
+        payload["system"] = _with_breakpoint(payload["system"])
+    else:
+        message = payload["messages"][boundary.index]
+        if message.get("content"):
+            payload["messages"][boundary.index] = {
+                **message,
+                "content": _with_breakpoint(message["content"]),
+            }
+
+
+def apply_breakpoints(
+    payload: Dict[str, Any], tracker: PrefixTracker, min_tokens: int, ttl: float
+) -> List[Boundary]:
+    """
+    为请求体中的稳定前缀插入缓存断点，并记录本次请求的所有前缀。
+    - 最长的稳定前缀: 读取已有缓存 (或在首次重复时写入)。
+    - 对话仍在延续 (稳定前缀落在消息上) 时，在最后一条消息处写入缓存，供下一轮读取。
+    - 稳定的工具与系统提示: 通常被多个对话共享，单独设置断点。
+    估算 Token 数低于 min_tokens 的前缀不会被缓存，不插入断点。
+    :return: 插入了断点的位置
+    """
+    bounds = boundaries(payload)
+    if not bounds:
+        return []
+    now = time.time()
+    stable = [
+        b for b in bounds if b.tokens >= min_tokens and tracker.seen(b.digest, ttl, now)
+    ]
+    tracker.record([b.digest for b in bounds], now)
+    if not stable:
+        return []
+
+    deepest = stable[-1]
+    chosen = [deepest]
+    last = bounds[-1]
+    if deepest.kind == "message" and last is not deepest:
+        chosen.append(last)
+    shared = [b for b in stable if b.kind != "message"]
+    if shared and shared[-1] is not deepest:
+        chosen.append(shared[-1])
+
+    for boundary in chosen[:MAX_BREAKPOINTS]:
+        _mark(payload, boundary)
+    return chosen[:MAX_BREAKPOINTS]
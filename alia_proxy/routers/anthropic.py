@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Request, Depends, HTTPException
 from fastapi.responses import StreamingResponse
-from .deps import get_proxy_service
+from .deps import get_proxy_service, watch_disconnect
 from ..services.proxy import ProxyService
 
 router = APIRouter()
@@ -16,10 +16,17 @@ async def messages(request: Request, proxy: ProxyService = Depends(get_proxy_ser
     try:
         response = await proxy.anthropic_chat(body)
         if body.get("stream"):
-            return StreamingResponse(response, media_type="text/event-stream")
+            return StreamingResponse(
+                watch_disconnect(request, response), media_type="text/event-stream"
+            )
         else:
             return response
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        # 与全局异常处理一致: 异常自带 status_code 时使用该状态码 (如熔断或限流拒绝时的 503)
+        status_code = getattr(e, "status_code", 500)
+        raise HTTPException(
+            status_code=status_code if isinstance(status_code, int) else 500,
+            detail=str(e),
+        )
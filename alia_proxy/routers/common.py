@@ -1,13 +1,93 @@
 from fastapi import APIRouter, HTTPException, Query
-from ..models import RequestLog
+from ..models import (
+    RequestLog,
+    RequestContent,
+    RequestAttempt,
+    Rollup,
+    RollupMinute,
+    RollupHour,
+    RollupDay,
+)
+from ..database import database
 from ..config import settings
+from ..providers.keypool import mask_key
+from ..services.breaker import circuit_breakers
+from ..services.telemetry import telemetry
+from ..services.limiter import limiters
+from ..services.cache import response_cache, embedding_cache
+from ..services.batcher import embedding_batcher
+from ..services.semantic import semantic_cache
+from ..services.logger import log_writer
+from ..services.compression import compression_stats, content_migrator
+from ..services.blobs import blob_store
+from ..services.rollups import HISTOGRAMS, histogram_columns, delete_logs
 from tortoise.functions import Count, Sum, Avg
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Type
 from datetime import datetime, timedelta
+from tortoise import timezone
 from tortoise.expressions import RawSQL
 
 router = APIRouter()
 
+# 成功请求数 (汇总表按状态码分组，状态码低于 400 的请求数之和)
+SUCCESS_SQL = "SUM(CASE WHEN status_code < 400 THEN requests ELSE 0 END)"
+
+
+def _rollup_query(
+    model: Type[Rollup],
+    start: datetime,
+    model_name: Optional[str],
+    provider: Optional[str],
+    db,
+):
+    """
+    按起始时间与筛选条件查询汇总表。
+    """
+    query = model.filter(bucket__gte=start).using_db(db)
+    if model_name:
+        query = query.filter(model=model_name)
+    if provider:
+        query = query.filter(provider=provider)
+    return query
+
+
+def _histogram(row: Dict[str, Any], name: str) -> Dict[str, int]:
+    """
+    将汇总后的直方图列转换为 区间名称 -> 数量。
+    """
+    return {
+        bucket: int(row.get(column) or 0)
+        for bucket, column in zip(HISTOGRAMS[name], histogram_columns(name))
+    }
+
+
+def _histogram_sums(name: str) -> Dict[str, Sum]:
+    return {column: Sum(column) for column in histogram_columns(name)}
+
+
+def _distribution(rows: List[Dict[str, Any]], name: str) -> List[Dict[str, Any]]:
+    """
+    将按提供商与模型汇总的直方图展开为 (提供商, 模型, 区间, 数量) 的列表 (省略数量为 0 的区间)。
+    """
+    return [
+        {
+            "provider": row["provider"],
+            "model": row["model"],
+            "bucket": bucket,
+            "count": count,
+        }
+        for row in rows
+        for bucket, count in _histogram(row, name).items()
+        if count
+    ]
+
+
+def _by_date(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    将按天汇总的时间段起始时间转换为日期。
+    """
+    return [{"date": row.pop("bucket").date(), **row} for row in rows]
+
 
 @router.get("/api/analytics")
 async def get_analytics(
@@ -23,31 +103,46 @@ async def get_analytics(
     3. 每模型 Token 消耗趋势
     4. 每模型请求数趋势
     5. RPM/TPM/RPD 细分
+    6. 流式响应的首个数据块延迟 (TTFT) 与输出速度分布 (按提供商与模型)
+    7. 降级、对冲与竞速产生的上游调用 (失败调用按提供商、模型与状态码汇总)
+    以上统计均以逻辑请求为单位 (多次上游调用只计一次请求)。
+    统计读取预聚合的汇总表: RPM/TPM 按分钟，摘要与分布按小时 (从起始时间所在的小时开始)，趋势按天。
+    时间段按带时区的当前时间划分，与写入汇总表时一致。
+    查询通过只读连接执行，不与日志写入争用写连接。
     """
-    start_date = datetime.now() - timedelta(days=days)
-
-    base_query = RequestLog.filter(timestamp__gte=start_date)
-    if model:
-        base_query = base_query.filter(model=model)
-    if provider:
-        base_query = base_query.filter(provider=provider)
-
-    # 1. 总体统计 (总请求, 成功率, 平均耗时)
-    total_count = await base_query.count()
-    success_count = await base_query.filter(status_code__lt=400).count()
-
-    # 优化平均耗时查询，直接聚合
-    avg_latency_result = await base_query.annotate(avg_lat=Avg("latency")).values(
-        "avg_lat"
+    start_date = timezone.now() - timedelta(days=days)
+    hour_start = start_date.replace(minute=0, second=0, microsecond=0)
+    day_start = hour_start.replace(hour=0)
+
+    db = database.reader()
+    minute_query = _rollup_query(RollupMinute, start_date, model, provider, db)
+    hour_query = _rollup_query(RollupHour, hour_start, model, provider, db)
+    day_query = _rollup_query(RollupDay, day_start, model, provider, db)
+
+    # 1. 总体统计 (总请求, 成功率, 平均耗时, 上游调用总数与发生过降级的请求数) 与延迟分布
+    totals = await hour_query.annotate(
+        total=Sum("requests"),
+        success=RawSQL(SUCCESS_SQL),
+        latency=Sum("latency_sum"),
+        attempts=Sum("attempts"),
+        retried=Sum("retried"),
+        **_histogram_sums("latency"),
+    ).values(
+        "total",
+        "success",
+        "latency",
+        "attempts",
+        "retried",
+        *histogram_columns("latency"),
     )
-    avg_latency_val = 0.0
-    if avg_latency_result and avg_latency_result[0].get("avg_lat") is not None:
-        avg_latency_val = float(avg_latency_result[0]["avg_lat"])
+    summary = totals[0] if totals else {}
+    total_count = int(summary.get("total") or 0)
+    success_count = int(summary.get("success") or 0)
 
     # 2. 错误分布 (全局摘要)
     error_summary = (
-        await base_query.filter(status_code__gte=400)
-        .annotate(count=Count("id"))
+        await hour_query.filter(status_code__gte=400)
+        .annotate(count=Sum("requests"))
         .group_by("status_code")
         .values("status_code", "count")
     )
@@ -55,33 +150,30 @@ async def get_analytics(
     # 3. 趋势数据 (按天聚合)
     # 总体请求数与成功率趋势
     overall_daily_stats = (
-        await base_query.group_by("date")
-        .annotate(
-            total=Count("id"),
-            success=RawSQL("SUM(CASE WHEN status_code < 400 THEN 1 ELSE 0 END)"),
-        )
-        .values("date", "total", "success")
+        await day_query.group_by("bucket")
+        .annotate(total=Sum("requests"), success=RawSQL(SUCCESS_SQL))
+        .values("bucket", "total", "success")
     )
 
     # 错误趋势 (按天聚合错误代码)
     error_daily_stats = (
-        await base_query.filter(status_code__gte=400)
-        .group_by("date", "status_code")
-        .annotate(count=Count("id"))
-        .values("date", "status_code", "count")
+        await day_query.filter(status_code__gte=400)
+        .group_by("bucket", "status_code")
+        .annotate(count=Sum("requests"))
+        .values("bucket", "status_code", "count")
     )
 
     # 每个模型的请求数和 Token 数趋势
     model_daily_stats = (
-        await base_query.group_by("date", "provider", "model")
+        await day_query.group_by("bucket", "provider", "model")
         .annotate(
-            request_count=Count("id"),
+            request_count=Sum("requests"),
             input_tokens=Sum("prompt_tokens"),
             output_tokens=Sum("completion_tokens"),
             total_tokens=Sum("total_tokens"),
         )
         .values(
-            "date",
+            "bucket",
             "provider",
             "model",
             "request_count",
@@ -94,45 +186,67 @@ async def get_analytics(
     # 4. 速率限制细分 (RPM/TPM 趋势，用于仪表盘图表)
     # 按分钟聚合
     minute_usage = (
-        await base_query.annotate(
-            minute=RawSQL("strftime('%Y-%m-%d %H:%M', timestamp)")
-        )
-        .group_by("minute", "provider", "model")
-        .annotate(rpm=Count("id"), tpm=Sum("total_tokens"))
-        .values("minute", "provider", "model", "rpm", "tpm")
+        await minute_query.group_by("bucket", "provider", "model")
+        .annotate(rpm=Sum("requests"), tpm=Sum("total_tokens"))
+        .values("bucket", "provider", "model", "rpm", "tpm")
     )
 
     # 5. Provider 趋势 (按天聚合)
     provider_daily_stats = (
-        await base_query.group_by("date", "provider")
+        await day_query.group_by("bucket", "provider")
         .annotate(
-            total=Count("id"),
-            success=RawSQL("SUM(CASE WHEN status_code < 400 THEN 1 ELSE 0 END)"),
-            avg_latency=Avg("latency"),
+            total=Sum("requests"),
+            success=RawSQL(SUCCESS_SQL),
+            latency=Sum("latency_sum"),
         )
-        .values("date", "provider", "total", "success", "avg_latency")
+        .values("bucket", "provider", "total", "success", "latency")
     )
 
-    # 6. 按小时聚合
-    hourly_stats = (
-        await base_query.annotate(hour=RawSQL("strftime('%H', timestamp)"))
-        .group_by("hour")
-        .annotate(count=Count("id"))
+    # 6. 按小时聚合 (汇总表存储了时间段的小时，不依赖数据库的日期函数)
+    hourly_stats = [
+        {"hour": f"{row['hour']:02d}", "count": row["count"]}
+        for row in await hour_query.group_by("hour")
+        .annotate(count=Sum("requests"))
         .values("hour", "count")
+    ]
+
+    # 7. 流式响应: TTFT 与输出速度 (按提供商与模型)
+    stream_stats = (
+        await hour_query.filter(streams__gt=0)
+        .group_by("provider", "model")
+        .annotate(
+            stream_count=Sum("streams"),
+            ttft=Sum("ttft_sum"),
+            throughput=Sum("throughput_sum"),
+            throughput_requests=Sum("throughput_count"),
+            **_histogram_sums("ttft"),
+            **_histogram_sums("throughput"),
+        )
+        .values(
+            "provider",
+            "model",
+            "stream_count",
+            "ttft",
+            "throughput",
+            "throughput_requests",
+            *histogram_columns("ttft"),
+            *histogram_columns("throughput"),
+        )
     )
 
-    # 7. 延迟分布
-    latency_bins = {
-        "0-0.5s": (0, 0.5),
-        "0.5-1s": (0.5, 1),
-        "1-2s": (2, 5),
-        "2-5s": (2, 5),
-        "5s+": (5, 9999),
-    }
-    latency_distribution = {}
-    for name, (lower, upper) in latency_bins.items():
-        count = await base_query.filter(latency__gte=lower, latency__lt=upper).count()
-        latency_distribution[name] = count
+    # 8. 降级过程中失败的上游调用 (只有一次调用的请求没有调用记录，其结果即请求本身)
+    attempt_query = RequestAttempt.filter(
+        log__timestamp__gte=start_date, status_code__gte=400
+    ).using_db(db)
+    if model:
+        attempt_query = attempt_query.filter(model=model)
+    if provider:
+        attempt_query = attempt_query.filter(provider=provider)
+    attempt_failures = (
+        await attempt_query.group_by("provider", "model", "status_code")
+        .annotate(count=Count("id"), avg_latency=Avg("latency"))
+        .values("provider", "model", "status_code", "count", "avg_latency")
+    )
 
     return {
         "summary": {
@@ -140,16 +254,49 @@ async def get_analytics(
             "success_rate": (
                 (success_count / total_count * 100) if total_count > 0 else 100
             ),
-            "avg_latency": avg_latency_val,
+            "avg_latency": (
+                float(summary["latency"]) / total_count if total_count > 0 else 0.0
+            ),
+            "total_attempts": int(summary.get("attempts") or 0),
+            "retried_requests": int(summary.get("retried") or 0),
         },
         "errors": {str(item["status_code"]): item["count"] for item in error_summary},
-        "error_trends": error_daily_stats,
-        "overall_trends": overall_daily_stats,
-        "model_trends": model_daily_stats,
-        "minute_usage": minute_usage,
-        "provider_trends": provider_daily_stats,
+        "error_trends": _by_date(error_daily_stats),
+        "overall_trends": _by_date(overall_daily_stats),
+        "model_trends": _by_date(model_daily_stats),
+        "minute_usage": [
+            {"minute": row.pop("bucket").strftime("%Y-%m-%d %H:%M"), **row}
+            for row in minute_usage
+        ],
+        "provider_trends": [
+            {
+                "date": row["bucket"].date(),
+                "provider": row["provider"],
+                "total": row["total"],
+                "success": row["success"],
+                "avg_latency": row["latency"] / row["total"] if row["total"] else None,
+            }
+            for row in provider_daily_stats
+        ],
         "hourly_trends": hourly_stats,
-        "latency_distribution": latency_distribution,
+        "latency_distribution": _histogram(summary, "latency"),
+        "stream_stats": [
+            {
+                "provider": row["provider"],
+                "model": row["model"],
+                "requests": row["stream_count"],
+                "avg_ttft": row["ttft"] / row["stream_count"],
+                "avg_tokens_per_second": (
+                    row["throughput"] / row["throughput_requests"]
+                    if row["throughput_requests"]
+                    else None
+                ),
+            }
+            for row in stream_stats
+        ],
+        "ttft_distribution": _distribution(stream_stats, "ttft"),
+        "throughput_distribution": _distribution(stream_stats, "throughput"),
+        "attempt_failures": attempt_failures,
     }
 
 
@@ -172,9 +319,10 @@ async def get_logs(
 ):
     """
     获取请求日志列表，支持过滤和分页。
-    列表仅返回元数据及媒体信息，不包含大文本内容。
+    每条日志对应一次逻辑请求 (含其全部上游调用)。
+    列表仅返回元数据及媒体信息，不包含大文本内容与调用记录。
     """
-    query = RequestLog.all()
+    query = RequestLog.all().using_db(database.reader())
     if provider:
         query = query.filter(provider=provider)
     if model:
@@ -210,6 +358,7 @@ async def get_logs(
             "is_streaming": log.is_streaming,
             "ip_address": log.ip_address,
             "metadata": log.metadata,
+            "attempt_count": log.attempt_count,
             "media": [
                 {"file_path": m.file_path, "file_type": m.file_type} for m in log.media
             ],
@@ -223,9 +372,14 @@ async def get_logs(
 async def get_log_detail(log_id: int):
     """
     获取特定请求日志的详细信息。
-    手动序列化关联的 content 和 media 数据。
+    手动序列化关联的 content、media 与上游调用记录。
     """
-    log = await RequestLog.get_or_none(id=log_id).prefetch_related("content", "media")
+    log = (
+        await RequestLog.filter(id=log_id)
+        .using_db(database.reader())
+        .prefetch_related("content", "media", "attempts")
+        .first()
+    )
     if not log:
         raise HTTPException(status_code=404, detail="Log not found")
 
@@ -244,22 +398,30 @@ async def get_log_detail(log_id: int):
         "request_id": log.request_id,
         "is_streaming": log.is_streaming,
         "metadata": log.metadata,
+        "attempt_count": log.attempt_count,
         "timestamp": log.timestamp.isoformat(),
         "date": log.date.isoformat(),
     }
 
     if log.content:
-        data["content"] = {
-            "prompt": log.content.prompt,
-            "response": log.content.response,
-            "error": log.content.error,
-        }
+        data["content"] = (await blob_store.load_contents([log.content]))[0]
     else:
         data["content"] = None
 
     data["media"] = [
         {"file_path": m.file_path, "file_type": m.file_type} for m in log.media
     ]
+    data["attempts"] = [
+        {
+            "attempt": a.attempt,
+            "provider": a.provider,
+            "model": a.model,
+            "status_code": a.status_code,
+            "latency": a.latency,
+            "error": a.error,
+        }
+        for a in sorted(log.attempts, key=lambda a: a.attempt)
+    ]
 
     return data
 
@@ -267,12 +429,13 @@ async def get_log_detail(log_id: int):
 @router.delete("/api/logs/{log_id}")
 async def delete_log(log_id: int):
     """
-    删除特定的请求日志。
+    删除特定的请求日志 (同时从分析汇总表中减去)。
+    内容单独存储时不会级联删除，按 log_id 直接删除对应的内容；
+    不再被引用的消息块在下次批量删除日志时清理 (清理需要扫描全部引用)。
     """
-    log = await RequestLog.get_or_none(id=log_id)
-    if not log:
+    if not await delete_logs(RequestLog.filter(id=log_id)):
         raise HTTPException(status_code=404, detail="Log not found")
-    await log.delete()
+    await RequestContent.filter(log_id=log_id).delete()
     return {"status": "success", "message": f"Log {log_id} deleted"}
 
 
@@ -282,7 +445,7 @@ async def clear_logs(
     before_timestamp: Optional[str] = None,
 ):
     """
-    批量删除日志，支持按提供商或时间筛选。
+    批量删除日志，支持按提供商或时间筛选 (同时从分析汇总表中减去)。
     """
     query = RequestLog.all()
     if provider:
@@ -290,8 +453,10 @@ async def clear_logs(
     if before_timestamp:
         query = query.filter(timestamp__lt=before_timestamp)
 
-    count = await query.count()
-    await query.delete()
+    count = await delete_logs(query)
+    # 清理不再被引用的内容与消息块
+    await database.delete_orphaned_content()
+    await blob_store.sweep()
     return {"status": "success", "deleted_count": count}
 
 
@@ -299,14 +464,17 @@ async def clear_logs(
 async def get_stats():
     """
     获取全局统计信息，包括总请求数和已配置的提供商信息。
+    请求数与 Token 数读取按天汇总的分析汇总表。
     """
+    rollup = RollupDay.all().using_db(database.reader())
+
     # 总请求数
-    total_requests = await RequestLog.all().count()
+    totals = await rollup.annotate(total=Sum("requests")).values("total")
+    total_requests = int(totals[0]["total"] or 0) if totals else 0
 
     # 按提供商统计
     provider_stats = (
-        await RequestLog.all()
-        .annotate(count=Count("id"))
+        await rollup.annotate(count=Sum("requests"))
         .group_by("provider")
         .order_by("-count")
         .limit(5)
@@ -315,8 +483,7 @@ async def get_stats():
 
     # 按模型统计 (请求数)
     model_request_stats = (
-        await RequestLog.all()
-        .annotate(count=Count("id"))
+        await rollup.annotate(count=Sum("requests"))
         .group_by("provider", "model")  # Group by both provider and model
         .order_by("-count")
         .limit(5)
@@ -325,8 +492,7 @@ async def get_stats():
 
     # 按模型统计 (Token消耗)
     model_token_stats = (
-        await RequestLog.all()
-        .annotate(total_tokens=Sum("total_tokens"))
+        await rollup.annotate(total_tokens=Sum("total_tokens"))
         .group_by("provider", "model")  # Group by both provider and model
         .order_by("-total_tokens")
         .limit(5)
@@ -377,6 +543,67 @@ async def get_providers():
     return settings.providers
 
 
+@router.get("/api/providers/{name}/keys")
+async def get_provider_keys(name: str):
+    """
+    获取指定提供商各 API Key 的健康统计 (Key 已脱敏)。
+    """
+    from ..providers.factory import ProviderFactory
+
+    try:
+        provider = ProviderFactory.get_provider(name)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return provider.key_pool.snapshot()
+
+
+@router.post("/api/providers/{name}/keys/reset")
+async def reset_provider_keys(name: str):
+    """
+    清除指定提供商所有 API Key 的冷却状态。
+    """
+    from ..providers.factory import ProviderFactory
+
+    try:
+        provider = ProviderFactory.get_provider(name)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    provider.key_pool.reset()
+    return {"status": "success", "message": f"Key cooldowns reset for {name}"}
+
+
+@router.get("/api/metrics")
+async def get_metrics():
+    """
+    获取运行时指标。
+    包含：
+    1. 各提供商及 (提供商, 模型) 的熔断器状态
+    2. 各 (提供商, 模型) 的首响应延迟分位数
+    3. 各并发限制器的当前上限、并发数、排队数与等待时间
+    4. 响应缓存、语义缓存与嵌入向量缓存的命中情况
+    5. 嵌入请求微批处理的批次统计 (含批量大小直方图)
+    6. 日志写入队列的积压与丢弃情况
+    7. 请求内容的压缩率、压缩耗费的 CPU 时间与旧数据迁移进度
+    8. 按消息去重存储的提示词的引用数与去重情况
+    """
+    return {
+        "circuits": circuit_breakers.snapshot(),
+        "latency": telemetry.snapshot(),
+        "limiters": limiters.snapshot(),
+        "cache": response_cache.snapshot(),
+        "semantic_cache": semantic_cache.snapshot(),
+        "embedding_cache": embedding_cache.snapshot(),
+        "embedding_batches": embedding_batcher.snapshot(),
+        "log_writer": log_writer.snapshot(),
+        "content_compression": {
+            **compression_stats.snapshot(),
+            "migrating": content_migrator.running,
+        },
+        "content_blobs": blob_store.snapshot(),
+        "database": database.snapshot(),
+    }
+
+
 @router.get("/api/health")
 async def health_check():
     """
@@ -409,18 +636,9 @@ async def get_config():
             if "api_key" in provider and provider["api_key"]:
                 raw_key = provider["api_key"]
                 if isinstance(raw_key, list):
-                    masked_keys = []
-                    for key in raw_key:
-                        if len(key) > 8:
-                            masked_keys.append(f"{key[:4]}...{key[-4:]}")
-                        else:
-                            masked_keys.append("****")
-                    provider["api_key"] = masked_keys
+                    provider["api_key"] = [mask_key(key) for key in raw_key]
                 else:
-                    if len(raw_key) > 8:
-                        provider["api_key"] = f"{raw_key[:4]}...{raw_key[-4:]}"
-                    else:
-                        provider["api_key"] = "****"
+                    provider["api_key"] = mask_key(raw_key)
     return config_data
 
 
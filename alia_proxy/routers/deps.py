@@ -1,4 +1,7 @@
+import asyncio
+from typing import Any, AsyncGenerator
 from fastapi import HTTPException, Request
+from ..config import settings
 from ..providers.factory import ProviderFactory
 from ..services.proxy import ProxyService
 
@@ -35,6 +38,57 @@ async def get_proxy_service(request: Request) -> ProxyService:
             request_ip=request_ip,
             fallbacks=fallbacks,
             original_model=model_field,
+            mapping=ProviderFactory.get_mapping(model_field),
         )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+
+
+async def _wait_disconnect(request: Request):
+    """
+    定期检测客户端连接，直到客户端断开时返回。
+    """
+    while not await request.is_disconnected():
+        await asyncio.sleep(settings.disconnect_poll_interval)
+
+
+async def watch_disconnect(
+    request: Request, stream: AsyncGenerator[Any, None]
+) -> AsyncGenerator[Any, None]:
+    """
+    转发流式响应，同时检测客户端是否断开。
+    整个流使用一个检测任务: 客户端断开时，若正在等待上游则取消这次等待
+    (生成器内部记录 499 日志并关闭上游连接)，而不是等到上游产生下一个数据块、写入客户端失败时才发现。
+    等待上游的迭代在转发任务内执行，转发任务被外部取消时取消同样传递给生成器，不会遗留未完成的迭代。
+    """
+    consumer = asyncio.current_task()
+    waiting = False  # 是否正在等待上游的数据块
+    disconnected = False
+
+    async def watch():
+        nonlocal disconnected
+        await _wait_disconnect(request)
+        disconnected = True
+        if waiting:
+            consumer.cancel()
+
+    watcher = asyncio.create_task(watch())
+    try:
+        while not disconnected:
+            waiting = True
+            try:
+                chunk = await anext(stream)
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                # 仅吞掉检测任务发出的取消，外部的取消继续传递
+                if not disconnected or consumer.uncancel() > 0:
+                    raise
+                return
+            finally:
+                waiting = False
+            yield chunk
+    finally:
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+        await stream.aclose()
@@ -9,6 +9,8 @@ import json
 import csv
 import io
 from ..models import RequestLog
+from ..database import database
+from ..services.blobs import blob_store
 from enum import StrEnum
 
 router = APIRouter()
@@ -30,13 +32,20 @@ async def export_logs(format: ExportFormat = Query(ExportFormat.JSONL)):
     导出聊天日志。
     支持多种格式，通过流式响应下载。
     """
-    # 只导出聊天完成类型的日志
+    # 只导出聊天完成类型的日志 (每个逻辑请求一条，降级产生的调用记录随 JSONL 导出)
     chat_logs = (
         await RequestLog.filter(endpoint="chat")
-        .prefetch_related("content", "media")
+        .using_db(database.reader())
+        .prefetch_related("content", "media", "attempts")
         .all()
     )
 
+    # 一次性读取全部内容 (透明解压并还原按消息存储的 prompt)
+    stored = [log.content for log in chat_logs if log.content]
+    contents = dict(
+        zip([c.log_id for c in stored], await blob_store.load_contents(stored))
+    )
+
     # 如果没有找到任何 chat 日志，返回带有说明的空文件
     if not chat_logs:
         if format == "csv":
@@ -74,6 +83,7 @@ async def export_logs(format: ExportFormat = Query(ExportFormat.JSONL)):
                 "completion_tokens",
                 "status_code",
                 "latency",
+                "attempt_count",
                 "ip_address",
                 "media_path",
                 "prompt",
@@ -82,8 +92,9 @@ async def export_logs(format: ExportFormat = Query(ExportFormat.JSONL)):
         )
         for log in chat_logs:
             # 兼容处理新模型
-            prompt = log.content.prompt if log.content else ""
-            response = log.content.response if log.content else ""
+            content = contents.get(log.id, {})
+            prompt = content.get("prompt") or ""
+            response = content.get("response") or ""
             media_paths = ",".join([m.file_path for m in log.media])
 
             writer.writerow(
@@ -97,6 +108,7 @@ async def export_logs(format: ExportFormat = Query(ExportFormat.JSONL)):
                     log.completion_tokens,
                     log.status_code,
                     log.latency,
+                    log.attempt_count,
                     log.ip_address,
                     media_paths,
                     prompt,
@@ -114,8 +126,9 @@ async def export_logs(format: ExportFormat = Query(ExportFormat.JSONL)):
     elif format == "sharegpt":
         sharegpt_logs = []
         for log in chat_logs:
-            prompt_str = log.content.prompt if log.content else ""
-            response = log.content.response if log.content else ""
+            content = contents.get(log.id, {})
+            prompt_str = content.get("prompt") or ""
+            response = content.get("response") or ""
             if prompt_str and response:
                 try:
                     # 尝试解析原始 prompt 消息列表 (可能是 JSON 或 Python repr)
@@ -177,8 +190,9 @@ async def export_logs(format: ExportFormat = Query(ExportFormat.JSONL)):
     elif format == "jsonl":
         jsonl_logs = []
         for log in chat_logs:
-            prompt = log.content.prompt if log.content else ""
-            response = log.content.response if log.content else ""
+            content = contents.get(log.id, {})
+            prompt = content.get("prompt") or ""
+            response = content.get("response") or ""
             media_paths = [m.file_path for m in log.media]
             jsonl_logs.append(
                 {
@@ -195,6 +209,17 @@ async def export_logs(format: ExportFormat = Query(ExportFormat.JSONL)):
                     "media_paths": media_paths,
                     "prompt": prompt,
                     "response": response,
+                    "attempts": [
+                        {
+                            "attempt": a.attempt,
+                            "provider": a.provider,
+                            "model": a.model,
+                            "status_code": a.status_code,
+                            "latency": a.latency,
+                            "error": a.error,
+                        }
+                        for a in sorted(log.attempts, key=lambda a: a.attempt)
+                    ],
                 }
             )
 
@@ -1,8 +1,8 @@
 import traceback
 from fastapi import APIRouter, HTTPException, Request, Depends
-from fastapi.responses import StreamingResponse
-from ..providers.base import ChatRequest, EmbeddingsRequest
-from .deps import get_proxy_service
+from fastapi.responses import StreamingResponse, Response
+from ..providers.base import ChatRequest, EmbeddingsRequest, RawChatResponse
+from .deps import get_proxy_service, watch_disconnect
 from ..services.proxy import ProxyService
 from ..config import settings
 from ..providers.factory import ProviderFactory
@@ -146,10 +146,15 @@ async def chat_completions(
 
     if chat_request.stream:
         return StreamingResponse(
-            proxy.chat_stream(chat_request), media_type="text/event-stream"
+            watch_disconnect(request, proxy.chat_stream(chat_request)),
+            media_type="text/event-stream",
         )
     else:
-        return await proxy.chat(chat_request)
+        result = await proxy.chat(chat_request)
+        if isinstance(result, RawChatResponse):
+            # 协议一致，直接输出上游响应字节
+            return Response(content=result.body, media_type=result.media_type)
+        return result
 
 
 @router.post("/v1/embeddings")
@@ -0,0 +1,66 @@
+"""
+数据库结构升级。
+Tortoise.generate_schemas 只会创建缺失的表，不会为已有的表添加新列，
+而且会为新列创建索引 (在旧表上直接失败)。因此在 generate_schemas 之前，
+先为旧版本创建的表补齐后续新增的列，索引仍由 generate_schemas 创建。
+"""
+
+from typing import List, NamedTuple
+from tortoise import Tortoise
+from tortoise.exceptions import OperationalError
+
+
+class AddedColumn(NamedTuple):
+    """
+    在已有表上新增的列。
+    """
+
+    table: str
+    column: str
+    definition: str  # 列类型与约束 (ALTER TABLE ... ADD COLUMN 的列定义)
+
+
+# 各数据库方言中与 SQLite 类型名不同的列类型
+DIALECT_TYPES = {"postgres": {"BLOB": "BYTEA"}}
+
+# 按版本顺序追加，已存在的列会被跳过 (列定义使用 SQLite 类型名)
+ADDED_COLUMNS: List[AddedColumn] = [
+    AddedColumn("requestlog", "ttft", "REAL"),
+    AddedColumn("requestcontent", "codec", "VARCHAR(16)"),
+    AddedColumn("requestcontent", "prompt_blob", "BLOB"),
+    AddedColumn("requestcontent", "response_blob", "BLOB"),
+    AddedColumn("requestcontent", "prompt_refs", "JSON"),
+    AddedColumn("requestlog", "attempt_count", "INT NOT NULL DEFAULT 1"),
+]
+
+
+async def _table_exists(conn, table: str) -> bool:
+    try:
+        await conn.execute_query(f"SELECT 1 FROM {table} LIMIT 0")
+    except OperationalError:
+        return False
+    return True
+
+
+async def upgrade_schema(connection_name: str = "default"):
+    """
+    为已有的表补齐缺失的列 (在 generate_schemas 之前调用)。表尚不存在时跳过，由 generate_schemas 创建。
+    """
+    conn = Tortoise.get_connection(connection_name)
+    for added in ADDED_COLUMNS:
+        if not await _table_exists(conn, added.table):
+            continue
+        try:
+            await conn.execute_query(
+                f"SELECT {added.column} FROM {added.table} LIMIT 0"
+            )
+            continue
+        except OperationalError:
+            pass
+        definition = DIALECT_TYPES.get(conn.capabilities.dialect, {}).get(
+            added.definition, added.definition
+        )
+        await conn.execute_script(
+            f"ALTER TABLE {added.table} ADD COLUMN {added.column} {definition}"
+        )
+        print(f"数据库结构升级: 已为 {added.table} 添加列 {added.column}")
@@ -0,0 +1,179 @@
+"""
+嵌入请求微批处理。
+将同一 (提供商, 模型) 下并发到达的小批量嵌入请求在几毫秒内 (或达到最大批量时) 合并为一次上游调用，
+再把向量与 Token 用量拆分回各个调用方。
+"""
+
+import asyncio
+import time
+from collections import Counter
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Set, Tuple
+from ..config import settings
+from ..providers.base import EmbeddingsResponse, Usage
+
+# 批量大小直方图的桶上界 (最后一个桶为无上限)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+Fetch = Callable[[List[str]], Awaitable[EmbeddingsResponse]]
+
+
+def split_tokens(total: int, weights: List[int]) -> List[int]:
+    """
+    按权重拆分 Token 数 (最大余数法)，保证各部分之和等于总数。
+    """
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        weights = [1] * len(weights)
+        weight_sum = len(weights)
+    exact = [total * w / weight_sum for w in weights]
+    shares = [int(x) for x in exact]
+    remainder = total - sum(shares)
+    order = sorted(
+        range(len(weights)), key=lambda i: exact[i] - shares[i], reverse=True
+    )
+    for i in order[:remainder]:
+        shares[i] += 1
+    return shares
+
+
+class _Batch:
+    """
+    正在收集中的批次。
+    """
+
+    def __init__(self, fetch: Fetch):
+        self.fetch = fetch  # 第一个调用方提供的上游调用函数
+        self.inputs: List[str] = []
+        # (等待结果的 Future, 输入在批次中的起始位置, 输入数量)
+        self.waiters: List[Tuple[asyncio.Future, int, int]] = []
+        self.created_at = time.perf_counter()
+        self.timer: Any = None
+
+
+class EmbeddingBatcher:
+    """
+    嵌入请求微批处理器。所有操作都在事件循环内完成，无需加锁。
+    """
+
+    def __init__(self):
+        self._pending: Dict[Hashable, _Batch] = {}
+        self._tasks: Set[asyncio.Task] = set()  # 发送中的批次 (保持引用防止被回收)
+        self.batches = 0  # 已发送的批次数
+        self.inputs = 0  # 已发送的输入总数
+        self.sizes: Counter = Counter()  # 批量大小直方图 (按桶上界计数)
+        self.flush_wait = 0.0  # 批次从创建到发送的累计等待时间 (秒)
+
+    async def submit(
+        self, key: Hashable, inputs: List[str], fetch: Fetch
+    ) -> Tuple[EmbeddingsResponse, int]:
+        """
+        提交输入并等待所在批次的结果。
+        :param key: 批次键，只有键相同的请求才会被合并 (提供商、模型、维度、编码格式)
+        :param fetch: 向上游请求一批输入的协程函数 (批次由第一个调用方的 fetch 发送)
+        :return: (仅包含本调用方输入的响应, 批次大小)
+        """
+        config = settings.embeddings_batch
+        batch = self._pending.get(key)
+        if (
+            batch is not None
+            and len(batch.inputs) + len(inputs) > config.max_batch_size
+        ):
+            self._flush(key, batch)
+            batch = None
+        if batch is None:
+            batch = _Batch(fetch)
+            self._pending[key] = batch
+            batch.timer = asyncio.get_running_loop().call_later(
+                config.max_delay, self._flush, key, batch
+            )
+
+        future = asyncio.get_running_loop().create_future()
+        batch.waiters.append((future, len(batch.inputs), len(inputs)))
+        batch.inputs.extend(inputs)
+        if len(batch.inputs) >= config.max_batch_size:
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key: Hashable, batch: _Batch):
+        """
+        停止收集并发送批次。
+        """
+        if self._pending.get(key) is not batch:
+            return
+        del self._pending[key]
+        batch.timer.cancel()
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _observe(self, batch: _Batch):
+        size = len(batch.inputs)
+        self.batches += 1
+        self.inputs += size
+        self.flush_wait += time.perf_counter() - batch.created_at
+        bucket = next((b for b in BATCH_SIZE_BUCKETS if size <= b), "+Inf")
+        self.sizes[bucket] += 1
+
+    async def _send(self, batch: _Batch):
+        self._observe(batch)
+        try:
+            response = await batch.fetch(batch.inputs)
+            data = sorted(response.data, key=lambda item: item.get("index", 0))
+            if len(data) != len(batch.inputs):
+                raise ValueError("Upstream returned an incomplete embeddings batch")
+        except Exception as e:
+            for future, _, _ in batch.waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # 按各调用方的输入字符数拆分 Token 用量
+        weights = [
+            sum(len(text) for text in batch.inputs[offset : offset + count])
+            for _, offset, count in batch.waiters
+        ]
+        prompt_shares = split_tokens(response.usage.prompt_tokens, weights)
+        total_shares = split_tokens(response.usage.total_tokens, weights)
+        size = len(batch.inputs)
+        for (future, offset, count), prompt_tokens, total_tokens in zip(
+            batch.waiters, prompt_shares, total_shares
+        ):
+            if future.done():
+                continue
+            items = [
+                {**item, "index": j}
+                for j, item in enumerate(data[offset : offset + count])
+            ]
+            future.set_result(
+                (
+                    EmbeddingsResponse(
+                        id=response.id,
+                        data=items,
+                        model=response.model,
+                        usage=Usage(
+                            prompt_tokens=prompt_tokens, total_tokens=total_tokens
+                        ),
+                    ),
+                    size,
+                )
+            )
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "batches": self.batches,
+            "inputs": self.inputs,
+            "avg_batch_size": (
+                round(self.inputs / self.batches, 2) if self.batches else None
+            ),
+            "avg_flush_wait": (
+                round(self.flush_wait / self.batches, 4) if self.batches else None
+            ),
+            "batch_size_histogram": {
+                str(bucket): self.sizes.get(bucket, 0)
+                for bucket in (*BATCH_SIZE_BUCKETS, "+Inf")
+            },
+        }
+
+
+# 全局嵌入请求微批处理器
+embedding_batcher = EmbeddingBatcher()
@@ -0,0 +1,268 @@
+"""
+内容寻址的提示词存储。
+多轮对话的每一轮都会重复记录完整的历史消息，降级重试也会重复记录相同的 prompt。
+写入时将 prompt (消息列表的 JSON) 按消息拆分，每条消息以 SHA-256 为键只存储一次 (ContentBlob)，
+RequestContent 只保存有序的哈希列表 (prompt_refs)；读取时按哈希取回并拼接还原。
+"""
+
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from tortoise import Tortoise
+from ..config import settings
+from ..models import ContentBlob, RequestContent
+from ..database import database
+from .compression import DEFAULT_CODEC, PLAIN, compress, decode_content, decompress
+
+# json.dumps 默认的列表元素分隔符
+SEPARATOR = ", "
+# 最多记住的已存储哈希数量 (命中时无需查询数据库)
+MAX_KNOWN = 100_000
+# 读取时每次查询的最大哈希数量 (SQLite 的参数个数有上限)
+FETCH_CHUNK = 500
+
+
+def join_segments(segments: List[str]) -> str:
+    return "[" + SEPARATOR.join(segments) + "]"
+
+
+def split_prompt(prompt: Optional[str]) -> Optional[List[str]]:
+    """
+    将 prompt 拆分为各条消息的 JSON 文本。
+    只有拼接结果与原文完全一致时才拆分 (保证逐字节还原)，否则返回 None。
+    """
+    if not prompt or not prompt.startswith("["):
+        return None
+    try:
+        messages = json.loads(prompt)
+    except ValueError:
+        return None
+    if not isinstance(messages, list) or not messages:
+        return None
+    segments = [json.dumps(m, ensure_ascii=False) for m in messages]
+    if join_segments(segments) != prompt:
+        return None
+    return segments
+
+
+def segment_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def split_contents(
+    contents: List[Dict[str, Any]],
+) -> Tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """
+    将一批 RequestContent 字段中的 prompt 替换为哈希列表。
+    :return: (替换后的字段, 本批出现的 {哈希: 消息文本})
+    """
+    segments: Dict[str, str] = {}
+    result = []
+    for fields in contents:
+        parts = split_prompt(fields.get("prompt"))
+        if parts is None:
+            result.append(fields)
+            continue
+        refs = []
+        for text in parts:
+            digest = segment_hash(text)
+            segments[digest] = text
+            refs.append(digest)
+        result.append({**fields, "prompt": None, "prompt_refs": refs})
+    return result, segments
+
+
+class BlobStore:
+    """
+    消息块的写入与读取。
+    记住近期已写入的哈希 (LRU)，重复出现的消息既不需要查询数据库也不需要再次写入。
+    new_blobs 在写入事务之外判断消息块是否已存在；其间执行的 sweep 可能删除这些块，
+    写入方在事务内比较 sweeps 计数，发生变化时通过 restore 补齐被删除的块。
+    """
+
+    def __init__(self):
+        self._known: "OrderedDict[str, None]" = OrderedDict()
+        self.sweeps = 0  # 已执行的清理次数
+        self.refs = 0  # 写入的消息引用数
+        self.stored = 0  # 新存储的消息块数
+        self.raw_bytes = 0  # 所有引用的消息原文字节数
+        self.stored_bytes = 0  # 新存储的消息块字节数 (压缩后)
+
+    @property
+    def enabled(self) -> bool:
+        return settings.compression.dedupe
+
+    def _remember(self, digests: Iterable[str]):
+        for digest in digests:
+            self._known[digest] = None
+            self._known.move_to_end(digest)
+        while len(self._known) > MAX_KNOWN:
+            self._known.popitem(last=False)
+
+    async def new_blobs(
+        self, contents: List[Dict[str, Any]], segments: Dict[str, str]
+    ) -> List[ContentBlob]:
+        """
+        找出本批中数据库里尚不存在的消息块，并在线程池中压缩。
+        :param contents: split_contents 替换后的字段 (用于统计引用)
+        """
+        for fields in contents:
+            for digest in fields.get("prompt_refs") or ():
+                self.refs += 1
+                self.raw_bytes += len(segments[digest].encode("utf-8"))
+
+        unknown = [d for d in segments if d not in self._known]
+        existing = set()
+        for i in range(0, len(unknown), FETCH_CHUNK):
+            existing.update(
+                await ContentBlob.filter(
+                    hash__in=unknown[i : i + FETCH_CHUNK]
+                ).values_list("hash", flat=True)
+            )
+        self._remember(existing)
+        missing = [d for d in unknown if d not in existing]
+        if not missing:
+            return []
+        return await self._encode(missing, segments)
+
+    async def restore(
+        self, segments: Dict[str, str], blobs: List[ContentBlob], conn
+    ) -> List[ContentBlob]:
+        """
+        在写入事务内重新确认本批引用的消息块都存在 (new_blobs 之后执行过 sweep 时调用)。
+        写入与清理都通过写连接串行执行，事务内的检查结果在提交前不会再变化。
+        :param blobs: new_blobs 返回的待写入消息块
+        :return: 需要额外写入的 (已被清理的) 消息块
+        """
+        pending = {blob.hash for blob in blobs}
+        assumed = [d for d in segments if d not in pending]
+        existing = set()
+        for i in range(0, len(assumed), FETCH_CHUNK):
+            existing.update(
+                await ContentBlob.filter(hash__in=assumed[i : i + FETCH_CHUNK])
+                .using_db(conn)
+                .values_list("hash", flat=True)
+            )
+        missing = [d for d in assumed if d not in existing]
+        if not missing:
+            return []
+        return await self._encode(missing, segments)
+
+    async def _encode(
+        self, digests: List[str], segments: Dict[str, str]
+    ) -> List[ContentBlob]:
+        """
+        在线程池中压缩消息块。
+        """
+
+        def encode() -> List[ContentBlob]:
+            blobs = []
+            for digest in digests:
+                raw = segments[digest].encode("utf-8")
+                data = compress(raw)
+                blobs.append(
+                    ContentBlob(
+                        hash=digest,
+                        codec=PLAIN if data is None else DEFAULT_CODEC,
+                        data=raw if data is None else data,
+                        size=len(raw),
+                    )
+                )
+            return blobs
+
+        blobs = await asyncio.to_thread(encode)
+        self.stored += len(blobs)
+        self.stored_bytes += sum(len(blob.data) for blob in blobs)
+        return blobs
+
+    def committed(self, blobs: List[ContentBlob]):
+        """
+        消息块写入成功后记住其哈希。
+        """
+        self._remember(blob.hash for blob in blobs)
+
+    async def fetch(self, digests: Iterable[str]) -> Dict[str, str]:
+        """
+        按哈希批量读取消息原文 (通过只读连接)。
+        """
+        db = database.reader()
+        wanted = list(dict.fromkeys(digests))
+        texts = {}
+        for i in range(0, len(wanted), FETCH_CHUNK):
+            for blob in await ContentBlob.filter(
+                hash__in=wanted[i : i + FETCH_CHUNK]
+            ).using_db(db):
+                texts[blob.hash] = (
+                    blob.data.decode("utf-8")
+                    if blob.codec == PLAIN
+                    else decompress(blob.codec, blob.data)
+                )
+        return texts
+
+    async def load_contents(
+        self, contents: List[RequestContent]
+    ) -> List[Dict[str, Optional[str]]]:
+        """
+        读取多行 RequestContent 的明文内容 (透明解压并还原按消息存储的 prompt)。
+        引用的消息块缺失时不拼接残缺的 prompt，记录警告并返回 None。
+        """
+        texts = await self.fetch(
+            digest for content in contents for digest in content.prompt_refs or ()
+        )
+        result = []
+        for content in contents:
+            fields = decode_content(content)
+            if content.prompt_refs:
+                missing = [d for d in content.prompt_refs if d not in texts]
+                if missing:
+                    print(
+                        f"日志 {content.log_id} 的 prompt 引用了 {len(missing)} 个"
+                        f"不存在的消息块: {missing[0]}"
+                    )
+                    fields["prompt"] = None
+                else:
+                    fields["prompt"] = join_segments(
+                        [texts[digest] for digest in content.prompt_refs]
+                    )
+            result.append(fields)
+        return result
+
+    async def sweep(self) -> int:
+        """
+        删除不再被任何日志引用的消息块 (批量删除日志后调用，仅支持 SQLite)。
+        :return: 删除的消息块数量
+        """
+        conn = Tortoise.get_connection("default")
+        if conn.capabilities.dialect != "sqlite":
+            return 0
+        self.clear()
+        self.sweeps += 1
+        count, _ = await conn.execute_query(
+            "DELETE FROM contentblob WHERE hash NOT IN "
+            "(SELECT DISTINCT refs.value FROM requestcontent, "
+            "json_each(requestcontent.prompt_refs) AS refs "
+            "WHERE requestcontent.prompt_refs IS NOT NULL)"
+        )
+        return count
+
+    def clear(self):
+        """
+        清空已存储哈希的记录 (切换或清空数据库后调用)。
+        """
+        self._known.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "refs": self.refs,
+            "stored": self.stored,
+            "deduplicated": self.refs - self.stored,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "known": len(self._known),
+        }
+
+
+# 全局消息块存储
+blob_store = BlobStore()
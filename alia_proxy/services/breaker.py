@@ -0,0 +1,209 @@
+"""
+熔断器。
+为每个提供商实例以及每个 (提供商, 模型) 组合维护独立的熔断状态，
+在上游持续故障时跳过对应的候选项，避免每个请求都等待超时后才降级。
+"""
+
+import time
+from collections import OrderedDict
+from enum import StrEnum
+from typing import Any, Dict, Optional
+from ..config import settings, CircuitBreakerConfig
+
+# 最多跟踪的熔断器数量 (模型名来自客户端请求，需要限制内存占用)
+MAX_BREAKERS = 1024
+
+
+class CircuitState(StrEnum):
+    """
+    熔断器状态枚举。
+    """
+
+    CLOSED = "closed"  # 正常放行
+    OPEN = "open"  # 熔断中，拒绝请求
+    HALF_OPEN = "half_open"  # 恢复探测中，仅放行少量请求
+
+
+class CircuitOpenError(Exception):
+    """
+    所有候选项均处于熔断状态。
+    """
+
+    status_code = 503
+
+
+class CircuitBreaker:
+    """
+    单个熔断器。
+    连续失败次数达到阈值后打开；经过恢复时间后进入半开状态并放行探测请求，
+    探测成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._state = CircuitState.CLOSED
+        self.consecutive_failures = 0  # 连续失败次数
+        self.total_failures = 0  # 累计失败次数
+        self.total_successes = 0  # 累计成功次数
+        self.opened_at = 0.0  # 最近一次打开的时间 (time.monotonic)
+        self.probes = 0  # 半开状态下正在进行的探测请求数
+        self.probe_started_at = 0.0  # 最近一次探测开始的时间
+
+    @property
+    def config(self) -> CircuitBreakerConfig:
+        return settings.circuit_breaker
+
+    @property
+    def state(self) -> CircuitState:
+        """
+        当前状态。打开状态超过恢复时间后自动转为半开。
+        """
+        if (
+            self._state == CircuitState.OPEN
+            and time.monotonic() - self.opened_at >= self.config.recovery_timeout
+        ):
+            self._state = CircuitState.HALF_OPEN
+            self.probes = 0
+        return self._state
+
+    def allows(self) -> bool:
+        """
+        是否允许向该目标发起请求 (不占用探测名额)。
+        """
+        state = self.state
+        if state == CircuitState.CLOSED:
+            return True
+        if state == CircuitState.OPEN:
+            return False
+        # 探测请求长时间没有结果 (如被取消) 时，允许发起新的探测
+        if time.monotonic() - self.probe_started_at >= self.config.recovery_timeout:
+            self.probes = 0
+        return self.probes < self.config.half_open_max_calls
+
+    def on_attempt(self):
+        """
+        发起请求前调用。半开状态下占用一个探测名额。
+        """
+        if self.state == CircuitState.HALF_OPEN:
+            self.probes += 1
+            self.probe_started_at = time.monotonic()
+
+    def record_success(self):
+        self.total_successes += 1
+        self.consecutive_failures = 0
+        if self._state != CircuitState.CLOSED:
+            self._state = CircuitState.CLOSED
+            self.probes = 0
+
+    def record_failure(self):
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        state = self.state
+        if state == CircuitState.HALF_OPEN or (
+            state == CircuitState.CLOSED
+            and self.consecutive_failures >= self.config.failure_threshold
+        ):
+            self._state = CircuitState.OPEN
+            self.opened_at = time.monotonic()
+            self.probes = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        state = self.state
+        retry_in = 0.0
+        if state == CircuitState.OPEN:
+            retry_in = self.config.recovery_timeout - (
+                time.monotonic() - self.opened_at
+            )
+        return {
+            "state": str(state),
+            "consecutive_failures": self.consecutive_failures,
+            "failures": self.total_failures,
+            "successes": self.total_successes,
+            "retry_in": round(max(retry_in, 0.0), 1),
+        }
+
+
+class CircuitBreakerRegistry:
+    """
+    熔断器注册表。
+    - 提供商级熔断器只统计连接层故障 (连接失败、超时)，表示整个上游不可达。
+    - (提供商, 模型) 级熔断器统计所有上游故障 (连接层故障、5xx、429)。
+    """
+
+    def __init__(self):
+        self._breakers: "OrderedDict[str, CircuitBreaker]" = OrderedDict()
+
+    @staticmethod
+    def _pair_key(instance_name: str, model: str) -> str:
+        return f"{instance_name}/{model}"
+
+    def _get(self, key: str, create: bool = True) -> Optional[CircuitBreaker]:
+        breaker = self._breakers.get(key)
+        if breaker is not None:
+            self._breakers.move_to_end(key)
+            return breaker
+        if not create:
+            return None
+        breaker = CircuitBreaker(key)
+        self._breakers[key] = breaker
+        if len(self._breakers) > MAX_BREAKERS:
+            # 优先淘汰最久未使用且处于关闭状态的熔断器
+            for old_key, old in self._breakers.items():
+                if old.state == CircuitState.CLOSED:
+                    del self._breakers[old_key]
+                    break
+            else:
+                self._breakers.popitem(last=False)
+        return breaker
+
+    def allows(self, instance_name: str, model: str) -> bool:
+        """
+        目标是否可用 (提供商与模型两级熔断器均放行)。
+        """
+        if not settings.circuit_breaker.enabled:
+            return True
+        for key in (instance_name, self._pair_key(instance_name, model)):
+            breaker = self._get(key, create=False)
+            if breaker is not None and not breaker.allows():
+                return False
+        return True
+
+    def on_attempt(self, instance_name: str, model: str):
+        if not settings.circuit_breaker.enabled:
+            return
+        for key in (instance_name, self._pair_key(instance_name, model)):
+            breaker = self._get(key, create=False)
+            if breaker is not None:
+                breaker.on_attempt()
+
+    def record_success(self, instance_name: str, model: str):
+        if not settings.circuit_breaker.enabled:
+            return
+        self._get(instance_name).record_success()
+        self._get(self._pair_key(instance_name, model)).record_success()
+
+    def record_failure(
+        self, instance_name: str, model: str, status_code: int, transport_error: bool
+    ):
+        """
+        记录一次失败。
+        :param status_code: 失败对应的状态码
+        :param transport_error: 是否为连接层故障 (连接失败、超时等)
+        """
+        if not settings.circuit_breaker.enabled:
+            return
+        if transport_error:
+            self._get(instance_name).record_failure()
+            self._get(self._pair_key(instance_name, model)).record_failure()
+        elif status_code >= 500 or status_code == 429:
+            self._get(self._pair_key(instance_name, model)).record_failure()
+
+    def reset(self):
+        self._breakers.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {key: breaker.snapshot() for key, breaker in self._breakers.items()}
+
+
+# 全局熔断器注册表
+circuit_breakers = CircuitBreakerRegistry()
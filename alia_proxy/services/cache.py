@@ -0,0 +1,280 @@
+"""
+响应缓存。
+- ResponseCache: 对确定性聊天请求 (temperature 为 0 或指定了 seed，或映射显式开启)
+  按目标模型与规范化请求体缓存完整响应。内存层为带 TTL 与字节上限的 LRU；
+  可选的磁盘层保存在 data/ 下，重启后仍然有效。
+- EmbeddingCache: 按单条输入缓存嵌入向量 (float32 紧凑存储)，批量请求只需向上游请求未命中的部分。
+缓存是尽力而为的：磁盘读写失败时视为未命中，不影响请求本身。
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
+import uuid
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Union
+import aiofiles
+import aiofiles.os
+from ..config import settings, CacheConfig
+
+# 每写入多少次磁盘缓存后清理一次过期与超额文件
+PRUNE_INTERVAL = 256
+
+
+class CachedResponse(NamedTuple):
+    """
+    缓存的完整响应。
+    """
+
+    body: bytes  # 响应体
+    media_type: str  # 响应的 Content-Type
+    expires_at: float  # 过期时间 (time.time，磁盘缓存需要跨进程有效)
+
+
+def cache_key(instance_name: str, model: str, body: Dict[str, Any]) -> str:
+    """
+    根据目标 (提供商实例, 模型) 与规范化的请求体计算缓存键。
+    """
+    canonical = json.dumps(
+        [instance_name, model, body],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    两级响应缓存 (内存 LRU + 可选磁盘)。
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self._writes = 0
+        self._tasks: Set[asyncio.Task] = set()  # 后台清理任务 (保持引用防止被回收)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @property
+    def config(self) -> CacheConfig:
+        return settings.cache
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.config.disk_dir, key[:2], key)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.body)
+
+    def _store(self, key: str, entry: CachedResponse):
+        """
+        写入内存层，并按条目数与字节数淘汰最久未使用的条目。
+        """
+        self._drop(key)
+        if len(entry.body) > self.config.max_bytes:
+            return
+        self._entries[key] = entry
+        self._bytes += len(entry.body)
+        while self._entries and (
+            self._bytes > self.config.max_bytes
+            or len(self._entries) > self.config.max_entries
+        ):
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= len(old.body)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        """
+        查找缓存。内存未命中时查找磁盘层，命中后回填内存层。
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self._drop(key)
+
+        if self.config.disk:
+            entry = await self._read_disk(key)
+            if entry is not None:
+                self._store(key, entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return entry
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, body: bytes, media_type: str = "application/json"):
+        entry = CachedResponse(body, media_type, time.time() + self.config.ttl)
+        self._store(key, entry)
+        if self.config.disk:
+            await self._write_disk(key, entry)
+
+    async def _read_disk(self, key: str) -> Optional[CachedResponse]:
+        path = self._path(key)
+        try:
+            async with aiofiles.open(path, mode="rb") as f:
+                data = await f.read()
+            header, _, body = data.partition(b"\n")
+            meta = json.loads(header)
+            if meta["expires_at"] <= time.time():
+                await aiofiles.os.remove(path)
+                return None
+            return CachedResponse(body, meta["media_type"], meta["expires_at"])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    async def _write_disk(self, key: str, entry: CachedResponse):
+        path = self._path(key)
+        # 先写临时文件再替换，避免并发读取到不完整的内容
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        header = json.dumps(
+            {"expires_at": entry.expires_at, "media_type": entry.media_type}
+        )
+        try:
+            await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+            async with aiofiles.open(tmp_path, mode="wb") as f:
+                await f.write(header.encode() + b"\n" + entry.body)
+            await aiofiles.os.replace(tmp_path, path)
+        except OSError:
+            return
+
+        self._writes += 1
+        if self._writes >= PRUNE_INTERVAL:
+            self._writes = 0
+            task = asyncio.create_task(asyncio.to_thread(self._prune_disk))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _prune_disk(self):
+        """
+        清理磁盘层: 删除过期文件，总大小超过上限时从最旧的文件开始删除。
+        文件修改时间即写入时间，修改时间早于 TTL 的文件均已过期。
+        """
+        expire_before = time.time() - self.config.ttl
+        files = []
+        for root, _, names in os.walk(self.config.disk_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime < expire_before:
+                        os.remove(path)
+                    else:
+                        files.append((stat.st_mtime, stat.st_size, path))
+                except OSError:
+                    continue
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.config.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }
+
+
+def pack_vector(embedding: Union[str, List[float]]) -> bytes:
+    """
+    将上游返回的嵌入向量 (浮点数列表或 base64 编码的 float32) 转换为 float32 字节。
+    """
+    if isinstance(embedding, str):
+        return base64.b64decode(embedding)
+    return array("f", embedding).tobytes()
+
+
+def unpack_vector(data: bytes, encoding_format: Optional[str] = None) -> Any:
+    """
+    将 float32 字节还原为请求的输出格式 (float 列表或 base64 字符串)。
+    """
+    if encoding_format == "base64":
+        return base64.b64encode(data).decode()
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """
+    单条输入的嵌入向量缓存。
+    键为 (提供商实例, 模型, 维度, 输入文本) 的摘要，值为 float32 字节；按总字节数进行 LRU 淘汰。
+    """
+
+    def __init__(self):
+        self._entries: "OrderedDict[bytes, bytes]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(
+        instance_name: str, model: str, dimensions: Optional[int], text: str
+    ) -> bytes:
+        return hashlib.sha256(
+            f"{instance_name}\0{model}\0{dimensions}\0{text}".encode()
+        ).digest()
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        vector = self._entries.get(key)
+        if vector is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return vector
+
+    def put(self, key: bytes, vector: bytes):
+        max_bytes = settings.embeddings_cache.max_bytes
+        if len(vector) > max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._entries[key] = vector
+        self._bytes += len(vector)
+        while self._bytes > max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# 全局响应缓存
+response_cache = ResponseCache()
+# 全局嵌入向量缓存
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,77 @@
+"""
+请求合并 (single-flight)。
+多个完全相同的非流式请求同时到达时，只有第一个 (leader) 真正调用上游，
+其余请求 (follower) 等待并共享 leader 的结果。
+"""
+
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+def coalesce_key(endpoint: str, instance_name: str, body: Dict[str, Any]) -> str:
+    """
+    根据端点、提供商实例与请求体 (已包含解析后的模型名) 计算规范化哈希。
+    """
+    canonical = json.dumps(
+        [endpoint, instance_name, body],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class SingleFlight:
+    """
+    按 key 合并进行中的调用。所有操作都在事件循环内完成，无需加锁。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    @property
+    def inflight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        执行 fn，或等待相同 key 的进行中调用。
+        leader 失败时异常同样传递给所有 follower；leader 被取消时 follower 自行重新发起调用。
+        :return: (结果, 是否为共享的结果)
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            try:
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    # 当前请求自身被取消
+                    raise
+            # leader 被取消 (如客户端断开)，由当前请求重新发起
+            return await self.do(key, fn)
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有 follower 时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+
+
+# 全局请求合并器
+single_flight = SingleFlight()
@@ -0,0 +1,253 @@
+"""
+请求内容压缩。
+RequestContent 的 prompt / response 通常是完整的 JSON 对话，写入时使用 zlib 与内置的预设字典压缩，
+保存在对应的 *_blob 列中 (原文本列置空)；读取时由 decode_content 透明解压。
+预设字典由聊天请求中反复出现的 JSON 片段组成，使较短的内容也能获得可观的压缩率。
+字典一经发布不可修改 (已压缩的数据依赖它解压)，调整时新增一个编码名称。
+旧版本写入的未压缩内容由 ContentMigrator 在后台分批压缩。
+"""
+
+import asyncio
+import time
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+from ..config import settings, CompressionConfig
+from ..models import RequestContent
+
+# 预设字典 v1: zlib 会优先匹配字典末尾的内容，最常见的片段放在最后
+_DICTIONARY_V1 = (
+    '"finish_reason": "stop"',
+    '"finish_reason": "tool_calls"',
+    '"finish_reason": "length"',
+    '"stop_reason": "end_turn"',
+    '"stop_reason": "tool_use"',
+    '"type": "tool_use"',
+    '"type": "tool_result"',
+    '"tool_use_id": "',
+    '"input": {',
+    '"cache_control": {"type": "ephemeral"}',
+    '"type": "function", "function": {"name": "',
+    '"parameters": {"type": "object", "properties": {',
+    '"required": [',
+    '"description": "',
+    '"type": "string"',
+    '"type": "integer"',
+    '"type": "boolean"',
+    '"type": "array", "items": {',
+    '"enum": [',
+    '"tools": [',
+    '"tool_choice": "auto"',
+    '"tool_calls": [{"id": "call_',
+    '"arguments": "{\\"',
+    '"name": "',
+    '"id": "',
+    '"type": "image_url", "image_url": {"url": "',
+    '"type": "text", "text": "',
+    '"role": "tool", "tool_call_id": "',
+    '{"role": "system", "content": "',
+    '{"role": "assistant", "content": null, "tool_calls": [',
+    '{"role": "assistant", "content": "',
+    '{"role": "user", "content": [{"type": "text", "text": "',
+    '{"role": "user", "content": "',
+    '"}, {"role": "assistant", "content": "',
+    '"}, {"role": "user", "content": "',
+    "\\n\\n",
+    "\\n",
+    "```",
+    "You are a helpful assistant.",
+)
+DICTIONARIES: Dict[str, bytes] = {
+    "zlib-d1": "".join(_DICTIONARY_V1).encode(),
+}
+# 新写入的内容使用的编码
+DEFAULT_CODEC = "zlib-d1"
+# 已检查但无需压缩 (过短或压缩后没有变小) 的内容
+PLAIN = "plain"
+
+
+def _compressor(codec: str, level: int):
+    return zlib.compressobj(
+        level,
+        zlib.DEFLATED,
+        zlib.MAX_WBITS,
+        9,
+        zlib.Z_DEFAULT_STRATEGY,
+        DICTIONARIES[codec],
+    )
+
+
+def decompress(codec: str, data: Optional[bytes]) -> Optional[str]:
+    if data is None:
+        return None
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS, DICTIONARIES[codec])
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+
+
+class CompressionStats:
+    """
+    压缩统计: 压缩率与 CPU 开销 (按线程 CPU 时间计)。
+    """
+
+    def __init__(self):
+        self.compressed = 0  # 已压缩的字段数
+        self.raw_bytes = 0  # 压缩前的字节数
+        self.stored_bytes = 0  # 压缩后的字节数
+        self.cpu_time = 0.0  # 压缩耗费的 CPU 时间 (秒)
+        self.migrated = 0  # 后台迁移压缩的行数
+        self.migrate_errors = 0  # 后台迁移失败的批次数
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "compressed": self.compressed,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+            "ratio": (
+                round(self.raw_bytes / self.stored_bytes, 2)
+                if self.stored_bytes
+                else None
+            ),
+            "cpu_time": round(self.cpu_time, 4),
+            "cpu_us_per_kb": (
+                round(self.cpu_time * 1e6 / (self.raw_bytes / 1024), 2)
+                if self.raw_bytes
+                else None
+            ),
+            "migrated": self.migrated,
+            "migrate_errors": self.migrate_errors,
+        }
+
+
+compression_stats = CompressionStats()
+
+
+def compress(raw: bytes) -> Optional[bytes]:
+    """
+    使用 DEFAULT_CODEC 压缩内容。短于 min_size 或压缩后没有变小时返回 None (保持原样)。
+    """
+    config = settings.compression
+    if not config.enabled or len(raw) < config.min_size:
+        return None
+    start = time.thread_time()
+    compressor = _compressor(DEFAULT_CODEC, config.level)
+    data = compressor.compress(raw) + compressor.flush()
+    compression_stats.cpu_time += time.thread_time() - start
+    if len(data) >= len(raw):
+        return None
+    compression_stats.compressed += 1
+    compression_stats.raw_bytes += len(raw)
+    compression_stats.stored_bytes += len(data)
+    return data
+
+
+def encode_content(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    压缩一行 RequestContent 的 prompt 与 response。
+    短于 min_size 或压缩后没有变小的内容保持原样；codec 为压缩使用的编码，均未压缩时为 plain。
+    在线程池中执行 (zlib 压缩时释放 GIL)，统计数据只做累加。
+    """
+    if not settings.compression.enabled:
+        return fields
+    encoded = {**fields, "codec": PLAIN}
+    for name in ("prompt", "response"):
+        text = fields.get(name)
+        data = compress(text.encode("utf-8")) if text else None
+        if data is None:
+            continue
+        encoded[name] = None
+        encoded[f"{name}_blob"] = data
+        encoded["codec"] = DEFAULT_CODEC
+    return encoded
+
+
+def decode_content(content: RequestContent) -> Dict[str, Optional[str]]:
+    """
+    读取一行 RequestContent 的明文内容 (透明解压)。
+    按消息去重存储的 prompt (prompt_refs) 需要通过 blobs.load_contents 读取。
+    """
+    prompt, response = content.prompt, content.response
+    if content.codec and content.codec != PLAIN:
+        if content.prompt_blob is not None:
+            prompt = decompress(content.codec, content.prompt_blob)
+        if content.response_blob is not None:
+            response = decompress(content.codec, content.response_blob)
+    return {"prompt": prompt, "response": response, "error": content.error}
+
+
+class ContentMigrator:
+    """
+    后台分批压缩旧版本写入的未压缩内容。
+    每批按 ID 顺序处理 migrate_batch 行，批次之间间隔 migrate_interval 秒，避免长时间占用数据库。
+    一批失败 (如数据库暂时被锁定) 时按指数退避重试，连续失败 migrate_retries 次后放弃，下次启动时继续。
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        config = settings.compression
+        if self.running or not (config.enabled and config.migrate):
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        config = settings.compression
+        failures = 0
+        while True:
+            try:
+                done = await self.migrate_batch(config.migrate_batch)
+            except Exception as e:
+                failures += 1
+                compression_stats.migrate_errors += 1
+                if failures >= config.migrate_retries:
+                    print(f"内容压缩迁移失败 {failures} 次，已停止: {e}")
+                    return
+                delay = min(
+                    config.migrate_interval * 2**failures, config.migrate_max_backoff
+                )
+                print(f"内容压缩迁移失败，{delay:.1f} 秒后重试: {e}")
+                await asyncio.sleep(delay)
+                continue
+            if done:
+                return
+            failures = 0
+            await asyncio.sleep(config.migrate_interval)
+
+    async def migrate_batch(self, size: int) -> bool:
+        """
+        压缩一批未压缩的内容。
+        :return: 是否已经没有需要迁移的行
+        """
+        rows: List[RequestContent] = (
+            await RequestContent.filter(codec__isnull=True).order_by("id").limit(size)
+        )
+        if not rows:
+            return True
+        encoded: List[Tuple[RequestContent, Dict[str, Any]]] = await asyncio.to_thread(
+            lambda: [
+                (row, encode_content({"prompt": row.prompt, "response": row.response}))
+                for row in rows
+            ]
+        )
+        for row, fields in encoded:
+            for name, value in fields.items():
+                setattr(row, name, value)
+        await RequestContent.bulk_update(
+            rows, fields=["prompt", "response", "prompt_blob", "response_blob", "codec"]
+        )
+        compression_stats.migrated += len(rows)
+        return len(rows) < size
+
+
+# 全局内容迁移器
+content_migrator = ContentMigrator()
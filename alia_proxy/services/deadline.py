@@ -0,0 +1,91 @@
+"""
+上游调用的时限。
+httpx 的超时只约束单次读写 (数据块之间)，无法表达 "首个数据块必须在几秒内到达" 或 "整个调用的总时限"；
+这里在代理层按时限包装上游调用与流式响应，超时后抛出 UpstreamTimeoutError，
+与 httpx 的超时异常一样计为 504 并触发降级 (仅限尚未开始输出的流)。
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, NamedTuple, Optional
+import httpx
+from ..config import MappingConfig
+
+
+class UpstreamTimeoutError(httpx.TimeoutException):
+    """
+    上游在时限内没有返回数据。
+    """
+
+
+class Deadlines(NamedTuple):
+    """
+    单次上游调用的时限 (秒)，None 表示不限制。
+    """
+
+    first_token: Optional[float]  # 流式请求等待首个数据块
+    idle: Optional[float]  # 流式响应相邻数据块之间
+    total: Optional[float]  # 整个调用
+
+    @classmethod
+    def resolve(cls, config: Any, mapping: Optional[MappingConfig]) -> "Deadlines":
+        """
+        映射配置的时限优先于提供商配置。
+        """
+
+        def pick(name: str) -> Optional[float]:
+            value = getattr(mapping, name, None) if mapping else None
+            return value if value is not None else getattr(config, name, None)
+
+        return cls(
+            pick("first_token_timeout"), pick("idle_timeout"), pick("total_timeout")
+        )
+
+
+@asynccontextmanager
+async def deadline(seconds: Optional[float]):
+    """
+    限制代码块的总执行时间，超时抛出 UpstreamTimeoutError。
+    """
+    if seconds is None:
+        yield
+        return
+    try:
+        async with asyncio.timeout(seconds):
+            yield
+    except TimeoutError:
+        raise UpstreamTimeoutError(f"Upstream did not finish within {seconds}s")
+
+
+async def guard_stream(
+    stream: AsyncGenerator[Any, None], deadlines: Deadlines
+) -> AsyncGenerator[Any, None]:
+    """
+    按时限转发流式响应: 首个数据块、相邻数据块的间隔以及整个流分别受对应时限约束。
+    超时后关闭上游流并抛出 UpstreamTimeoutError。
+    """
+    loop = asyncio.get_running_loop()
+    end = loop.time() + deadlines.total if deadlines.total is not None else None
+    first = True
+    try:
+        while True:
+            limit, reason = (
+                (deadlines.first_token, "first token")
+                if first
+                else (deadlines.idle, "next chunk")
+            )
+            if end is not None and (limit is None or end - loop.time() < limit):
+                limit, reason = max(end - loop.time(), 0), "stream completion"
+            try:
+                async with asyncio.timeout(limit):
+                    chunk = await anext(stream)
+            except StopAsyncIteration:
+                return
+            except TimeoutError:
+                raise UpstreamTimeoutError(
+                    f"Upstream timed out waiting for {reason} ({limit:.1f}s)"
+                )
+            first = False
+            yield chunk
+    finally:
+        await stream.aclose()
@@ -0,0 +1,198 @@
+"""
+上游并发限制。
+为每个提供商实例 (可选: 每个提供商/模型组合) 维护一个自适应并发上限 (AIMD)：
+请求成功时缓慢增加上限，上游出现过载信号 (429、503、超时) 时按比例收缩。
+超过上限的请求进入有界队列等待；预计无法在等待时限内获得名额的请求会被立即拒绝。
+"""
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional
+from ..config import settings, LimiterConfig
+
+# 最多跟踪的限流器数量
+MAX_LIMITERS = 1024
+# 过载时上限的收缩比例
+BACKOFF_RATIO = 0.7
+# 等待时间与持有时间 EWMA 的平滑系数
+EWMA_ALPHA = 0.2
+
+
+class LimiterRejectedError(Exception):
+    """
+    请求因并发受限被拒绝 (队列已满或等待超时)。
+    """
+
+    status_code = 503
+
+
+class ConcurrencyLimiter:
+    """
+    单个目标的自适应并发限制器。
+    所有操作都在事件循环内完成，无需加锁。
+    """
+
+    def __init__(self, name: str, config: LimiterConfig, max_limit: int):
+        self.name = name
+        self.config = config
+        self.min_limit = max(config.min_limit, 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.limit = float(min(max(config.initial_limit, self.min_limit), max_limit))
+        self.inflight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.last_decrease = 0.0  # 最近一次收缩上限的时间 (time.perf_counter)
+        self.wait_time: Optional[float] = None  # 排队等待时间 (EWMA, 秒)
+        self.hold_time: Optional[float] = None  # 名额持有时间 (EWMA, 秒)
+        self.rejected = 0  # 累计拒绝次数
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _estimated_wait(self) -> float:
+        """
+        按当前排队数量与平均持有时间估算新请求的等待时间。
+        """
+        if self.hold_time is None:
+            return 0.0
+        return (len(self._waiters) + 1) * self.hold_time / max(int(self.limit), 1)
+
+    def _observe_wait(self, wait: float):
+        self.wait_time = (
+            wait
+            if self.wait_time is None
+            else EWMA_ALPHA * wait + (1 - EWMA_ALPHA) * self.wait_time
+        )
+
+    async def acquire(self) -> float:
+        """
+        获取一个并发名额。
+        :return: 获得名额的时间 (time.perf_counter)，释放时传回 release
+        """
+        if not self._waiters and self.inflight < int(self.limit):
+            self.inflight += 1
+            self._observe_wait(0.0)
+            return time.perf_counter()
+
+        timeout = self.config.queue_timeout
+        if len(self._waiters) >= self.config.queue_size:
+            self.rejected += 1
+            raise LimiterRejectedError(f"Concurrency limit reached for {self.name}")
+        if self._estimated_wait() > timeout:
+            self.rejected += 1
+            raise LimiterRejectedError(
+                f"Concurrency limit reached for {self.name} (estimated wait exceeds {timeout}s)"
+            )
+
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as e:
+            if waiter.done() and not waiter.cancelled():
+                # 名额已分配但请求已放弃，归还名额
+                self._release_slot()
+            else:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise LimiterRejectedError(
+                    f"Timed out after {timeout}s waiting for {self.name}"
+                ) from None
+            raise
+        self._observe_wait(time.perf_counter() - start)
+        return time.perf_counter()
+
+    def release(self, acquired_at: float, overloaded: bool = False):
+        """
+        释放名额并根据结果调整上限。
+        :param acquired_at: acquire 返回的时间
+        :param overloaded: 上游是否返回了过载信号 (429、503、超时)
+        """
+        hold = time.perf_counter() - acquired_at
+        self.hold_time = (
+            hold
+            if self.hold_time is None
+            else EWMA_ALPHA * hold + (1 - EWMA_ALPHA) * self.hold_time
+        )
+        if overloaded:
+            # 同一批次请求的过载信号只收缩一次
+            if acquired_at >= self.last_decrease:
+                self.limit = max(self.limit * BACKOFF_RATIO, self.min_limit)
+                self.last_decrease = time.perf_counter()
+        elif self.inflight >= int(self.limit):
+            # 名额用满时才增加上限: 每个上限窗口约增加 1
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+        self._release_slot()
+
+    def _release_slot(self):
+        self.inflight -= 1
+        while self._waiters and self.inflight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.inflight += 1
+                waiter.set_result(None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "inflight": self.inflight,
+            "queued": len(self._waiters),
+            "wait_time": (
+                round(self.wait_time, 4) if self.wait_time is not None else None
+            ),
+            "hold_time": (
+                round(self.hold_time, 4) if self.hold_time is not None else None
+            ),
+            "rejected": self.rejected,
+        }
+
+
+class LimiterRegistry:
+    """
+    并发限制器注册表。默认按提供商实例限流，per_model 开启时按 (提供商, 模型) 限流。
+    """
+
+    def __init__(self):
+        self._limiters: "OrderedDict[str, ConcurrencyLimiter]" = OrderedDict()
+
+    def get(self, instance_name: str, model: str) -> Optional[ConcurrencyLimiter]:
+        """
+        获取目标对应的限制器。未启用限流时返回 None。
+        """
+        config = settings.limiter
+        if not config.enabled:
+            return None
+        key = f"{instance_name}/{model}" if config.per_model else instance_name
+        limiter = self._limiters.get(key)
+        if limiter is not None:
+            self._limiters.move_to_end(key)
+            return limiter
+
+        provider_config = settings.providers.get(instance_name)
+        max_limit = getattr(provider_config, "max_concurrency", None) or (
+            config.max_limit
+        )
+        limiter = self._limiters[key] = ConcurrencyLimiter(key, config, max_limit)
+        if len(self._limiters) > MAX_LIMITERS:
+            # 淘汰最久未使用且空闲的限制器
+            for old_key, old in self._limiters.items():
+                if old.inflight == 0 and old.queued == 0:
+                    del self._limiters[old_key]
+                    break
+        return limiter
+
+    def reset(self):
+        self._limiters.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {key: limiter.snapshot() for key, limiter in self._limiters.items()}
+
+
+# 全局并发限制器注册表
+limiters = LimiterRegistry()
@@ -1,6 +1,246 @@
-from datetime import date
-from typing import Optional, List, Union
-from ..models import RequestLog, RequestContent, MediaResource
+"""
+请求日志。
+log_request 只负责组装日志记录并放入内存队列，由后台写入任务按数量或时间批量写入数据库 (bulk_create)，
+避免每个请求在请求路径上进行多次数据库往返。写入任务未运行时 (如未经过 lifespan 启动) 直接写入。
+流式响应的收尾与取消路径通过 log_writer.submit 提交日志，不等待入队或写入完成。
+每个逻辑请求只写入一条日志 (内容只存储一次)；降级、对冲与竞速产生的多次上游调用写入轻量的调用记录。
+"""
+
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Deque, Dict, List, NamedTuple, Optional, Set, Union
+from tortoise import timezone
+from tortoise.transactions import in_transaction
+from ..config import settings, LogWriterConfig
+from ..models import (
+    RequestLog,
+    RequestContent,
+    RequestAttempt,
+    MediaResource,
+    ContentBlob,
+)
+from .compression import encode_content
+from .blobs import blob_store, split_contents
+from .rollups import apply_deltas, log_deltas, minute_pruner
+
+
+class AttemptRecord(NamedTuple):
+    """
+    一次逻辑请求中的一次上游调用。
+    """
+
+    attempt: int  # 调用序号 (从 1 开始，对应候选项顺序)
+    provider: str
+    model: str
+    status_code: int
+    latency: float  # 调用耗时 (秒)
+    error: str = ""
+
+
+class LogRecord(NamedTuple):
+    """
+    待写入的一条请求日志。
+    """
+
+    log: Dict[str, Any]  # RequestLog 字段
+    content: Dict[str, Any]  # RequestContent 字段
+    media_paths: List[str]  # 关联的媒体文件路径
+    media_type: str  # 媒体类型 (image/audio)
+    attempts: List[AttemptRecord]  # 上游调用记录 (只有一次调用时为空)
+
+
+async def write_records(records: List[LogRecord]):
+    """
+    在一个事务内批量写入日志。
+    RequestLog 逐条插入，由数据库分配 ID (不与其他写入者冲突)，再用于同批写入关联的内容、媒体与调用记录。
+    内容在进入事务前于线程池中拆分与压缩，不阻塞事件循环；prompt 中的消息按内容去重存储。
+    分析汇总表在同一事务内更新，与日志保持一致。
+    """
+
+    def encode():
+        contents = [record.content for record in records]
+        segments: Dict[str, str] = {}
+        if blob_store.enabled:
+            contents, segments = split_contents(contents)
+        return [encode_content(content) for content in contents], segments
+
+    encoded, segments = await asyncio.to_thread(encode)
+    sweeps = blob_store.sweeps
+    blobs = await blob_store.new_blobs(encoded, segments) if segments else []
+    async with in_transaction("default") as conn:
+        if segments and blob_store.sweeps != sweeps:
+            # 检查消息块之后执行过清理 (批量删除日志)，补齐可能已被删除的块
+            blobs += await blob_store.restore(segments, blobs, conn)
+        contents, media, attempts = [], [], []
+        for record, content in zip(records, encoded):
+            log = await RequestLog.create(using_db=conn, **record.log)
+            contents.append(RequestContent(log_id=log.id, **content))
+            media.extend(
+                MediaResource(
+                    log_id=log.id, file_path=path, file_type=record.media_type
+                )
+                for path in record.media_paths
+            )
+            attempts.extend(
+                RequestAttempt(log_id=log.id, **attempt._asdict())
+                for attempt in record.attempts
+            )
+        if blobs:
+            # 并发写入的相同消息块以先写入的为准
+            await ContentBlob.bulk_create(blobs, ignore_conflicts=True, using_db=conn)
+        await RequestContent.bulk_create(contents, using_db=conn)
+        if media:
+            await MediaResource.bulk_create(media, using_db=conn)
+        if attempts:
+            await RequestAttempt.bulk_create(attempts, using_db=conn)
+        # 在同一事务内累加分析汇总表，并定期清理过期的按分钟汇总数据
+        await apply_deltas(log_deltas(record.log for record in records), conn)
+        await minute_pruner.maybe_prune(conn)
+    blob_store.committed(blobs)
+
+
+class LogWriter:
+    """
+    后台日志写入器。所有队列操作都在事件循环内完成，无需加锁。
+    """
+
+    def __init__(self):
+        self._queue: Deque[LogRecord] = deque()
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None  # 队列积累到一批时唤醒写入任务
+        self._space: Optional[asyncio.Event] = None  # 队列腾出空间时唤醒等待的请求
+        self._stopping = False
+        self._submitted: Set[asyncio.Future] = set()  # submit 提交的日志任务
+        self.written = 0  # 已写入的日志条数
+        self.dropped = 0  # 因队列已满或写入失败而丢弃的日志条数
+        self.batches = 0  # 已写入的批次数
+        self.errors = 0  # 写入失败的次数
+
+    @property
+    def config(self) -> LogWriterConfig:
+        return settings.log_writer
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """
+        启动后台写入任务 (在 lifespan 中调用)。
+        """
+        if self.running or not self.config.enabled:
+            return
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        停止写入任务，并写入队列中剩余的全部日志 (包括 submit 提交但尚未入队的日志)。
+        """
+        if self._submitted:
+            await asyncio.gather(*self._submitted, return_exceptions=True)
+        if not self.running:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    def submit(self, coro: Awaitable[Any]):
+        """
+        在后台执行日志记录 (fire-and-forget)。
+        用于流式响应的收尾与客户端断开的路径: 在这些位置等待会推迟响应结束，或被再次取消。
+        """
+        task = asyncio.ensure_future(coro)
+        self._submitted.add(task)
+        task.add_done_callback(self._submitted_done)
+
+    def _submitted_done(self, task: asyncio.Future):
+        self._submitted.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            print(f"日志记录失败: {task.exception()}")
+
+    async def put(self, record: LogRecord):
+        """
+        将日志放入队列。队列已满时按 overflow 策略等待或丢弃。
+        """
+        if not self.running:
+            await write_records([record])
+            return
+
+        config = self.config
+        if len(self._queue) >= config.queue_size:
+            if config.overflow == "drop-oldest":
+                self._queue.popleft()
+                self.dropped += 1
+            elif config.overflow == "drop-new" or not await self._wait_for_space():
+                self.dropped += 1
+                return
+
+        self._queue.append(record)
+        if len(self._queue) >= config.batch_size:
+            self._wakeup.set()
+
+    async def _wait_for_space(self) -> bool:
+        """
+        等待队列腾出空间 (反压)，超过 block_timeout 时返回 False。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.config.block_timeout
+        self._wakeup.set()
+        while len(self._queue) >= self.config.queue_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            self._space.clear()
+            try:
+                await asyncio.wait_for(self._space.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.config.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._flush()
+            if self._stopping and not self._queue:
+                return
+
+    async def _flush(self):
+        while self._queue:
+            size = min(self.config.batch_size, len(self._queue))
+            batch = [self._queue.popleft() for _ in range(size)]
+            self._space.set()
+            try:
+                await write_records(batch)
+            except Exception as e:
+                self.errors += 1
+                self.dropped += len(batch)
+                print(f"日志写入失败，丢弃 {len(batch)} 条日志: {e}")
+                continue
+            self.written += len(batch)
+            self.batches += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "queued": len(self._queue),
+            "written": self.written,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "errors": self.errors,
+        }
+
+
+# 全局日志写入器
+log_writer = LogWriter()
 
 
 async def log_request(
@@ -14,6 +254,7 @@ async def log_request(
     total_tokens: int = 0,
     status_code: int = 200,
     latency: float = 0.0,
+    ttft: Optional[float] = None,
     media_path: Optional[Union[str, List[str]]] = "",
     error: str = "",
     ip_address: str = "",
@@ -22,43 +263,43 @@ async def log_request(
     metadata: Optional[dict] = None,
     media_type: str = "image",
     request_model: Optional[str] = None,
+    attempts: Optional[List[AttemptRecord]] = None,
 ):
     """
     异步记录请求日志。
-    使用 Tortoise-ORM 将请求元数据、Token 统计和内容负载分别保存到对应的表中。
+    请求元数据、Token 统计、内容负载与媒体记录由后台写入器分别批量写入对应的表中。
+    :param attempts: 本次请求的全部上游调用 (按发起顺序)，未提供时视为一次调用，缓存命中时为空列表。
+        只有一次调用时不写入调用记录，日志本身即描述了这次调用。
     """
-    # 1. 创建核心元数据日志
-    log = await RequestLog.create(
-        provider=provider,
-        endpoint=endpoint,
-        model=model,
-        request_model=request_model,
-        prompt_tokens=prompt_tokens,
-        completion_tokens=completion_tokens,
-        total_tokens=total_tokens,
-        status_code=status_code,
-        latency=latency,
-        ip_address=ip_address,
-        request_id=request_id,
-        is_streaming=is_streaming,
-        metadata=metadata,
-        date=date.today(),
-    )
-
-    # 2. 创建详情内容 (Prompt/Response/Error)
-    await RequestContent.create(
-        log=log,
-        prompt=prompt,
-        response=response,
-        error=error,
-    )
-
-    # 3. 如果有关联媒体资源，创建媒体记录
     if media_path:
-        paths = [media_path] if isinstance(media_path, str) else media_path
-        for path in paths:
-            await MediaResource.create(
-                log=log,
-                file_path=path,
-                file_type=media_type,
-            )
+        paths = [media_path] if isinstance(media_path, str) else list(media_path)
+    else:
+        paths = []
+    # 时间取请求完成时，而不是写入数据库时；日期与时间戳使用同一时区
+    timestamp = timezone.now()
+    record = LogRecord(
+        log={
+            "provider": provider,
+            "endpoint": endpoint,
+            "model": model,
+            "request_model": request_model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "status_code": status_code,
+            "latency": latency,
+            "ttft": ttft,
+            "ip_address": ip_address,
+            "request_id": request_id,
+            "is_streaming": is_streaming,
+            "metadata": metadata,
+            "attempt_count": len(attempts) if attempts is not None else 1,
+            "timestamp": timestamp,
+            "date": timestamp.date(),
+        },
+        content={"prompt": prompt, "response": response, "error": error},
+        media_paths=paths,
+        media_type=media_type,
+        attempts=attempts if attempts and len(attempts) > 1 else [],
+    )
+    await log_writer.put(record)
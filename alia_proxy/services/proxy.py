@@ -1,15 +1,196 @@
 import time
 import json
 import base64
-from typing import Any, Dict, Tuple, AsyncGenerator, List, Union, Optional
+import asyncio
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    NamedTuple,
+    Set,
+    Tuple,
+    AsyncGenerator,
+    List,
+    Union,
+    Optional,
+)
+import httpx
+from ..config import settings, MappingConfig
 from ..providers.base import (
     BaseProvider,
     ChatRequest,
     EmbeddingsRequest,
     EmbeddingsResponse,
+    RawChatResponse,
+    Usage,
 )
-from ..services.logger import log_request
+from ..services.logger import log_request, log_writer, AttemptRecord
 from ..services.media import save_media
+from ..services.sse import (
+    OpenAIStreamTap,
+    AnthropicStreamTap,
+    ChunkTimer,
+    DONE_FRAME,
+    completion_to_sse,
+    estimate_tokens,
+)
+from ..services.breaker import circuit_breakers, CircuitOpenError
+from ..services.telemetry import telemetry, TELEMETRY_STRATEGIES
+from ..services.limiter import limiters, ConcurrencyLimiter
+from ..services.coalesce import single_flight, coalesce_key
+from ..services.batcher import embedding_batcher
+from ..services.deadline import Deadlines, deadline, guard_stream
+from ..services.semantic import (
+    semantic_cache,
+    SemanticEntry,
+    SemanticQuery,
+    query_text,
+    namespace,
+    normalize,
+)
+from ..services.cache import (
+    response_cache,
+    cache_key,
+    CachedResponse,
+    embedding_cache,
+    pack_vector,
+    unpack_vector,
+)
+
+Candidate = Tuple[BaseProvider, str, str]
+
+# 对冲请求的默认延迟 (秒)，在未配置 hedge_delay 且观测样本不足时使用
+DEFAULT_HEDGE_DELAY = 2.0
+
+
+def get_status_code(e: Exception) -> int:
+    """
+    从异常中提取用于日志记录的状态码。
+    上游 HTTP 错误使用上游响应的状态码，连接超时为 504，其他连接错误为 502。
+    """
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code
+    if isinstance(e, httpx.TimeoutException):
+        return 504
+    if isinstance(e, httpx.TransportError):
+        return 502
+    status_code = getattr(e, "status_code", 500)
+    return status_code if isinstance(status_code, int) else 500
+
+
+class UpstreamAttempt:
+    """
+    单次上游调用的运行时状态。
+    在调用结束时更新熔断器与遥测数据、归还并发名额，并保证每次调用只结算一次。
+    """
+
+    def __init__(
+        self,
+        instance_name: str,
+        model: str,
+        limiter: Optional[ConcurrencyLimiter] = None,
+        queued_at: Optional[float] = None,
+    ):
+        """
+        :param limiter: 已从中获取名额的并发限制器
+        :param queued_at: 开始排队等待名额的时间 (time.perf_counter)
+        """
+        self.instance_name = instance_name
+        self.model = model
+        self.limiter = limiter
+        self.start_time = time.perf_counter()
+        self.queued_at = queued_at if queued_at is not None else self.start_time
+        self.first_token_latency: Optional[float] = None  # 首个数据块延迟 (流式)
+        self.finished = False
+        circuit_breakers.on_attempt(instance_name, model)
+        telemetry.begin(instance_name, model)
+
+    @classmethod
+    async def start(cls, instance_name: str, model: str) -> "UpstreamAttempt":
+        """
+        获取并发名额 (可能需要排队) 后开始一次上游调用。
+        名额不足时抛出 LimiterRejectedError。
+        """
+        queued_at = time.perf_counter()
+        limiter = limiters.get(instance_name, model)
+        if limiter is not None:
+            await limiter.acquire()
+        return cls(instance_name, model, limiter, queued_at)
+
+    @property
+    def latency(self) -> float:
+        """
+        上游调用耗时 (不含排队时间)。
+        """
+        return time.perf_counter() - self.start_time
+
+    def _finish(self, overloaded: bool = False):
+        self.finished = True
+        telemetry.end(self.instance_name, self.model)
+        if self.limiter is not None:
+            self.limiter.release(self.start_time, overloaded)
+
+    def mark_first_token(self):
+        if self.first_token_latency is None:
+            self.first_token_latency = self.latency
+
+    def succeed(self):
+        if self.finished:
+            return
+        self._finish()
+        circuit_breakers.record_success(self.instance_name, self.model)
+        # 流式请求以首个数据块的延迟作为响应延迟
+        telemetry.observe(
+            self.instance_name,
+            self.model,
+            (
+                self.first_token_latency
+                if self.first_token_latency is not None
+                else self.latency
+            ),
+        )
+
+    def fail(self, e: Exception):
+        if self.finished:
+            return
+        status_code = get_status_code(e)
+        # 限流、服务过载与超时视为上游过载信号，收缩并发上限
+        self._finish(
+            overloaded=status_code in (429, 503)
+            or isinstance(e, httpx.TimeoutException)
+        )
+        circuit_breakers.record_failure(
+            self.instance_name,
+            self.model,
+            status_code,
+            transport_error=isinstance(e, httpx.TransportError),
+        )
+        # 客户端错误 (如请求参数无效) 不计入上游故障率
+        if status_code >= 500 or status_code == 429:
+            telemetry.observe_failure(self.instance_name, self.model)
+
+    def cancel(self):
+        """
+        调用被取消 (如对冲请求落败、客户端断开)，不计入成功或失败。
+        """
+        if self.finished:
+            return
+        self._finish()
+
+
+class OpenedStream(NamedTuple):
+    """
+    已建立并收到首个数据块的上游流。
+    """
+
+    index: int  # 候选项序号
+    candidate: Candidate
+    attempt: UpstreamAttempt
+    tap: OpenAIStreamTap
+    stream: AsyncGenerator[Union[str, bytes], None]
+    first_chunk: Optional[Union[str, bytes]]
 
 
 class ProxyService:
@@ -17,6 +198,7 @@ class ProxyService:
     代理服务类。
     封装了对具体提供商的调用逻辑，并自动集成日志记录和媒体存储功能。
     支持故障自动降级 (Fallback)。
+    每个实例对应一次逻辑请求: 降级、对冲与竞速产生的多次上游调用汇总为一条请求日志。
     """
 
     def __init__(
@@ -27,6 +209,7 @@ class ProxyService:
         request_ip: str = "",
         fallbacks: Optional[List[str]] = None,
         original_model: Optional[str] = None,
+        mapping: Optional[MappingConfig] = None,
     ):
         """
         初始化代理服务。
@@ -36,6 +219,7 @@ class ProxyService:
         :param request_ip: 请求者的 IP 地址
         :param fallbacks: 降级备选模型列表
         :param original_model: 用户请求的原始模型名称 (用于日志记录)
+        :param mapping: 命中的映射配置 (决定 hedge / race 调度方式)
         """
         self.provider = provider
         self.model = model
@@ -43,10 +227,91 @@ class ProxyService:
         self.request_ip = request_ip
         self.fallbacks = fallbacks or []
         self.original_model = original_model
+        self.mapping = mapping
+        self.start_time = time.perf_counter()  # 逻辑请求的开始时间
+        self.attempts: List[AttemptRecord] = []  # 已结束的上游调用 (随请求日志写入)
+
+    def _begin(self):
+        """
+        开始一次逻辑请求: 重置开始时间与调用记录。
+        """
+        self.start_time = time.perf_counter()
+        self.attempts = []
+
+    def _record_attempt(
+        self,
+        i: int,
+        instance_name: str,
+        model: str,
+        status_code: int,
+        start_time: float,
+        error: str = "",
+    ):
+        """
+        记录一次已结束的上游调用。
+        :param i: 候选项序号
+        :param start_time: 该次调用的开始时间 (time.perf_counter)
+        """
+        self.attempts.append(
+            AttemptRecord(
+                i + 1,
+                instance_name,
+                model,
+                status_code,
+                time.perf_counter() - start_time,
+                error,
+            )
+        )
 
-    def _get_candidates(self) -> List[Tuple[BaseProvider, str, str]]:
+    def _ttft(self, timer: ChunkTimer) -> Optional[float]:
+        """
+        端到端的首个数据块延迟 (从逻辑请求开始计时，包含此前失败的调用)。
+        """
+        return timer.first - self.start_time if timer.first is not None else None
+
+    def _log(self, endpoint: str, prompt: str, **fields: Any) -> Awaitable[None]:
+        """
+        组装本次逻辑请求的日志: 最终结果、端到端耗时与各次上游调用的记录。
+        返回的协程由调用方等待，或在流式响应的收尾与取消路径上通过 log_writer.submit 提交。
+        """
+        return log_request(
+            endpoint=endpoint,
+            prompt=prompt,
+            latency=time.perf_counter() - self.start_time,
+            ip_address=self.request_ip,
+            request_model=self._get_request_model(),
+            attempts=list(self.attempts),
+            **fields,
+        )
+
+    def _log_failure(
+        self, endpoint: str, prompt: str, e: BaseException, **fields: Any
+    ) -> Awaitable[None]:
+        """
+        记录失败 (或被取消) 的逻辑请求。
+        提供商、模型、状态码与错误取最后一次上游调用，尚未发起调用时取主提供商与异常本身。
+        """
+        if self.attempts:
+            last = self.attempts[-1]
+            provider, model = last.provider, last.model
+            status_code, error = last.status_code, last.error
+        else:
+            provider, model = self.instance_name, self.model
+            status_code, error = get_status_code(e), str(e)
+        return self._log(
+            endpoint,
+            prompt,
+            provider=provider,
+            model=model,
+            status_code=status_code,
+            error=error,
+            **fields,
+        )
+
+    def _get_candidates(self) -> List[Candidate]:
         """
         获取所有候选提供商 (主提供商 + 降级提供商)。
+        映射使用 least-latency / least-inflight 策略时，降级提供商按遥测数据排序。
         :return: List[(Provider, ModelName, InstanceName)]
         """
         candidates = [(self.provider, self.model, self.instance_name)]
@@ -63,7 +328,190 @@ class ProxyService:
                 except Exception:
                     # 如果解析或获取 fallback 失败，忽略该候选项
                     pass
-        return candidates
+
+        # 基于遥测的路由策略同样用于排列降级顺序
+        if self.mapping and self.mapping.strategy in TELEMETRY_STRATEGIES:
+            candidates[1:] = sorted(
+                candidates[1:],
+                key=lambda c: telemetry.score(c[2], c[1], self.mapping.strategy),
+            )
+
+        # 跳过处于熔断状态的候选项
+        available = [c for c in candidates if circuit_breakers.allows(c[2], c[1])]
+        if not available:
+            raise CircuitOpenError(
+                f"All candidates for {self.original_model or self.model} are unavailable (circuit open)"
+            )
+        return available
+
+    async def _candidates(
+        self, endpoint: str, prompt: str, **fields: Any
+    ) -> List[Candidate]:
+        """
+        获取候选提供商。全部候选项处于熔断状态时记录被拒绝的请求 (503) 后抛出，
+        故障期间的分析数据显示为被拒绝，而不是流量下降。
+        """
+        try:
+            return self._get_candidates()
+        except CircuitOpenError as e:
+            await self._log_failure(endpoint, prompt, e, **fields)
+            raise
+
+    @asynccontextmanager
+    async def _attempt(self, instance_name: str, model: str):
+        """
+        包装单次上游调用。
+        根据调用结果更新熔断器与遥测数据; 异常会继续向外抛出，由调用方记录日志并决定是否降级。
+        """
+        attempt = await UpstreamAttempt.start(instance_name, model)
+        try:
+            yield attempt
+        except Exception as e:
+            attempt.fail(e)
+            raise
+        except BaseException:
+            attempt.cancel()
+            raise
+        attempt.succeed()
+
+    def _deadlines(self, provider: BaseProvider) -> Deadlines:
+        """
+        单次上游调用的时限 (映射配置优先于提供商配置)。
+        """
+        return Deadlines.resolve(provider.config, self.mapping)
+
+    @property
+    def dispatch(self) -> str:
+        """
+        当前请求的调度方式: sequential, hedge 或 race。
+        """
+        return self.mapping.dispatch if self.mapping else "sequential"
+
+    def _log_metadata(
+        self,
+        coalesced: bool = False,
+        usage: Optional[Usage] = None,
+        stream: Optional[Dict[str, Any]] = None,
+        **extra: Any,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        附加到日志的元数据: hedge / race 调度信息、是否为合并请求、提示词缓存的读写 Token 数，
+        以及流式响应的分块计时统计。
+        """
+        metadata: Dict[str, Any] = {}
+        if self.dispatch != "sequential":
+            metadata = {"dispatch": self.dispatch, **extra}
+        if coalesced:
+            metadata["coalesced"] = True
+        if usage is not None and (usage.cache_read_tokens or usage.cache_write_tokens):
+            metadata["cache_read_tokens"] = usage.cache_read_tokens or 0
+            metadata["cache_write_tokens"] = usage.cache_write_tokens or 0
+        if stream:
+            metadata["stream"] = stream
+        return metadata or None
+
+    async def _coalesce(
+        self,
+        endpoint: str,
+        instance_name: str,
+        body: Dict[str, Any],
+        call: Callable[[], Awaitable[Any]],
+    ) -> Tuple[Any, bool]:
+        """
+        映射开启 coalesce 时，合并完全相同的进行中请求。
+        :return: (上游响应, 是否复用了其他请求的结果)
+        """
+        if not (self.mapping and self.mapping.coalesce):
+            return await call(), False
+        return await single_flight.do(coalesce_key(endpoint, instance_name, body), call)
+
+    def _hedge_delay(self, candidate: Candidate) -> float:
+        """
+        对冲延迟: 优先使用映射配置，否则取首个候选项观测到的 P95 首响应延迟。
+        """
+        if self.mapping and self.mapping.hedge_delay is not None:
+            return self.mapping.hedge_delay
+        _, model, instance_name = candidate
+        observed = telemetry.quantile(instance_name, model, 0.95)
+        return observed if observed is not None else DEFAULT_HEDGE_DELAY
+
+    async def _dispatch(
+        self,
+        candidates: List[Candidate],
+        run: Callable[[int, Candidate], Awaitable[Any]],
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ) -> Any:
+        """
+        按映射配置的调度方式执行候选项，返回第一个成功的结果。
+        - sequential: 依次尝试，失败后降级到下一个候选项。
+        - hedge: 先请求第一个候选项，若在对冲延迟内仍未返回，则并发请求下一个候选项。
+        - race: 同时请求前 race_count 个候选项。
+        hedge 与 race 模式下，失败的请求由后续候选项补位，其余未完成的请求在得到结果后被取消。
+        :param run: 执行单个候选项的协程函数 run(index, candidate)，失败时抛出异常
+        :param discard: 释放多余成功结果的协程函数 (多个候选项同时成功时)
+        """
+        mode = self.dispatch
+        if mode not in ("hedge", "race") or len(candidates) == 1:
+            for i, candidate in enumerate(candidates):
+                try:
+                    return await run(i, candidate)
+                except Exception:
+                    # 如果是最后一个候选项，则抛出异常
+                    if i == len(candidates) - 1:
+                        raise
+
+        width = max(self.mapping.race_count, 1) if mode == "race" else 1
+        delay = self._hedge_delay(candidates[0]) if mode == "hedge" else None
+        queue = list(enumerate(candidates))
+        pending: Set[asyncio.Task] = set()
+        last_exception: Optional[BaseException] = None
+
+        def launch():
+            i, candidate = queue.pop(0)
+            pending.add(asyncio.create_task(run(i, candidate)))
+
+        try:
+            while queue and len(pending) < width:
+                launch()
+            while pending:
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=delay if queue else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    # 对冲延迟内没有候选项返回，追加下一个候选项
+                    launch()
+                    continue
+
+                winner = None
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is not None:
+                        last_exception = task.exception()
+                    elif winner is None:
+                        winner = task
+                    elif discard is not None:
+                        await discard(task.result())
+                if winner is not None:
+                    return winner.result()
+
+                # 补位: 保持并发数量
+                while queue and len(pending) < width:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                results = await asyncio.gather(*pending, return_exceptions=True)
+                # 取消前已经成功返回的结果
+                for result in results:
+                    if discard is not None and not isinstance(result, BaseException):
+                        await discard(result)
+
+        if last_exception:
+            raise last_exception
+        raise Exception("No providers available")
 
     def _get_request_model(self) -> Optional[str]:
         """
@@ -127,272 +575,711 @@ class ProxyService:
 
         return json.dumps(processed_messages, ensure_ascii=False), media_paths
 
-    async def chat(self, chat_request: ChatRequest) -> Dict[str, Any]:
+    async def chat(
+        self, chat_request: ChatRequest
+    ) -> Union[Dict[str, Any], RawChatResponse]:
         """
         处理非流式聊天请求。
         调用提供商 API，记录日志并返回响应结果。
-        支持自动降级。
+        支持自动降级以及 hedge / race 调度。
+        OpenAI 兼容提供商默认返回未经解析的 RawChatResponse，由路由层直接输出上游字节。
+        映射配置了 semantic_threshold 时，在选择候选项之前先查找语义缓存。
         """
+        self._begin()
         # 预处理请求，转存图片 (仅需做一次)
         prompt_json, media_paths = await self._process_messages_for_log(
             chat_request.messages
         )
 
-        candidates = self._get_candidates()
-        last_exception = None
+        semantic = await self._semantic_query(chat_request)
+        if semantic is not None:
+            hit = semantic_cache.get(semantic)
+            if hit is not None:
+                entry, similarity = hit
+                response = RawChatResponse(entry.body, entry.media_type)
+                self._log_cache_hit(
+                    (self.provider, entry.model, entry.instance_name),
+                    response,
+                    prompt_json,
+                    media_paths,
+                    False,
+                    metadata={"cache": "semantic", "similarity": round(similarity, 4)},
+                )
+                return response
 
-        for i, (provider, model, instance_name) in enumerate(candidates):
-            start_time = time.perf_counter()
-            try:
-                # 更新请求中的模型名称
-                chat_request.model = model
+        candidates = await self._candidates("chat", prompt_json, media_path=media_paths)
+
+        cached = await self._cache_lookup(candidates, chat_request)
+        if cached is not None:
+            candidate, entry = cached
+            response = RawChatResponse(entry.body, entry.media_type)
+            self._log_cache_hit(candidate, response, prompt_json, media_paths, False)
+            return response
+
+        async def run(i: int, candidate: Candidate):
+            return await self._chat_once(
+                i,
+                len(candidates),
+                candidate,
+                chat_request,
+                semantic,
+            )
+
+        try:
+            result, outcome = await self._dispatch(candidates, run)
+        except Exception as e:
+            await self._log_failure("chat", prompt_json, e, media_path=media_paths)
+            raise
+        except asyncio.CancelledError as e:
+            # 客户端断开: 取消路径上不能再等待，日志在后台提交
+            log_writer.submit(
+                self._log_failure("chat", prompt_json, e, media_path=media_paths)
+            )
+            raise
+        # 在调度结束 (落败的对冲 / 竞速请求均已取消) 后记录，包含全部上游调用
+        await self._log("chat", prompt_json, media_path=media_paths, **outcome)
+        return result
+
+    async def _semantic_query(
+        self, chat_request: ChatRequest
+    ) -> Optional[SemanticQuery]:
+        """
+        为开启了语义缓存的映射生成查询: 以请求模型、系统提示与其余参数作为命名空间，
+        用配置的嵌入模型向量化最近的消息窗口。无法向量化时不使用语义缓存。
+        """
+        threshold = self.mapping.semantic_threshold if self.mapping else None
+        if threshold is None or not semantic_cache.enabled:
+            return None
+        config = settings.semantic_cache
+        text = query_text(chat_request.messages, config.message_window)
+        if text is None:
+            return None
+
+        body = chat_request.model_dump(
+            exclude_none=True,
+            exclude={"model", "messages", "stream", "stream_options", "user"},
+        )
+        body["system"] = [
+            message.model_dump(exclude_none=True)
+            for message in chat_request.messages
+            if message.role == "system"
+        ]
+        try:
+            from ..providers.factory import ProviderFactory
 
-                response = await provider.chat(chat_request)
-                latency = time.perf_counter() - start_time
+            instance_name, model, _ = ProviderFactory.resolve_model(
+                config.embedding_model
+            )
+            provider = ProviderFactory.get_provider(instance_name)
+            async with self._attempt(instance_name, model):
+                response = await provider.embeddings(
+                    EmbeddingsRequest(model=model, input=[text])
+                )
+            vector = normalize(response.data[0]["embedding"])
+        except Exception:
+            semantic_cache.errors += 1
+            return None
+        if vector is None:
+            return None
+        return SemanticQuery(
+            namespace(self.original_model or self.model, body), vector, threshold
+        )
 
+    def _cacheable(self, chat_request: ChatRequest) -> bool:
+        """
+        请求是否适用响应缓存: 映射显式配置优先，否则仅缓存确定性请求 (temperature 为 0 或指定了 seed)。
+        """
+        if not settings.cache.enabled:
+            return False
+        if self.mapping and self.mapping.cache is not None:
+            return self.mapping.cache
+        return chat_request.temperature == 0 or chat_request.seed is not None
+
+    @staticmethod
+    def _cache_key(candidate: Candidate, chat_request: ChatRequest) -> str:
+        """
+        缓存键: 目标模型 + 规范化的请求体 (流式与否不影响缓存)。
+        """
+        _, model, instance_name = candidate
+        body = chat_request.model_dump(
+            exclude_none=True, exclude={"model", "stream", "stream_options"}
+        )
+        return cache_key(instance_name, model, body)
+
+    async def _cache_lookup(
+        self, candidates: List[Candidate], chat_request: ChatRequest
+    ) -> Optional[Tuple[Candidate, CachedResponse]]:
+        """
+        按候选项顺序查找缓存的响应。
+        """
+        if not self._cacheable(chat_request):
+            return None
+        for candidate in candidates:
+            entry = await response_cache.get(self._cache_key(candidate, chat_request))
+            if entry is not None:
+                return candidate, entry
+        return None
+
+    def _log_cache_hit(
+        self,
+        candidate: Candidate,
+        response: RawChatResponse,
+        prompt_json: str,
+        media_paths: List[str],
+        is_streaming: bool,
+        metadata: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        记录缓存命中的请求 (没有上游调用，Token 记为 0)。
+        """
+        _, model, instance_name = candidate
+        log_writer.submit(
+            self._log(
+                "chat",
+                prompt_json,
+                provider=instance_name,
+                model=model,
+                response=response.content,
+                status_code=200,
+                request_id=response.id,
+                is_streaming=is_streaming,
+                media_path=media_paths,
+                metadata=metadata or {"cache": "hit"},
+            )
+        )
+
+    async def _chat_once(
+        self,
+        i: int,
+        total: int,
+        candidate: Candidate,
+        chat_request: ChatRequest,
+        semantic: Optional[SemanticQuery] = None,
+    ) -> Tuple[Union[Dict[str, Any], RawChatResponse], Dict[str, Any]]:
+        """
+        向单个候选项发起非流式聊天请求并记录本次调用。
+        :param semantic: 语义缓存查询，成功后以此写入语义缓存
+        :return: (响应, 请求日志中描述最终结果的字段)
+        """
+        provider, model, instance_name = candidate
+        start_time = time.perf_counter()
+        try:
+            # 每个候选项使用独立的请求副本 (hedge / race 下会并发执行)
+            request = chat_request.model_copy(update={"model": model})
+
+            async def call():
+                async with self._attempt(instance_name, model):
+                    async with deadline(self._deadlines(provider).total):
+                        if provider.can_passthrough():
+                            return await provider.chat_raw(request)
+                        return await provider.chat(request)
+
+            response, coalesced = await self._coalesce(
+                "chat",
+                instance_name,
+                request.model_dump(exclude_none=True),
+                call,
+            )
+            # 合并请求没有产生上游消耗，不重复统计 Token
+            usage = response.usage if not coalesced else Usage()
+
+            if isinstance(response, RawChatResponse):
+                result = response
+                resp_content = response.content
+            else:
+                result = response.model_dump(exclude_none=True)
                 resp_content = response.choices[0].message.content
                 if isinstance(resp_content, list):
                     resp_content = json.dumps(resp_content, ensure_ascii=False)
                 elif resp_content is None:
                     resp_content = ""
 
-                # 记录请求和响应到数据库
-                await log_request(
-                    provider=instance_name,
-                    endpoint="chat",
-                    model=model,
-                    prompt=prompt_json,
-                    response=resp_content,
-                    prompt_tokens=response.usage.prompt_tokens,
-                    completion_tokens=response.usage.completion_tokens,
-                    total_tokens=response.usage.total_tokens,
-                    status_code=200,
-                    latency=latency,
-                    ip_address=self.request_ip,
-                    request_id=response.id,
-                    is_streaming=False,
-                    media_path=media_paths,
-                    request_model=self._get_request_model(),
-                )
-                return response.model_dump(exclude_none=True)
-
-            except Exception as e:
-                last_exception = e
-                latency = time.perf_counter() - start_time
-                status_code = getattr(e, "status_code", 500)
-
-                # 记录错误日志
-                await log_request(
-                    provider=instance_name,
-                    endpoint="chat",
-                    model=model,
-                    prompt=prompt_json,
-                    error=f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
-                    status_code=status_code,
-                    latency=latency,
-                    ip_address=self.request_ip,
-                    media_path=media_paths,
-                    request_model=self._get_request_model(),
-                )
-
-                # 如果是最后一个候选项，则抛出异常
-                if i == len(candidates) - 1:
-                    raise
+            cacheable = self._cacheable(chat_request)
+            if not coalesced and (cacheable or semantic is not None):
+                if isinstance(response, RawChatResponse):
+                    body, media_type = response.body, response.media_type
+                else:
+                    body = json.dumps(result, ensure_ascii=False).encode()
+                    media_type = "application/json"
+                if cacheable:
+                    await response_cache.put(
+                        self._cache_key(candidate, chat_request), body, media_type
+                    )
+                if semantic is not None:
+                    expires_at = time.time() + settings.semantic_cache.ttl
+                    semantic_cache.put(
+                        semantic,
+                        SemanticEntry(
+                            body, media_type, expires_at, instance_name, model
+                        ),
+                    )
 
-        # Should be unreachable if candidates is not empty
-        if last_exception:
-            raise last_exception
-        raise Exception("No providers available")
+            self._record_attempt(i, instance_name, model, 200, start_time)
+            return result, {
+                "provider": instance_name,
+                "model": model,
+                "response": resp_content,
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.total_tokens,
+                "status_code": 200,
+                "request_id": response.id,
+                "is_streaming": False,
+                "metadata": self._log_metadata(coalesced, usage, attempt=i + 1),
+            }
+
+        except asyncio.CancelledError:
+            # hedge / race 落败的请求或客户端断开
+            self._record_attempt(
+                i,
+                instance_name,
+                model,
+                499,
+                start_time,
+                f"Attempt {i + 1}/{total} cancelled",
+            )
+            raise
+
+        except Exception as e:
+            self._record_attempt(
+                i,
+                instance_name,
+                model,
+                get_status_code(e),
+                start_time,
+                f"Attempt {i + 1}/{total} failed: {str(e)}",
+            )
+            raise
 
     async def embeddings(self, request: EmbeddingsRequest) -> Dict[str, Any]:
         """
         处理嵌入请求。
-        支持自动降级。
+        支持自动降级、嵌入向量缓存与微批处理。
         """
+        self._begin()
         prompt_str = json.dumps(request.input, ensure_ascii=False)
-        candidates = self._get_candidates()
-        last_exception = None
+        candidates = await self._candidates("embeddings", prompt_str)
 
         for i, (provider, model, instance_name) in enumerate(candidates):
             start_time = time.perf_counter()
             try:
                 request.model = model
-                response = await provider.embeddings(request)
-                latency = time.perf_counter() - start_time
+                # 由缓存、合并与微批处理各环节填充的日志元数据
+                metadata: Dict[str, Any] = {}
+                if settings.embeddings_cache.enabled:
+                    response = await self._cached_embeddings(
+                        provider, model, instance_name, request, metadata
+                    )
+                else:
+                    response = await self._fetch_embeddings(
+                        provider, model, instance_name, request, metadata
+                    )
+                usage = response.usage if not metadata.get("coalesced") else Usage()
+                self._record_attempt(i, instance_name, model, 200, start_time)
 
                 # 记录请求和响应到数据库
-                await log_request(
+                await self._log(
+                    "embeddings",
+                    prompt_str,
                     provider=instance_name,
-                    endpoint="embeddings",
                     model=model,
-                    prompt=prompt_str,
                     response="[Embeddings Data]",
-                    prompt_tokens=response.usage.prompt_tokens,
-                    total_tokens=response.usage.total_tokens,
+                    prompt_tokens=usage.prompt_tokens,
+                    total_tokens=usage.total_tokens,
                     status_code=200,
-                    latency=latency,
-                    ip_address=self.request_ip,
                     request_id=getattr(response, "id", None),
                     is_streaming=False,
-                    request_model=self._get_request_model(),
+                    metadata={**(self._log_metadata() or {}), **metadata} or None,
                 )
                 return response.model_dump(exclude_none=True)
             except Exception as e:
-                last_exception = e
-                latency = time.perf_counter() - start_time
-                status_code = getattr(e, "status_code", 500)
-                await log_request(
-                    provider=instance_name,
-                    endpoint="embeddings",
-                    model=model,
-                    prompt=prompt_str,
-                    error=f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
-                    status_code=status_code,
-                    latency=latency,
-                    ip_address=self.request_ip,
-                    request_model=self._get_request_model(),
+                self._record_attempt(
+                    i,
+                    instance_name,
+                    model,
+                    get_status_code(e),
+                    start_time,
+                    f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
                 )
                 if i == len(candidates) - 1:
+                    await self._log_failure("embeddings", prompt_str, e)
                     raise
 
-        if last_exception:
-            raise last_exception
         raise Exception("No providers available")
 
-    async def chat_stream(self, chat_request: ChatRequest) -> AsyncGenerator[str, None]:
+    async def _fetch_embeddings(
+        self,
+        provider: BaseProvider,
+        model: str,
+        instance_name: str,
+        request: EmbeddingsRequest,
+        metadata: Dict[str, Any],
+    ) -> EmbeddingsResponse:
         """
-        处理流式聊天请求。
-        支持自动降级 (仅在流启动失败时重试)。
+        向上游请求嵌入向量。
+        启用微批处理时，小请求与其他并发请求合并发送；否则按映射配置合并完全相同的请求。
+        :param metadata: 日志元数据，记录 coalesced / batch_size
         """
-        prompt_json, media_paths = await self._process_messages_for_log(
-            chat_request.messages
-        )
-
-        candidates = self._get_candidates()
-
-        for i, (provider, model, instance_name) in enumerate(candidates):
-            start_time = time.perf_counter()
-            full_content = ""
-            prompt_tokens = 0
-            completion_tokens = 0
-            total_tokens = 0
-            status_code = 200
-            error_occured = False
+        inputs = [request.input] if isinstance(request.input, str) else request.input
+        config = settings.embeddings_batch
+        if config.enabled and len(inputs) <= config.max_request_size:
+
+            async def fetch(batch_inputs: List[str]) -> EmbeddingsResponse:
+                # user 字段因调用方而异，合并后的请求不再携带
+                batch_request = request.model_copy(
+                    update={"input": batch_inputs, "user": None}
+                )
+                async with self._attempt(instance_name, model):
+                    return await provider.embeddings(batch_request)
 
-            try:
-                chat_request.model = model
+            key = (instance_name, model, request.dimensions, request.encoding_format)
+            response, batch_size = await embedding_batcher.submit(key, inputs, fetch)
+            metadata["batch_size"] = batch_size
+            return response
 
-                # 获取生成器
-                stream_gen = provider.stream(chat_request)
+        async def call():
+            async with self._attempt(instance_name, model):
+                return await provider.embeddings(request)
 
-                # 尝试获取第一个块 (用于检测启动错误)
-                try:
-                    first_chunk = await stream_gen.__anext__()
-                except StopAsyncIteration:
-                    # 空流？视为成功但无内容
-                    yield "data: [DONE]\n\n"
-                    return
-                except Exception as e:
-                    # 启动失败，记录并尝试下一个
-                    raise e
+        response, coalesced = await self._coalesce(
+            "embeddings", instance_name, request.model_dump(exclude_none=True), call
+        )
+        if coalesced:
+            metadata["coalesced"] = True
+        return response
 
-                # 如果成功获取第一块，说明连接建立，开始输出
-
-                # 处理第一个块
-                if first_chunk:
-                    if "choices" in first_chunk and len(first_chunk["choices"]) > 0:
-                        delta = first_chunk["choices"][0].get("delta", {})
-                        if "content" in delta:
-                            full_content += delta["content"]
-                    if "usage" in first_chunk and first_chunk["usage"]:
-                        usage = first_chunk["usage"]
-                        prompt_tokens = usage.get("prompt_tokens", prompt_tokens)
-                        completion_tokens = usage.get(
-                            "completion_tokens", completion_tokens
-                        )
-                        total_tokens = usage.get(
-                            "total_tokens", prompt_tokens + completion_tokens
-                        )
-                    yield f"data: {json.dumps(first_chunk)}\n\n"
-
-                # 处理后续块
-                async for chunk in stream_gen:
-                    if chunk:
-                        if "choices" in chunk and len(chunk["choices"]) > 0:
-                            delta = chunk["choices"][0].get("delta", {})
-                            if "content" in delta:
-                                full_content += delta["content"]
-                        if "usage" in chunk and chunk["usage"]:
-                            usage = chunk["usage"]
-                            prompt_tokens = usage.get("prompt_tokens", prompt_tokens)
-                            completion_tokens = usage.get(
-                                "completion_tokens", completion_tokens
-                            )
-                            total_tokens = usage.get(
-                                "total_tokens", prompt_tokens + completion_tokens
-                            )
-                        yield f"data: {json.dumps(chunk)}\n\n"
+    async def _cached_embeddings(
+        self,
+        provider: BaseProvider,
+        model: str,
+        instance_name: str,
+        request: EmbeddingsRequest,
+        metadata: Dict[str, Any],
+    ) -> EmbeddingsResponse:
+        """
+        按单条输入查找嵌入向量缓存，只向上游请求未命中 (且去重后) 的输入，
+        再按原始顺序重新组装 data 数组。
+        :param metadata: 日志元数据，记录缓存命中统计 (embedding_cache)
+        """
+        inputs = [request.input] if isinstance(request.input, str) else request.input
+        keys = {
+            text: embedding_cache.key(instance_name, model, request.dimensions, text)
+            for text in inputs
+        }
+        vectors = {}
+        for text, key in keys.items():
+            vector = embedding_cache.get(key)
+            if vector is not None:
+                vectors[text] = vector
+        misses = [text for text in keys if text not in vectors]
+
+        response_id = None
+        response_model = model
+        usage = Usage()
+        if misses:
+            response = await self._fetch_embeddings(
+                provider,
+                model,
+                instance_name,
+                request.model_copy(update={"input": misses}),
+                metadata,
+            )
+            for j, item in enumerate(response.data):
+                text = misses[item.get("index", j)]
+                vectors[text] = pack_vector(item["embedding"])
+                embedding_cache.put(keys[text], vectors[text])
+            if len(vectors) != len(keys):
+                raise ValueError("Upstream returned an incomplete embeddings batch")
+            response_id = response.id
+            response_model = response.model
+            usage = response.usage
+
+        data = [
+            {
+                "object": "embedding",
+                "index": j,
+                "embedding": unpack_vector(vectors[text], request.encoding_format),
+            }
+            for j, text in enumerate(inputs)
+        ]
+        metadata["embedding_cache"] = {
+            "hits": len(keys) - len(misses),
+            "misses": len(misses),
+            "duplicates": len(inputs) - len(keys),
+        }
+        return EmbeddingsResponse(
+            id=response_id, data=data, model=response_model, usage=usage
+        )
 
-                yield "data: [DONE]\n\n"
+    async def chat_stream(
+        self, chat_request: ChatRequest
+    ) -> AsyncGenerator[Union[str, bytes], None]:
+        """
+        处理流式聊天请求。
+        支持自动降级 (仅在流启动失败时重试) 以及 hedge / race 调度 (以首个数据块决出胜者)。
+        OpenAI 兼容提供商默认透传上游原始 SSE 字节，日志信息在流结束后旁路解析。
+        命中响应缓存时，以合成的 SSE 流回放缓存的响应。
+        """
+        self._begin()
+        prompt_json, media_paths = await self._process_messages_for_log(
+            chat_request.messages
+        )
 
-                # 成功完成整个流，记录完整日志
-                latency = time.perf_counter() - start_time
-                await log_request(
+        candidates = await self._candidates(
+            "chat", prompt_json, is_streaming=True, media_path=media_paths
+        )
+        total = len(candidates)
+
+        cached = await self._cache_lookup(candidates, chat_request)
+        if cached is not None:
+            candidate, entry = cached
+            response = RawChatResponse(entry.body, entry.media_type)
+            yield completion_to_sse(response.data)
+            self._log_cache_hit(candidate, response, prompt_json, media_paths, True)
+            return
+
+        async def run(i: int, candidate: Candidate) -> OpenedStream:
+            return await self._open_stream(i, total, candidate, chat_request)
+
+        async def discard(opened: OpenedStream):
+            await self._discard_stream(opened, total)
+
+        try:
+            opened: OpenedStream = await self._dispatch(candidates, run, discard)
+        except Exception as e:
+            await self._log_failure(
+                "chat", prompt_json, e, is_streaming=True, media_path=media_paths
+            )
+            raise
+        except asyncio.CancelledError as e:
+            # 客户端在流建立前断开
+            log_writer.submit(
+                self._log_failure(
+                    "chat", prompt_json, e, is_streaming=True, media_path=media_paths
+                )
+            )
+            raise
+        _, model, instance_name = opened.candidate
+        attempt, tap, stream_gen = opened.attempt, opened.tap, opened.stream
+
+        if opened.first_chunk is None:
+            # 空流？视为成功但无内容
+            attempt.succeed()
+            self._record_attempt(
+                opened.index, instance_name, model, 200, attempt.queued_at
+            )
+            log_writer.submit(
+                self._log(
+                    "chat",
+                    prompt_json,
                     provider=instance_name,
-                    endpoint="chat",
                     model=model,
-                    prompt=prompt_json,
-                    response=full_content,
-                    prompt_tokens=prompt_tokens,
-                    completion_tokens=completion_tokens,
-                    total_tokens=total_tokens,
-                    status_code=status_code,
-                    latency=latency,
-                    ip_address=self.request_ip,
+                    status_code=200,
                     is_streaming=True,
                     media_path=media_paths,
-                    request_model=self._get_request_model(),
+                    metadata=self._log_metadata(attempt=opened.index + 1),
                 )
-                return
-
-            except Exception as e:
-                error_occured = True
-                status_code = getattr(e, "status_code", 500)
-                latency = time.perf_counter() - start_time
-
-                await log_request(
+            )
+            yield DONE_FRAME
+            return
+
+        try:
+            # 连接已建立，开始输出
+            yield opened.first_chunk
+            async for chunk in stream_gen:
+                yield chunk
+            if not tap.saw_done:
+                yield DONE_FRAME
+        except Exception as e:
+            # 流已开始传输，不再降级
+            attempt.fail(e)
+            self._record_attempt(
+                opened.index,
+                instance_name,
+                model,
+                get_status_code(e),
+                attempt.queued_at,
+                f"Attempt {opened.index + 1}/{total} failed: {str(e)}",
+            )
+            log_writer.submit(
+                self._log_failure(
+                    "chat",
+                    prompt_json,
+                    e,
+                    ttft=self._ttft(tap.timer),
+                    is_streaming=True,
+                    media_path=media_paths,
+                    metadata=self._log_metadata(attempt=opened.index + 1),
+                )
+            )
+            raise
+        except BaseException:
+            # 客户端断开 (任务被取消或生成器被关闭): 记录已转发的部分内容
+            attempt.cancel()
+            tap.finish()
+            # 中断的流通常没有用量块，按已转发的内容估算输出 Token 数
+            estimated = not tap.completion_tokens
+            completion_tokens = (
+                estimate_tokens(tap.content) if estimated else tap.completion_tokens
+            )
+            self._record_attempt(
+                opened.index,
+                instance_name,
+                model,
+                499,
+                attempt.queued_at,
+                "Client disconnected",
+            )
+            log_writer.submit(
+                self._log(
+                    "chat",
+                    prompt_json,
                     provider=instance_name,
-                    endpoint="chat",
                     model=model,
-                    prompt=prompt_json,
-                    error=f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
-                    status_code=status_code,
-                    latency=latency,
-                    ip_address=self.request_ip,
+                    response=tap.content,
+                    prompt_tokens=tap.prompt_tokens,
+                    completion_tokens=completion_tokens,
+                    total_tokens=tap.prompt_tokens + completion_tokens,
+                    error="Client disconnected",
+                    status_code=499,
+                    ttft=self._ttft(tap.timer),
+                    request_id=tap.request_id,
+                    is_streaming=True,
                     media_path=media_paths,
-                    request_model=self._get_request_model(),
+                    metadata={
+                        **(
+                            self._log_metadata(
+                                stream=tap.timer.stats(completion_tokens),
+                                attempt=opened.index + 1,
+                            )
+                            or {}
+                        ),
+                        "cancelled": True,
+                        **({"estimated_tokens": True} if estimated else {}),
+                    },
                 )
+            )
+            raise
+        finally:
+            # 关闭上游连接，即使当前任务正在被取消也要完成
+            await asyncio.shield(stream_gen.aclose())
+
+        # 成功完成整个流，解析旁路数据并在后台记录完整日志 (不推迟响应结束)
+        attempt.succeed()
+        tap.finish()
+        self._record_attempt(opened.index, instance_name, model, 200, attempt.queued_at)
+        log_writer.submit(
+            self._log(
+                "chat",
+                prompt_json,
+                provider=instance_name,
+                model=model,
+                response=tap.content,
+                prompt_tokens=tap.prompt_tokens,
+                completion_tokens=tap.completion_tokens,
+                total_tokens=tap.total_tokens,
+                status_code=200,
+                ttft=self._ttft(tap.timer),
+                request_id=tap.request_id,
+                is_streaming=True,
+                media_path=media_paths,
+                metadata=self._log_metadata(
+                    usage=Usage(
+                        cache_read_tokens=tap.cache_read_tokens,
+                        cache_write_tokens=tap.cache_write_tokens,
+                    ),
+                    stream=tap.timer.stats(tap.completion_tokens),
+                    attempt=opened.index + 1,
+                ),
+            )
+        )
 
-                # 如果是最后一个，抛出
-                if i == len(candidates) - 1:
-                    raise
-                # 否则继续下一个循环
-                continue
+    async def _open_stream(
+        self,
+        i: int,
+        total: int,
+        candidate: Candidate,
+        chat_request: ChatRequest,
+    ) -> OpenedStream:
+        """
+        向单个候选项发起流式请求，并等待首个数据块 (用于检测启动错误)。
+        启动失败时记录本次调用并抛出异常。
+        """
+        provider, model, instance_name = candidate
+        request = chat_request.model_copy(update={"model": model})
+        tap = OpenAIStreamTap()
+        start_time = time.perf_counter()
+        attempt: Optional[UpstreamAttempt] = None
+
+        try:
+            attempt = await UpstreamAttempt.start(instance_name, model)
+            # 获取生成器: 同协议直接透传字节，否则编码为 SSE 帧
+            if provider.can_passthrough():
+                stream_gen = tap.relay(provider.stream_raw(request))
+            else:
+                stream_gen = tap.encode(provider.stream(request))
+            # 首个数据块超时视为启动失败，降级到下一个候选项
+            stream_gen = guard_stream(stream_gen, self._deadlines(provider))
+            first_chunk = await anext(stream_gen, None)
+        except asyncio.CancelledError:
+            # hedge / race 落败的请求
+            if attempt is not None:
+                attempt.cancel()
+            self._record_attempt(
+                i,
+                instance_name,
+                model,
+                499,
+                start_time,
+                f"Attempt {i + 1}/{total} cancelled",
+            )
+            raise
+        except Exception as e:
+            if attempt is not None:
+                attempt.fail(e)
+            self._record_attempt(
+                i,
+                instance_name,
+                model,
+                get_status_code(e),
+                start_time,
+                f"Attempt {i + 1}/{total} failed: {str(e)}",
+            )
+            raise
+
+        attempt.mark_first_token()
+        return OpenedStream(i, candidate, attempt, tap, stream_gen, first_chunk)
+
+    async def _discard_stream(self, opened: OpenedStream, total: int):
+        """
+        关闭已建立但未被采用的上游流 (多个候选项几乎同时返回首个数据块时)。
+        """
+        _, model, instance_name = opened.candidate
+        opened.attempt.cancel()
+        await opened.stream.aclose()
+        self._record_attempt(
+            opened.index,
+            instance_name,
+            model,
+            499,
+            opened.attempt.queued_at,
+            f"Attempt {opened.index + 1}/{total} cancelled",
+        )
 
     async def image_gen(self, prompt: str) -> Dict[str, Any]:
         """
         处理图像生成请求。
         支持自动降级。
         """
+        self._begin()
         prompt_json = json.dumps(prompt, ensure_ascii=False)
-        candidates = self._get_candidates()
-        last_exception = None
+        candidates = await self._candidates("image", prompt_json)
 
         for i, (provider, model, instance_name) in enumerate(candidates):
             start_time = time.perf_counter()
             try:
-                response = await provider.image_gen(prompt, model)
-                latency = time.perf_counter() - start_time
+                async with self._attempt(instance_name, model):
+                    response = await provider.image_gen(prompt, model)
 
                 media_filenames = []
                 for item in response.get("data", []):
@@ -408,38 +1295,29 @@ class ProxyService:
                         pass
 
                 # 记录日志
-                await log_request(
+                self._record_attempt(i, instance_name, model, 200, start_time)
+                await self._log(
+                    "image",
+                    prompt_json,
                     provider=instance_name,
-                    endpoint="image",
                     model=model,
-                    prompt=prompt_json,
                     media_path=media_filenames,
                     status_code=200,
-                    latency=latency,
-                    ip_address=self.request_ip,
-                    request_model=self._get_request_model(),
                 )
                 return response
             except Exception as e:
-                last_exception = e
-                latency = time.perf_counter() - start_time
-                status_code = getattr(e, "status_code", 500)
-                await log_request(
-                    provider=instance_name,
-                    endpoint="image",
-                    model=model,
-                    prompt=prompt_json,
-                    error=f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
-                    status_code=status_code,
-                    latency=latency,
-                    ip_address=self.request_ip,
-                    request_model=self._get_request_model(),
+                self._record_attempt(
+                    i,
+                    instance_name,
+                    model,
+                    get_status_code(e),
+                    start_time,
+                    f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
                 )
                 if i == len(candidates) - 1:
+                    await self._log_failure("image", prompt_json, e)
                     raise
 
-        if last_exception:
-            raise last_exception
         raise Exception("No providers available")
 
     async def text_to_speech(self, text: str, voice: str) -> Tuple[bytes, str]:
@@ -447,50 +1325,41 @@ class ProxyService:
         处理文本转语音请求。
         支持自动降级。
         """
+        self._begin()
         prompt_json = json.dumps(text, ensure_ascii=False)
-        candidates = self._get_candidates()
-        last_exception = None
+        candidates = await self._candidates("audio", prompt_json)
 
         for i, (provider, model, instance_name) in enumerate(candidates):
             start_time = time.perf_counter()
             try:
-                content = await provider.text_to_speech(text, model, voice)
-                latency = time.perf_counter() - start_time
+                async with self._attempt(instance_name, model):
+                    content = await provider.text_to_speech(text, model, voice)
                 filename = await save_media(content, "mp3")
+                self._record_attempt(i, instance_name, model, 200, start_time)
 
-                await log_request(
+                await self._log(
+                    "audio",
+                    prompt_json,
                     provider=instance_name,
-                    endpoint="audio",
                     model=model,
-                    prompt=prompt_json,
                     media_path=filename,
                     media_type="audio",
                     status_code=200,
-                    latency=latency,
-                    ip_address=self.request_ip,
-                    request_model=self._get_request_model(),
                 )
                 return content, filename
             except Exception as e:
-                last_exception = e
-                latency = time.perf_counter() - start_time
-                status_code = getattr(e, "status_code", 500)
-                await log_request(
-                    provider=instance_name,
-                    endpoint="audio",
-                    model=model,
-                    prompt=prompt_json,
-                    error=f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
-                    status_code=status_code,
-                    latency=latency,
-                    ip_address=self.request_ip,
-                    request_model=self._get_request_model(),
+                self._record_attempt(
+                    i,
+                    instance_name,
+                    model,
+                    get_status_code(e),
+                    start_time,
+                    f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
                 )
                 if i == len(candidates) - 1:
+                    await self._log_failure("audio", prompt_json, e)
                     raise
 
-        if last_exception:
-            raise last_exception
         raise Exception("No providers available")
 
     async def anthropic_chat(self, body: Dict[str, Any]) -> Any:
@@ -498,16 +1367,22 @@ class ProxyService:
         处理 Anthropic 原生消息请求。
         支持自动降级 (仅限支持 Anthropic 协议的提供商)。
         """
+        self._begin()
         messages = body.get("messages", [])
         prompt_json, media_paths = await self._process_messages_for_log(messages)
 
-        candidates = self._get_candidates()
+        candidates = await self._candidates(
+            "anthropic/messages",
+            prompt_json,
+            is_streaming=bool(body.get("stream")),
+            media_path=media_paths,
+        )
 
         # 如果是流式请求
         if body.get("stream"):
             return self.anthropic_chat_stream(body, prompt_json, media_paths)
 
-        from ..providers.anthropic import AnthropicProvider
+        from ..providers.anthropic import AnthropicProvider, anthropic_usage
 
         last_exception = None
 
@@ -529,71 +1404,72 @@ class ProxyService:
                 # 确保模型字段正确
                 body["model"] = model
 
-                response = await provider.chat_native(body)
-                latency = time.perf_counter() - start_time
+                async with self._attempt(instance_name, model):
+                    async with deadline(self._deadlines(provider).total):
+                        response = await provider.chat_native(body)
 
                 content = ""
                 for block in response.get("content", []):
                     if block["type"] == "text":
                         content += block["text"]
+                usage = anthropic_usage(response.get("usage", {}))
+                self._record_attempt(i, instance_name, model, 200, start_time)
 
-                await log_request(
+                await self._log(
+                    "anthropic/messages",
+                    prompt_json,
                     provider=instance_name,
-                    endpoint="anthropic/messages",
                     model=model,
-                    prompt=prompt_json,
                     response=content,
-                    prompt_tokens=response.get("usage", {}).get("input_tokens", 0),
-                    completion_tokens=response.get("usage", {}).get("output_tokens", 0),
-                    total_tokens=response.get("usage", {}).get("input_tokens", 0)
-                    + response.get("usage", {}).get("output_tokens", 0),
+                    prompt_tokens=usage.prompt_tokens,
+                    completion_tokens=usage.completion_tokens,
+                    total_tokens=usage.total_tokens,
                     status_code=200,
-                    latency=latency,
-                    ip_address=self.request_ip,
                     request_id=response.get("id"),
                     is_streaming=False,
                     media_path=media_paths,
-                    request_model=self._get_request_model(),
+                    metadata=self._log_metadata(usage=usage),
                 )
                 return response
             except Exception as e:
                 last_exception = e
-                latency = time.perf_counter() - start_time
-                status_code = getattr(e, "status_code", 500)
-                await log_request(
-                    provider=instance_name,
-                    endpoint="anthropic/messages",
-                    model=model,
-                    prompt=prompt_json,
-                    error=f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
-                    status_code=status_code,
-                    latency=latency,
-                    ip_address=self.request_ip,
-                    media_path=media_paths,
-                    request_model=self._get_request_model(),
+                self._record_attempt(
+                    i,
+                    instance_name,
+                    model,
+                    get_status_code(e),
+                    start_time,
+                    f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
                 )
                 if i == len(candidates) - 1:
-                    raise
+                    break
 
         if last_exception:
+            await self._log_failure(
+                "anthropic/messages",
+                prompt_json,
+                last_exception,
+                media_path=media_paths,
+            )
             raise last_exception
         raise ValueError("Selected provider does not support Anthropic native format")
 
     async def anthropic_chat_stream(
         self, body: Dict[str, Any], prompt_json: str, media_paths: List[str]
-    ) -> AsyncGenerator[str, None]:
+    ) -> AsyncGenerator[bytes, None]:
         """
         处理 Anthropic 原生流式消息请求。
+        上游事件帧以原始字节转发。
         """
-        candidates = self._get_candidates()
+        candidates = await self._candidates(
+            "anthropic/messages", prompt_json, is_streaming=True, media_path=media_paths
+        )
         from ..providers.anthropic import AnthropicProvider
 
+        last_exception = None
+
         for i, (provider, model, instance_name) in enumerate(candidates):
             start_time = time.perf_counter()
-            full_content = ""
-            input_tokens = 0
-            output_tokens = 0
-            status_code = 200
 
             if not isinstance(provider, AnthropicProvider):
                 if i == len(candidates) - 1 and i == 0:
@@ -602,76 +1478,137 @@ class ProxyService:
                     )
                 continue
 
+            body["model"] = model
+            tap = AnthropicStreamTap()
+            stream_gen = None
+            started = False  # 是否已向客户端转发数据
             try:
-                body["model"] = model
-                stream_gen = provider.stream_native(body)
-
-                # 尝试获取第一块
-                try:
-                    first_line = await stream_gen.__anext__()
-                except StopAsyncIteration:
-                    return
-                except Exception as e:
-                    raise e
+                async with self._attempt(instance_name, model):
+                    stream_gen = guard_stream(
+                        tap.relay(provider.stream_native(body)),
+                        self._deadlines(provider),
+                    )
 
-                # 处理第一行
-                if first_line.startswith("data: "):
-                    data = json.loads(first_line[6:])
-                    if data["type"] == "content_block_delta":
-                        if data["delta"]["type"] == "text_delta":
-                            full_content += data["delta"]["text"]
-                    elif data["type"] == "message_start":
-                        input_tokens = data["message"]["usage"]["input_tokens"]
-                    elif data["type"] == "message_delta":
-                        output_tokens = data["usage"]["output_tokens"]
-                yield first_line + "\n"
-
-                async for line in stream_gen:
-                    # 解析内容用于记录日志
-                    if line.startswith("data: "):
-                        data = json.loads(line[6:])
-                        if data["type"] == "content_block_delta":
-                            if data["delta"]["type"] == "text_delta":
-                                full_content += data["delta"]["text"]
-                        elif data["type"] == "message_start":
-                            input_tokens = data["message"]["usage"]["input_tokens"]
-                        elif data["type"] == "message_delta":
-                            output_tokens = data["usage"]["output_tokens"]
-                    yield line + "\n"
-
-                # 成功
-                await log_request(
-                    provider=instance_name,
-                    endpoint="anthropic/messages",
-                    model=model,
-                    prompt=prompt_json,
-                    response=full_content,
-                    prompt_tokens=input_tokens,
-                    completion_tokens=output_tokens,
-                    total_tokens=input_tokens + output_tokens,
-                    status_code=status_code,
-                    latency=time.perf_counter() - start_time,
-                    ip_address=self.request_ip,
-                    is_streaming=True,
-                    media_path=media_paths,
-                    request_model=self._get_request_model(),
+                    # 尝试获取第一块
+                    first_chunk = await anext(stream_gen, None)
+                    if first_chunk is not None:
+                        # 原样转发上游事件帧，日志信息在流结束后旁路解析
+                        started = True
+                        yield first_chunk
+                        async for chunk in stream_gen:
+                            yield chunk
+
+                # 成功 (或空流)，在后台记录日志 (不推迟响应结束)
+                tap.finish()
+                self._record_attempt(i, instance_name, model, 200, start_time)
+                log_writer.submit(
+                    self._log(
+                        "anthropic/messages",
+                        prompt_json,
+                        provider=instance_name,
+                        model=model,
+                        response=tap.content,
+                        prompt_tokens=tap.prompt_tokens,
+                        completion_tokens=tap.output_tokens,
+                        total_tokens=tap.prompt_tokens + tap.output_tokens,
+                        status_code=200,
+                        ttft=self._ttft(tap.timer),
+                        request_id=tap.request_id,
+                        is_streaming=True,
+                        media_path=media_paths,
+                        metadata=self._log_metadata(
+                            usage=Usage(
+                                cache_read_tokens=tap.cache_read_tokens,
+                                cache_write_tokens=tap.cache_write_tokens,
+                            ),
+                            stream=tap.timer.stats(tap.output_tokens),
+                        ),
+                    )
                 )
                 return
 
             except Exception as e:
-                status_code = getattr(e, "status_code", 500)
-                await log_request(
-                    provider=instance_name,
-                    endpoint="anthropic/messages",
-                    model=model,
-                    prompt=prompt_json,
-                    error=f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
-                    status_code=status_code,
-                    latency=time.perf_counter() - start_time,
-                    ip_address=self.request_ip,
-                    media_path=media_paths,
-                    request_model=self._get_request_model(),
+                last_exception = e
+                self._record_attempt(
+                    i,
+                    instance_name,
+                    model,
+                    get_status_code(e),
+                    start_time,
+                    f"Attempt {i + 1}/{len(candidates)} failed: {str(e)}",
                 )
-                if i == len(candidates) - 1:
+                if started or i == len(candidates) - 1:
+                    # 流已开始传输 (如相邻数据块超时) 时不再降级，记录已转发的部分内容并结束响应
+                    tap.finish()
+                    log_writer.submit(
+                        self._log_failure(
+                            "anthropic/messages",
+                            prompt_json,
+                            e,
+                            response=tap.content or None,
+                            ttft=self._ttft(tap.timer),
+                            request_id=tap.request_id,
+                            is_streaming=True,
+                            media_path=media_paths,
+                        )
+                    )
                     raise
                 continue
+
+            except BaseException:
+                # 客户端断开: 记录已转发的部分内容
+                tap.finish()
+                # message_start 中的 output_tokens 只是初始值，按已转发的内容估算
+                estimated = estimate_tokens(tap.content) > tap.output_tokens
+                output_tokens = (
+                    estimate_tokens(tap.content) if estimated else tap.output_tokens
+                )
+                self._record_attempt(
+                    i, instance_name, model, 499, start_time, "Client disconnected"
+                )
+                log_writer.submit(
+                    self._log(
+                        "anthropic/messages",
+                        prompt_json,
+                        provider=instance_name,
+                        model=model,
+                        response=tap.content,
+                        prompt_tokens=tap.prompt_tokens,
+                        completion_tokens=output_tokens,
+                        total_tokens=tap.prompt_tokens + output_tokens,
+                        error="Client disconnected",
+                        status_code=499,
+                        ttft=self._ttft(tap.timer),
+                        request_id=tap.request_id,
+                        is_streaming=True,
+                        media_path=media_paths,
+                        metadata={
+                            **(
+                                self._log_metadata(
+                                    stream=tap.timer.stats(output_tokens)
+                                )
+                                or {}
+                            ),
+                            "cancelled": True,
+                            **({"estimated_tokens": True} if estimated else {}),
+                        },
+                    )
+                )
+                raise
+
+            finally:
+                # 关闭上游连接，即使当前任务正在被取消也要完成
+                if stream_gen is not None:
+                    await asyncio.shield(stream_gen.aclose())
+
+        if last_exception:
+            log_writer.submit(
+                self._log_failure(
+                    "anthropic/messages",
+                    prompt_json,
+                    last_exception,
+                    is_streaming=True,
+                    media_path=media_paths,
+                )
+            )
+            raise last_exception
@@ -0,0 +1,259 @@
+"""
+分析数据的预聚合 (rollup)。
+日志写入器在写入日志的同一事务内，将每批日志按分钟、小时与天累加到汇总表 (RollupMinute / RollupHour / RollupDay)，
+分析与统计接口读取汇总表，不再每次扫描原始日志。
+- 汇总维度: 时间段、提供商、模型、端点与状态码。
+- 汇总指标: 请求数、上游调用次数、Token 数、耗时之和，以及耗时、首个数据块延迟与输出速度的直方图。
+删除日志时在同一事务内从汇总表中减去这些日志；汇总表为空而已有日志时 (升级后首次启动) 从原始日志回填。
+时间段按日志时间戳 (带时区) 划分；按分钟汇总的数据超过保留天数后清理。
+"""
+
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+from tortoise import timezone
+from tortoise.expressions import F
+from tortoise.queryset import QuerySet
+from tortoise.transactions import in_transaction
+from ..config import settings
+from ..models import RequestLog, Rollup, RollupMinute, RollupHour, RollupDay
+
+# 请求耗时 (秒) 分布区间
+LATENCY_BINS = {
+    "0-0.5s": (0, 0.5),
+    "0.5-1s": (0.5, 1),
+    "1-2s": (1, 2),
+    "2-5s": (2, 5),
+    "5s+": (5, 9999),
+}
+# 流式响应的首个数据块延迟 (秒) 分布区间
+TTFT_BINS = {
+    "0-0.5s": (0, 0.5),
+    "0.5-1s": (0.5, 1),
+    "1-2s": (1, 2),
+    "2-5s": (2, 5),
+    "5s+": (5, 9999),
+}
+# 流式响应的输出速度 (Token/秒) 分布区间
+THROUGHPUT_BINS = {
+    "0-10": (0, 10),
+    "10-30": (10, 30),
+    "30-60": (30, 60),
+    "60-100": (60, 100),
+    "100+": (100, 1e9),
+}
+# 直方图名称 -> 区间 (第 i 个区间对应汇总表的 {名称}_hist_{i} 列)
+HISTOGRAMS = {
+    "latency": LATENCY_BINS,
+    "ttft": TTFT_BINS,
+    "throughput": THROUGHPUT_BINS,
+}
+
+# 汇总表 (按时间段)
+ROLLUPS: Dict[str, Type[Rollup]] = {
+    "minute": RollupMinute,
+    "hour": RollupHour,
+    "day": RollupDay,
+}
+# 汇总表的唯一键
+KEY_FIELDS = ("bucket", "provider", "model", "endpoint", "status_code")
+# 累加时读取的日志字段
+LOG_FIELDS = (
+    "timestamp",
+    "provider",
+    "model",
+    "endpoint",
+    "status_code",
+    "attempt_count",
+    "prompt_tokens",
+    "completion_tokens",
+    "total_tokens",
+    "latency",
+    "ttft",
+    "is_streaming",
+)
+# 回填与删除时每次读取的日志条数
+CHUNK_SIZE = 5000
+# 清理过期的按分钟汇总数据的最短间隔 (秒)
+PRUNE_INTERVAL = 3600.0
+
+Deltas = Dict[Tuple[str, tuple], Dict[str, float]]
+
+
+def histogram_columns(name: str) -> List[str]:
+    """
+    直方图各区间对应的列名 (与区间定义的顺序一致)。
+    """
+    return [f"{name}_hist_{i}" for i in range(len(HISTOGRAMS[name]))]
+
+
+def throughput(log: Dict[str, Any]) -> Optional[float]:
+    """
+    首个数据块之后的输出速度 (Token/秒)，没有生成时间的请求返回 None。
+    """
+    ttft = log["ttft"]
+    if ttft is None or log["latency"] <= ttft:
+        return None
+    return log["completion_tokens"] / (log["latency"] - ttft)
+
+
+def _observe(metrics: Dict[str, float], name: str, value: float):
+    for column, (lower, upper) in zip(
+        histogram_columns(name), HISTOGRAMS[name].values()
+    ):
+        if lower <= value < upper:
+            metrics[column] = 1
+            return
+
+
+def _metrics(log: Dict[str, Any]) -> Dict[str, float]:
+    """
+    一条日志对汇总表各列的贡献。
+    """
+    metrics = {
+        "requests": 1,
+        "attempts": log["attempt_count"],
+        "retried": int(log["attempt_count"] > 1),
+        "prompt_tokens": log["prompt_tokens"],
+        "completion_tokens": log["completion_tokens"],
+        "total_tokens": log["total_tokens"],
+        "latency_sum": log["latency"],
+    }
+    _observe(metrics, "latency", log["latency"])
+    if log["is_streaming"] and log["ttft"] is not None:
+        metrics["streams"] = 1
+        metrics["ttft_sum"] = log["ttft"]
+        _observe(metrics, "ttft", log["ttft"])
+        speed = throughput(log)
+        if speed is not None:
+            metrics["throughput_count"] = 1
+            metrics["throughput_sum"] = speed
+            _observe(metrics, "throughput", speed)
+    return metrics
+
+
+def _buckets(log: Dict[str, Any]) -> Dict[str, datetime]:
+    """
+    日志所属的各时间段的起始时间 (与时间戳的时区一致)。
+    """
+    timestamp = log["timestamp"]
+    return {
+        "minute": timestamp.replace(second=0, microsecond=0),
+        "hour": timestamp.replace(minute=0, second=0, microsecond=0),
+        "day": timestamp.replace(hour=0, minute=0, second=0, microsecond=0),
+    }
+
+
+def log_deltas(logs: Iterable[Dict[str, Any]], sign: int = 1) -> Deltas:
+    """
+    将一批日志合并为汇总表的增量。
+    :param sign: 1 表示累加，-1 表示减去 (删除日志时)
+    :return: (时间段, 唯一键) -> 各列的增量
+    """
+    deltas: Deltas = {}
+    for log in logs:
+        metrics = _metrics(log)
+        dimensions = (
+            log["provider"],
+            log["model"],
+            log["endpoint"],
+            log["status_code"],
+        )
+        for period, bucket in _buckets(log).items():
+            delta = deltas.setdefault((period, (bucket, *dimensions)), {})
+            for column, value in metrics.items():
+                delta[column] = delta.get(column, 0) + sign * value
+    return deltas
+
+
+async def apply_deltas(deltas: Deltas, conn):
+    """
+    将增量写入汇总表 (在写连接的事务内调用)。
+    写入都通过写连接串行执行，更新不到已有行时直接创建，不会与其他写入冲突。
+    """
+    for (period, key), delta in deltas.items():
+        model = ROLLUPS[period]
+        where = dict(zip(KEY_FIELDS, key))
+        updated = (
+            await model.filter(**where)
+            .using_db(conn)
+            .update(**{column: F(column) + value for column, value in delta.items()})
+        )
+        if not updated:
+            await model.create(
+                using_db=conn, **where, hour=where["bucket"].hour, **delta
+            )
+
+
+class MinutePruner:
+    """
+    清理超过保留天数 (log_writer.minute_rollup_retention) 的按分钟汇总数据。
+    按分钟汇总的行数随时间线性增长，分析接口最多查询 90 天，更早的数据不再需要。
+    在日志写入的事务内调用，每 PRUNE_INTERVAL 秒最多执行一次。
+    """
+
+    def __init__(self):
+        self._last: Optional[float] = None  # 上次清理的时间 (monotonic)
+
+    async def maybe_prune(self, conn) -> int:
+        retention = settings.log_writer.minute_rollup_retention
+        now = time.monotonic()
+        if retention <= 0 or (
+            self._last is not None and now - self._last < PRUNE_INTERVAL
+        ):
+            return 0
+        self._last = now
+        cutoff = timezone.now() - timedelta(days=retention)
+        return await RollupMinute.filter(bucket__lt=cutoff).using_db(conn).delete()
+
+
+# 全局按分钟汇总数据清理器
+minute_pruner = MinutePruner()
+
+
+async def _apply_query(query: QuerySet, conn, sign: int) -> int:
+    """
+    按 ID 分块读取查询匹配的日志，累加到 (或减去自) 汇总表。
+    :return: 处理的日志条数
+    """
+    last_id, total = 0, 0
+    while True:
+        rows = (
+            await query.filter(id__gt=last_id)
+            .using_db(conn)
+            .order_by("id")
+            .limit(CHUNK_SIZE)
+            .values("id", *LOG_FIELDS)
+        )
+        if not rows:
+            return total
+        await apply_deltas(log_deltas(rows, sign), conn)
+        last_id = rows[-1]["id"]
+        total += len(rows)
+
+
+async def backfill() -> int:
+    """
+    汇总表为空而已有日志时 (升级后首次启动) 从原始日志回填汇总表。
+    在日志写入器启动之前调用，回填在一个事务内完成。
+    :return: 回填的日志条数
+    """
+    if await RollupDay.exists() or not await RequestLog.exists():
+        return 0
+    async with in_transaction("default") as conn:
+        count = await _apply_query(RequestLog.all(), conn, 1)
+    print(f"已从 {count} 条日志回填分析汇总表")
+    return count
+
+
+async def delete_logs(query: QuerySet) -> int:
+    """
+    删除查询匹配的日志，并在同一事务内从汇总表中减去这些日志 (期间日志写入等待事务完成)。
+    :return: 删除的日志条数
+    """
+    async with in_transaction("default") as conn:
+        count = await _apply_query(query, conn, -1)
+        await query.using_db(conn).delete()
+        for model in ROLLUPS.values():
+            await model.filter(requests__lte=0).using_db(conn).delete()
+    return count
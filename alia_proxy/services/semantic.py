@@ -0,0 +1,326 @@
+"""
+语义响应缓存。
+将聊天请求最近的消息窗口向量化，在同一命名空间 (请求模型、系统提示与其余请求参数相同) 内
+按余弦相似度查找最相近的已缓存请求，相似度超过映射配置的阈值时直接返回缓存的响应。
+向量保存在归一化的 NumPy 矩阵中，容量有上限并按 LRU 淘汰；可选持久化到 data/ 下的内存映射文件。
+NumPy 为可选依赖 (pip install numpy)，未安装时语义缓存自动禁用。
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+from ..config import settings, SemanticCacheConfig
+
+try:
+    import numpy as np
+except ImportError:  # 可选依赖
+    np = None
+
+# 每写入多少条缓存后保存一次条目元数据 (向量直接写入内存映射文件)
+SAVE_INTERVAL = 64
+
+
+class SemanticEntry(NamedTuple):
+    """
+    语义缓存中的一条响应。
+    """
+
+    body: bytes  # 响应体
+    media_type: str  # 响应的 Content-Type
+    expires_at: float  # 过期时间 (time.time，持久化后需要跨进程有效)
+    instance_name: str  # 产生该响应的提供商实例
+    model: str  # 产生该响应的模型
+
+
+class SemanticQuery(NamedTuple):
+    """
+    一次语义缓存查询: 命名空间、归一化的查询向量与相似度阈值。
+    """
+
+    namespace: int
+    vector: Any  # np.ndarray (float32)
+    threshold: float
+
+
+def _message_text(content: Any) -> Optional[str]:
+    """
+    提取消息的文本内容。包含非文本部分 (如图片) 的消息无法按文本比较，返回 None。
+    """
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    parts = []
+    for part in content:
+        if part.get("type") != "text":
+            return None
+        parts.append(part.get("text", ""))
+    return "\n".join(parts)
+
+
+def query_text(messages: List[Any], window: int) -> Optional[str]:
+    """
+    取最近 window 条非系统消息作为向量化的文本。
+    最后一条消息不是用户消息，或窗口内包含非文本内容时返回 None (不使用语义缓存)。
+    """
+    turns = [m for m in messages if m.role != "system"][-max(window, 1) :]
+    if not turns or turns[-1].role != "user":
+        return None
+    texts = []
+    for message in turns:
+        text = _message_text(message.content)
+        if text is None or message.tool_calls:
+            return None
+        texts.append(text if len(turns) == 1 else f"{message.role}: {text}")
+    return "\n".join(texts)
+
+
+def namespace(request_model: str, body: Dict[str, Any]) -> int:
+    """
+    根据请求的模型名与除消息窗口外的规范化请求体 (含系统提示) 计算命名空间。
+    只有命名空间相同的请求才会比较相似度。
+    """
+    canonical = json.dumps(
+        [request_model, body],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=str,
+    )
+    digest = hashlib.sha256(canonical.encode()).digest()
+    return int.from_bytes(digest[:8], "little", signed=True)
+
+
+def normalize(embedding: List[float]) -> Any:
+    """
+    将嵌入向量转换为 L2 归一化的 float32 数组 (归一化后点积即余弦相似度)。
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    if norm == 0.0:
+        return None
+    return vector / norm
+
+
+class SemanticCache:
+    """
+    语义缓存索引。所有查询与写入都在事件循环内完成，无需加锁。
+    每个槽位对应矩阵中的一行；_last_used 为 0 的槽位为空。
+    """
+
+    def __init__(self):
+        self._vectors: Any = None  # (capacity, dim) float32，持久化时为 np.memmap
+        self._namespaces: Any = None  # (capacity,) int64
+        self._expires: Any = None  # (capacity,) float64
+        self._last_used: Any = None  # (capacity,) int64，LRU 时钟
+        self._entries: Dict[int, SemanticEntry] = {}  # 槽位 -> 响应
+        self._clock = 0
+        self._loaded = False
+        self._warned = False
+        self._writes = 0
+        self._tasks: Set[asyncio.Task] = set()  # 后台保存任务 (保持引用防止被回收)
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0  # 查询向量化失败次数
+
+    @property
+    def config(self) -> SemanticCacheConfig:
+        return settings.semantic_cache
+
+    @property
+    def enabled(self) -> bool:
+        if not self.config.enabled or not self.config.embedding_model:
+            return False
+        if np is None:
+            if not self._warned:
+                print("未安装 numpy，语义缓存已禁用 (pip install numpy)")
+                self._warned = True
+            return False
+        return True
+
+    def _paths(self) -> Tuple[str, str]:
+        index_dir = self.config.index_dir
+        return (
+            os.path.join(index_dir, "vectors.npy"),
+            os.path.join(index_dir, "entries.json"),
+        )
+
+    def _allocate(self, dim: int):
+        """
+        按当前容量与向量维度分配 (或重建) 索引，原有条目全部丢弃。
+        """
+        capacity = self.config.max_entries
+        if self.config.persist:
+            vectors_path, _ = self._paths()
+            os.makedirs(os.path.dirname(vectors_path), exist_ok=True)
+            self._vectors = np.lib.format.open_memmap(
+                vectors_path, mode="w+", dtype=np.float32, shape=(capacity, dim)
+            )
+        else:
+            self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._namespaces = np.zeros(capacity, dtype=np.int64)
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._last_used = np.zeros(capacity, dtype=np.int64)
+        self._entries.clear()
+
+    def _load(self):
+        """
+        首次使用时从内存映射文件与条目元数据恢复索引。文件损坏或容量变化时忽略。
+        """
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.config.persist:
+            return
+        vectors_path, entries_path = self._paths()
+        try:
+            vectors = np.load(vectors_path, mmap_mode="r+")
+            with open(entries_path, encoding="utf-8") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        capacity = self.config.max_entries
+        if vectors.ndim != 2 or vectors.shape[0] != capacity:
+            return
+
+        self._vectors = vectors
+        self._namespaces = np.zeros(capacity, dtype=np.int64)
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._last_used = np.zeros(capacity, dtype=np.int64)
+        now = time.time()
+        for item in saved:
+            slot = item["slot"]
+            if item["expires_at"] <= now or not 0 <= slot < capacity:
+                continue
+            self._entries[slot] = SemanticEntry(
+                base64.b64decode(item["body"]),
+                item["media_type"],
+                item["expires_at"],
+                item["instance_name"],
+                item["model"],
+            )
+            self._namespaces[slot] = item["namespace"]
+            self._expires[slot] = item["expires_at"]
+            self._clock += 1
+            self._last_used[slot] = item.get("last_used") or self._clock
+        self._clock = int(self._last_used.max(initial=0))
+
+    def _compatible(self, dim: int) -> bool:
+        return (
+            self._vectors is not None
+            and self._vectors.shape[0] == self.config.max_entries
+            and self._vectors.shape[1] == dim
+        )
+
+    def get(self, query: SemanticQuery) -> Optional[Tuple[SemanticEntry, float]]:
+        """
+        查找同一命名空间内相似度最高且未过期的条目。
+        :return: (缓存的响应, 相似度)，未命中时返回 None
+        """
+        self._load()
+        if not self._entries or not self._compatible(query.vector.shape[0]):
+            self.misses += 1
+            return None
+
+        slots = np.flatnonzero(
+            (self._namespaces == query.namespace)
+            & (self._expires > time.time())
+            & (self._last_used > 0)
+        )
+        if slots.size == 0:
+            self.misses += 1
+            return None
+        scores = self._vectors[slots] @ query.vector
+        best = int(np.argmax(scores))
+        similarity = float(scores[best])
+        if similarity < query.threshold:
+            self.misses += 1
+            return None
+
+        slot = int(slots[best])
+        self._clock += 1
+        self._last_used[slot] = self._clock
+        self.hits += 1
+        return self._entries[slot], similarity
+
+    def put(self, query: SemanticQuery, entry: SemanticEntry):
+        """
+        写入一条响应。优先使用空槽位或已过期的槽位，否则淘汰最久未使用的条目。
+        """
+        self._load()
+        if not self._compatible(query.vector.shape[0]):
+            self._allocate(query.vector.shape[0])
+
+        # 空槽位与过期槽位排在最前，其余按最近使用时间排序
+        order = np.where(self._expires > time.time(), self._last_used, -1)
+        slot = int(np.argmin(order))
+        self._vectors[slot] = query.vector
+        self._namespaces[slot] = query.namespace
+        self._expires[slot] = entry.expires_at
+        self._clock += 1
+        self._last_used[slot] = self._clock
+        self._entries[slot] = entry
+
+        if self.config.persist:
+            self._writes += 1
+            if self._writes >= SAVE_INTERVAL:
+                self._writes = 0
+                task = asyncio.create_task(self.save())
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def save(self):
+        """
+        保存条目元数据并刷新内存映射文件。
+        """
+        if not self.config.persist or self._vectors is None:
+            return
+        items = [
+            {
+                "slot": slot,
+                "namespace": int(self._namespaces[slot]),
+                "last_used": int(self._last_used[slot]),
+                "expires_at": entry.expires_at,
+                "media_type": entry.media_type,
+                "instance_name": entry.instance_name,
+                "model": entry.model,
+                "body": base64.b64encode(entry.body).decode(),
+            }
+            for slot, entry in self._entries.items()
+        ]
+        try:
+            await asyncio.to_thread(self._write, items)
+        except OSError:
+            return
+
+    def _write(self, items: List[Dict[str, Any]]):
+        self._vectors.flush()
+        _, entries_path = self._paths()
+        # 先写临时文件再替换，避免重启时读取到不完整的内容
+        tmp_path = f"{entries_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(items, f)
+        os.replace(tmp_path, entries_path)
+
+    def clear(self):
+        self._vectors = None
+        self._entries.clear()
+        self._loaded = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "dim": self._vectors.shape[1] if self._vectors is not None else None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+# 全局语义缓存
+semantic_cache = SemanticCache()
@@ -0,0 +1,350 @@
+"""
+SSE 流旁路解析。
+透传上游字节时仅做缓存，在流结束后再提取日志所需的内容与用量，避免在每个数据块上进行 JSON 编解码。
+"""
+
+import json
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
+
+DONE_FRAME = "data: [DONE]\n\n"
+# 估算 Token 数时每个 Token 对应的字符数
+CHARS_PER_TOKEN = 4
+
+
+def iter_sse_data(raw: bytes) -> List[str]:
+    """
+    从原始 SSE 字节中提取所有 data 字段的内容。
+    """
+    payloads = []
+    for line in raw.decode("utf-8", errors="replace").splitlines():
+        if line.startswith("data:"):
+            payloads.append(line[5:].lstrip(" "))
+    return payloads
+
+
+def iter_sse_events(raw: bytes) -> List[Tuple[Optional[str], str]]:
+    """
+    将原始 SSE 字节拆分为 (事件名, data 内容) 列表。
+    """
+    events = []
+    for block in (
+        raw.decode("utf-8", errors="replace").replace("\r\n", "\n").split("\n\n")
+    ):
+        event = None
+        data_lines = []
+        for line in block.split("\n"):
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data_lines.append(line[5:].lstrip(" "))
+        if data_lines:
+            events.append((event, "\n".join(data_lines)))
+    return events
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    按字符数粗略估算 Token 数 (用于上游未返回用量的中断流)。
+    """
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def completion_to_sse(data: Dict[str, Any]) -> str:
+    """
+    将完整的聊天完成响应转换为等价的 SSE 流 (用于回放缓存的响应)。
+    每个选项依次输出内容增量与结束原因，最后输出用量与 [DONE] 标记。
+    """
+    base = {
+        "id": data.get("id"),
+        "object": "chat.completion.chunk",
+        "created": data.get("created"),
+        "model": data.get("model"),
+    }
+    if data.get("system_fingerprint"):
+        base["system_fingerprint"] = data["system_fingerprint"]
+
+    frames = []
+    for choice in data.get("choices") or []:
+        message = choice.get("message") or {}
+        delta: Dict[str, Any] = {"role": message.get("role", "assistant")}
+        if message.get("content") is not None:
+            delta["content"] = message["content"]
+        if message.get("tool_calls"):
+            delta["tool_calls"] = [
+                {"index": i, **call} for i, call in enumerate(message["tool_calls"])
+            ]
+        index = choice.get("index", 0)
+        for chunk_choice in (
+            {"index": index, "delta": delta, "finish_reason": None},
+            {"index": index, "delta": {}, "finish_reason": choice.get("finish_reason")},
+        ):
+            frames.append({**base, "choices": [chunk_choice]})
+    if data.get("usage"):
+        frames.append({**base, "choices": [], "usage": data["usage"]})
+
+    return "".join(f"data: {json.dumps(f)}\n\n" for f in frames) + DONE_FRAME
+
+
+class ChunkTimer:
+    """
+    流式响应的分块计时: 首个数据块延迟 (TTFT)、数据块数量与相邻数据块的间隔。
+    数据块指一个完整的 SSE 事件: 编码模式下每个数据块调用一次 tick()，
+    透传模式下由 feed() 按事件边界 (空行) 计数，与网络读取的分片方式无关。
+    计时从创建时开始 (即该次上游调用开始时，包含排队时间)；
+    请求日志中的 ttft 按逻辑请求的开始时间计算，包含此前失败的调用。
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first: Optional[float] = None  # 首个数据块到达时间
+        self.last: Optional[float] = None  # 最后一个数据块到达时间
+        self.gaps: List[float] = []  # 相邻数据块的间隔
+        self._tail = b""  # 上一次读取的末尾字节 (检测跨读取的事件边界)
+
+    def tick(self):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        else:
+            self.gaps.append(now - self.last)
+        self.last = now
+
+    def feed(self, data: bytes):
+        """
+        记录一次网络读取，为其中结束的每个 SSE 事件调用一次 tick()。
+        同一次读取中结束的多个事件到达时间相同。
+        """
+        window = self._tail + data
+        events = window.count(b"\n\n") + window.count(b"\n\r\n")
+        events -= self._tail.count(b"\n\n")
+        self._tail = window[-2:]
+        for _ in range(events):
+            self.tick()
+
+    @property
+    def ttft(self) -> Optional[float]:
+        return self.first - self.start if self.first is not None else None
+
+    @property
+    def chunks(self) -> int:
+        return len(self.gaps) + (1 if self.first is not None else 0)
+
+    def stats(self, completion_tokens: int = 0) -> Optional[Dict[str, Any]]:
+        """
+        汇总统计 (写入日志的 metadata)。没有收到任何数据块时返回 None。
+        tokens_per_second 按首个数据块之后的生成时间计算。
+        """
+        if self.first is None:
+            return None
+        stream_time = self.last - self.first
+        stats: Dict[str, Any] = {
+            "ttft": round(self.ttft, 4),
+            "stream_time": round(stream_time, 4),
+            "chunks": self.chunks,
+        }
+        if self.gaps:
+            gaps = sorted(self.gaps)
+            stats["gap_mean"] = round(sum(gaps) / len(gaps), 4)
+            stats["gap_max"] = round(gaps[-1], 4)
+            stats["gap_p95"] = round(gaps[min(int(len(gaps) * 0.95), len(gaps) - 1)], 4)
+        if completion_tokens and stream_time > 0:
+            stats["tokens_per_second"] = round(completion_tokens / stream_time, 2)
+        return stats
+
+
+class OpenAIStreamTap:
+    """
+    OpenAI 流式响应的旁路解析器。
+    - relay: 原样转发上游 SSE 字节，只在内存中保留一份副本。
+    - encode: 将提供商转换后的数据块编码为 SSE 帧 (协议转换场景)。
+    两种模式结束后都可通过 finish() 获得完整内容与 Token 用量。
+    透传模式的副本保留到 finish() 为止，内存占用与响应大小成正比 (每个进行中的流一份)。
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self.timer = ChunkTimer()
+        self.content = ""
+        self.request_id: Optional[str] = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.cache_read_tokens: Optional[int] = None
+        self.cache_write_tokens: Optional[int] = None
+
+    async def relay(
+        self, stream_gen: AsyncGenerator[bytes, None]
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        透传上游原始字节。
+        """
+        async for chunk in stream_gen:
+            self.timer.feed(chunk)
+            self._chunks.append(chunk)
+            yield chunk
+
+    async def encode(
+        self, stream_gen: AsyncGenerator[Dict[str, Any], None]
+    ) -> AsyncGenerator[str, None]:
+        """
+        将数据块编码为 SSE 帧，同时累积日志信息。
+        """
+        async for chunk in stream_gen:
+            if chunk:
+                self.timer.tick()
+                self._add_chunk(chunk)
+                yield f"data: {json.dumps(chunk)}\n\n"
+
+    @property
+    def saw_done(self) -> bool:
+        """
+        上游是否已经发送了 [DONE] 结束标记 (与 finish() 相同地解析 data 字段，冒号后的空格可省略)。
+        """
+        tail = b"".join(self._chunks[-2:])
+        return "[DONE]" in iter_sse_data(tail)
+
+    def finish(self):
+        """
+        解析缓存的原始字节，提取内容与用量。
+        """
+        if not self._chunks:
+            return
+        raw = b"".join(self._chunks)
+        self._chunks = []
+        for data_str in iter_sse_data(raw):
+            if data_str == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data_str)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(chunk, dict):
+                self._add_chunk(chunk)
+
+    def _add_chunk(self, chunk: Dict[str, Any]):
+        """
+        累积单个数据块中的内容与用量。
+        """
+        if self.request_id is None:
+            self.request_id = chunk.get("id")
+        if "choices" in chunk and len(chunk["choices"]) > 0:
+            delta = chunk["choices"][0].get("delta") or {}
+            if delta.get("content"):
+                self.content += delta["content"]
+        if "usage" in chunk and chunk["usage"]:
+            usage = chunk["usage"]
+            self.prompt_tokens = usage.get("prompt_tokens", self.prompt_tokens)
+            self.completion_tokens = usage.get(
+                "completion_tokens", self.completion_tokens
+            )
+            # 提供商附带的缓存 Token 数只用于日志，读取后移除，不发送给客户端
+            self.cache_read_tokens = usage.pop(
+                "cache_read_tokens", self.cache_read_tokens
+            )
+            self.cache_write_tokens = usage.pop(
+                "cache_write_tokens", self.cache_write_tokens
+            )
+            self.total_tokens = usage.get(
+                "total_tokens", self.prompt_tokens + self.completion_tokens
+            )
+
+
+class AnthropicStreamTap:
+    """
+    Anthropic 原生消息流的旁路解析器。
+    原样转发上游字节，流结束后按事件类型嗅探，仅完整解码
+    message_start、message_delta 与文本增量事件，其余事件 (如工具参数增量) 直接跳过。
+    原始字节保留到 finish() 为止，内存占用与响应大小成正比。
+    """
+
+    # 需要解码的事件类型
+    _DECODED_EVENTS = {"message_start", "message_delta", "content_block_delta"}
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self.timer = ChunkTimer()
+        self.content = ""
+        self.request_id: Optional[str] = None
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens: Optional[int] = None
+        self.cache_write_tokens: Optional[int] = None
+
+    async def relay(
+        self, stream_gen: AsyncGenerator[bytes, None]
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        透传上游原始字节。
+        """
+        async for chunk in stream_gen:
+            self.timer.feed(chunk)
+            self._chunks.append(chunk)
+            yield chunk
+
+    def finish(self):
+        """
+        解析缓存的原始字节，提取文本内容与用量。
+        """
+        if not self._chunks:
+            return
+        raw = b"".join(self._chunks)
+        self._chunks = []
+        for event, data_str in iter_sse_events(raw):
+            if event is None:
+                event = self._sniff_event(data_str)
+            if event not in self._DECODED_EVENTS:
+                continue
+            # 内容增量只解码文本，跳过 input_json_delta 等
+            if event == "content_block_delta" and '"text_delta"' not in data_str:
+                continue
+            try:
+                data = json.loads(data_str)
+            except json.JSONDecodeError:
+                continue
+            self._add_event(event, data)
+
+    @property
+    def prompt_tokens(self) -> int:
+        """
+        提示词 Token 数 (input_tokens 不含缓存部分，需加上缓存读写的 Token 数)。
+        """
+        return (
+            self.input_tokens
+            + (self.cache_read_tokens or 0)
+            + (self.cache_write_tokens or 0)
+        )
+
+    @staticmethod
+    def _sniff_event(data_str: str) -> Optional[str]:
+        """
+        在缺少 event 行时，从 data 内容的 type 字段嗅探事件类型 (不做完整解析)。
+        """
+        marker = data_str.find('"type"')
+        if marker == -1:
+            return None
+        start = data_str.find('"', data_str.find(":", marker) + 1)
+        end = data_str.find('"', start + 1)
+        if start == -1 or end == -1:
+            return None
+        return data_str[start + 1 : end]
+
+    def _add_event(self, event: str, data: Dict[str, Any]):
+        """
+        累积单个事件中的内容与用量。
+        """
+        if event == "message_start":
+            message = data.get("message") or {}
+            self.request_id = message.get("id")
+            usage = message.get("usage") or {}
+            self.input_tokens = usage.get("input_tokens", 0)
+            self.output_tokens = usage.get("output_tokens", self.output_tokens)
+            self.cache_read_tokens = usage.get("cache_read_input_tokens")
+            self.cache_write_tokens = usage.get("cache_creation_input_tokens")
+        elif event == "message_delta":
+            usage = data.get("usage") or {}
+            self.output_tokens = usage.get("output_tokens", self.output_tokens)
+        elif event == "content_block_delta":
+            delta = data.get("delta") or {}
+            if delta.get("type") == "text_delta":
+                self.content += delta.get("text", "")
@@ -0,0 +1,164 @@
+"""
+上游目标的运行时遥测。
+按 (提供商实例, 模型) 记录首个响应 (非流式为完整响应，流式为首个数据块) 的延迟、
+上游故障率以及当前并发请求数，用于对冲延迟、按延迟/负载路由等调度决策。
+所有操作都在事件循环内同步完成，无需加锁；内存占用有上限。
+"""
+
+import random
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+# 每个目标保留的最近延迟样本数
+SAMPLE_SIZE = 128
+# 计算分位数所需的最少样本数
+MIN_SAMPLES = 10
+# 最多跟踪的目标数量
+MAX_TARGETS = 1024
+# 基于遥测数据的路由策略
+TELEMETRY_STRATEGIES = ("least-latency", "least-inflight")
+# 延迟 EWMA 的平滑系数: 数值越大，越偏重最近的请求
+EWMA_ALPHA = 0.2
+# 故障率为 1 时在路由排序中附加的延迟惩罚 (秒)
+FAILURE_PENALTY = 10.0
+
+
+class TargetStats:
+    """
+    单个目标的延迟统计。
+    """
+
+    __slots__ = ("samples", "ewma", "error_rate", "inflight")
+
+    def __init__(self):
+        self.samples: Deque[float] = deque(maxlen=SAMPLE_SIZE)
+        self.ewma: Optional[float] = None  # 首响应延迟 (EWMA, 秒)
+        self.error_rate = 0.0  # 上游故障率 (EWMA)
+        self.inflight = 0  # 当前并发请求数
+
+    def observe(self, latency: float):
+        self.samples.append(latency)
+        self.ewma = (
+            latency
+            if self.ewma is None
+            else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma
+        )
+        self.error_rate *= 1 - EWMA_ALPHA
+
+    def observe_failure(self):
+        self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        最近样本的分位数。样本不足时返回 None。
+        """
+        if len(self.samples) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Telemetry:
+    """
+    遥测存储。超过容量时淘汰最久未更新且没有进行中请求的目标。
+    """
+
+    def __init__(self, max_targets: int = MAX_TARGETS):
+        self.max_targets = max_targets
+        self._targets: "OrderedDict[str, TargetStats]" = OrderedDict()
+
+    @staticmethod
+    def _key(instance_name: str, model: str) -> str:
+        return f"{instance_name}/{model}"
+
+    def _get(self, instance_name: str, model: str) -> TargetStats:
+        key = self._key(instance_name, model)
+        stats = self._targets.get(key)
+        if stats is None:
+            stats = self._targets[key] = TargetStats()
+            if len(self._targets) > self.max_targets:
+                for old_key, old in self._targets.items():
+                    if old.inflight == 0 and old_key != key:
+                        del self._targets[old_key]
+                        break
+        else:
+            self._targets.move_to_end(key)
+        return stats
+
+    def observe(self, instance_name: str, model: str, latency: float):
+        """
+        记录一次成功调用的首个响应延迟 (秒)。
+        """
+        self._get(instance_name, model).observe(latency)
+
+    def observe_failure(self, instance_name: str, model: str):
+        """
+        记录一次上游故障 (服务端错误、限流、超时或连接失败)。
+        """
+        self._get(instance_name, model).observe_failure()
+
+    def begin(self, instance_name: str, model: str):
+        """
+        上游请求开始，并发数加一。
+        """
+        self._get(instance_name, model).inflight += 1
+
+    def end(self, instance_name: str, model: str):
+        """
+        上游请求结束 (无论成功、失败或取消)，并发数减一。
+        """
+        stats = self._targets.get(self._key(instance_name, model))
+        if stats is not None and stats.inflight > 0:
+            stats.inflight -= 1
+
+    def score(self, instance_name: str, model: str, strategy: str) -> Tuple:
+        """
+        目标在指定路由策略下的排序键，数值越小越优先。
+        - least-latency: 按有效延迟 (延迟 EWMA 加上按故障率计算的惩罚)。
+        - least-inflight: 按当前并发数，其次按有效延迟。
+        尚无延迟样本的目标以已观测目标的平均延迟作为先验 (新目标通过随机探索获得样本)。
+        并列时随机排序，避免总是选中同一个目标。
+        """
+        stats = self._targets.get(self._key(instance_name, model))
+        ewma = stats.ewma if stats is not None else None
+        if ewma is None:
+            ewma = self._prior()
+        error_rate = stats.error_rate if stats is not None else 0.0
+        latency = ewma + error_rate * FAILURE_PENALTY
+        inflight = stats.inflight if stats is not None else 0
+        if strategy == "least-inflight":
+            return (inflight, latency, random.random())
+        return (latency, random.random())
+
+    def _prior(self) -> float:
+        """
+        已观测目标的平均延迟 EWMA (尚无任何观测时为 0)。
+        """
+        observed = [s.ewma for s in self._targets.values() if s.ewma is not None]
+        return sum(observed) / len(observed) if observed else 0.0
+
+    def quantile(self, instance_name: str, model: str, q: float) -> Optional[float]:
+        stats = self._targets.get(self._key(instance_name, model))
+        return stats.quantile(q) if stats is not None else None
+
+    def reset(self):
+        self._targets.clear()
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for key, stats in self._targets.items():
+            p50 = stats.quantile(0.5)
+            p95 = stats.quantile(0.95)
+            result[key] = {
+                "samples": len(stats.samples),
+                "inflight": stats.inflight,
+                "ewma": round(stats.ewma, 4) if stats.ewma is not None else None,
+                "error_rate": round(stats.error_rate, 4),
+                "p50": round(p50, 4) if p50 is not None else None,
+                "p95": round(p95, 4) if p95 is not None else None,
+            }
+        return result
+
+
+# 全局遥测存储
+telemetry = Telemetry()
@@ -1,8 +1,35 @@
+import asyncio
+import json
+import re
+from datetime import date, timedelta
 import pytest
 from httpx import AsyncClient, ASGITransport
 from alia_proxy.main import app
-from alia_proxy.config import settings
-from tortoise import Tortoise
+from alia_proxy.config import (
+    settings,
+    LogWriterConfig,
+    DatabaseConfig,
+    CompressionConfig,
+)
+from alia_proxy.database import database
+from alia_proxy.routers.deps import get_proxy_service
+from alia_proxy.services.breaker import CircuitOpenError
+from alia_proxy.models import (
+    RequestLog,
+    RequestContent,
+    RequestAttempt,
+    MediaResource,
+    ContentBlob,
+    RollupMinute,
+    RollupDay,
+)
+from alia_proxy.services.logger import log_request, log_writer, AttemptRecord
+from alia_proxy.schema import upgrade_schema, ADDED_COLUMNS
+from alia_proxy.services.compression import content_migrator, decode_content
+from alia_proxy.services.blobs import blob_store
+from alia_proxy.services.rollups import backfill, delete_logs, MinutePruner
+from tortoise import Tortoise, timezone
+from tortoise.utils import get_schema_sql
 from unittest.mock import AsyncMock, patch
 
 
@@ -14,6 +41,7 @@ async def db():
     )
     await Tortoise.generate_schemas()
     yield
+    blob_store.clear()
     await Tortoise.close_connections()
 
 
@@ -49,6 +77,26 @@ async def test_chat_completions_no_model():
     assert "Missing 'model' field" in response.json()["error"]["message"]
 
 
+@pytest.mark.asyncio
+async def test_anthropic_messages_returns_rejection_status():
+    class RejectingProxy:
+        async def anthropic_chat(self, body):
+            raise CircuitOpenError("circuit open")
+
+    app.dependency_overrides[get_proxy_service] = lambda: RejectingProxy()
+    try:
+        async with AsyncClient(
+            transport=ASGITransport(app=app), base_url="http://test"
+        ) as ac:
+            response = await ac.post(
+                "/v1/messages", json={"model": "anthropic/claude", "messages": []}
+            )
+    finally:
+        app.dependency_overrides.pop(get_proxy_service, None)
+    # 熔断拒绝返回 503，客户端可以重试
+    assert response.status_code == 503
+
+
 @pytest.mark.asyncio
 async def test_chat_completions_invalid_format():
     async with AsyncClient(
@@ -94,3 +142,394 @@ async def test_list_models_with_mapping():
     finally:
         # Restore original mapping
         settings.mapping = original_mapping
+
+
+@pytest.fixture
+def writer_settings():
+    original = settings.log_writer
+
+    def configure(**kwargs):
+        settings.log_writer = LogWriterConfig(**kwargs)
+        log_writer.start()
+        return log_writer
+
+    yield configure
+    settings.log_writer = original
+
+
+@pytest.mark.asyncio
+async def test_log_writer_batches_inserts(writer_settings):
+    writer = writer_settings(batch_size=2, flush_interval=60)
+    await log_request("p", "chat", "m", prompt="a", media_path=["x.png", "y.png"])
+    await log_request("p", "chat", "m", prompt="b")
+    await log_request("p", "chat", "m", prompt="c", error="boom", status_code=500)
+    await writer.stop()
+
+    assert writer.running is False
+    logs = await RequestLog.all().order_by("id").prefetch_related("content", "media")
+    assert [log.content.prompt for log in logs] == ["a", "b", "c"]
+    assert sorted(m.file_path for m in logs[0].media) == ["x.png", "y.png"]
+    assert logs[2].content.error == "boom"
+    assert await MediaResource.all().count() == 2
+
+    # 写入任务未运行时直接写入
+    await log_request("p", "chat", "m", prompt="d")
+    assert await RequestContent.filter(prompt="d").count() == 1
+
+
+@pytest.mark.asyncio
+async def test_write_records_uses_database_ids():
+    # 其他写入者直接插入的日志不会与批量写入分配的 ID 冲突
+    await RequestLog.create(
+        id=100,
+        provider="p",
+        endpoint="chat",
+        model="m",
+        status_code=200,
+        date=date.today(),
+    )
+    await log_request("p", "chat", "m", prompt="a")
+    await log_request("p", "chat", "m", prompt="b")
+
+    logs = (
+        await RequestLog.filter(id__gt=100).order_by("id").prefetch_related("content")
+    )
+    assert [log.content.prompt for log in logs] == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_log_writer_drops_when_queue_full(writer_settings):
+    writer = writer_settings(queue_size=2, flush_interval=60, overflow="drop-new")
+    dropped = writer.dropped
+    for prompt in "abc":
+        await log_request("p", "chat", "m", prompt=prompt)
+    assert writer.dropped == dropped + 1
+    await writer.stop()
+    assert [c.prompt for c in await RequestContent.all().order_by("id")] == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_upgrade_schema_adds_missing_columns():
+    conn = Tortoise.get_connection("default")
+    # 模拟旧版本创建的数据库: 没有后续新增的列
+    added = [f'"{c.column}"' for c in ADDED_COLUMNS]
+    legacy = "\n".join(
+        line
+        for line in get_schema_sql(conn, safe=True).splitlines()
+        if not any(column in line for column in added)
+    )
+    # 去掉被删除的列留下的多余逗号
+    legacy = re.sub(r",(\s*\))", r"\1", legacy)
+    await conn.execute_script(
+        "DROP TABLE mediaresource; DROP TABLE requestcontent; "
+        "DROP TABLE requestattempt; DROP TABLE requestlog;"
+    )
+    await conn.execute_script(legacy)
+
+    await upgrade_schema()
+    await Tortoise.generate_schemas()
+    await upgrade_schema()  # 重复执行不会出错
+
+    await log_request("p", "chat", "m", prompt="a", ttft=0.25, is_streaming=True)
+    log = await RequestLog.get(model="m")
+    assert log.ttft == 0.25
+    assert log.attempt_count == 1
+
+
+@pytest.mark.asyncio
+async def test_analytics_stream_distributions():
+    await log_request(
+        "p", "chat", "m", completion_tokens=40, latency=2.5, ttft=0.5, is_streaming=True
+    )
+    await log_request("p", "chat", "m", latency=1.0)
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        response = await ac.get("/api/analytics")
+    data = response.json()
+
+    assert data["stream_stats"] == [
+        {
+            "provider": "p",
+            "model": "m",
+            "requests": 1,
+            "avg_ttft": 0.5,
+            "avg_tokens_per_second": 20.0,
+        }
+    ]
+    assert data["ttft_distribution"] == [
+        {"provider": "p", "model": "m", "bucket": "0.5-1s", "count": 1}
+    ]
+    assert data["throughput_distribution"] == [
+        {"provider": "p", "model": "m", "bucket": "10-30", "count": 1}
+    ]
+
+
+@pytest.mark.asyncio
+async def test_analytics_reads_rollups_backfilled_from_logs():
+    # 旧版本写入的日志: 汇总表为空，启动时从原始日志回填
+    for latency, status_code in [(0.2, 200), (1.5, 200), (3.0, 500)]:
+        await RequestLog.create(
+            provider="p",
+            endpoint="chat",
+            model="m",
+            total_tokens=10,
+            latency=latency,
+            status_code=status_code,
+            date=date.today(),
+        )
+    assert await backfill() == 3
+    assert await backfill() == 0  # 已回填时跳过
+    # 新日志由写入器增量累加
+    await log_request("q", "chat", "m", total_tokens=5, latency=0.7)
+    assert await RollupDay.all().count() == 3
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        analytics = (await ac.get("/api/analytics")).json()
+        assert analytics["summary"]["total_requests"] == 4
+        assert analytics["summary"]["success_rate"] == 75
+        assert analytics["summary"]["avg_latency"] == pytest.approx(1.35)
+        assert analytics["errors"] == {"500": 1}
+        assert analytics["latency_distribution"] == {
+            "0-0.5s": 1,
+            "0.5-1s": 1,
+            "1-2s": 1,
+            "2-5s": 1,
+            "5s+": 0,
+        }
+        assert analytics["overall_trends"] == [
+            {"date": timezone.now().date().isoformat(), "total": 4, "success": 3}
+        ]
+        assert sum(row["tpm"] for row in analytics["minute_usage"]) == 35
+        hours = analytics["hourly_trends"]
+        assert sum(row["count"] for row in hours) == 4
+        assert all(re.fullmatch(r"\d{2}", row["hour"]) for row in hours)
+
+        await ac.delete("/api/logs", params={"provider": "p"})
+        stats = (await ac.get("/api/stats")).json()
+    assert stats["total_requests"] == 1
+    assert stats["provider_counts"] == {"q": 1}
+    # 减为 0 的汇总行被删除
+    assert await RollupMinute.filter(provider="p").count() == 0
+
+
+@pytest.mark.asyncio
+async def test_minute_rollups_are_pruned_after_retention():
+    await log_request("p", "chat", "m", total_tokens=5)
+    await RollupMinute.all().update(bucket=timezone.now() - timedelta(days=100))
+    pruner = MinutePruner()
+    conn = Tortoise.get_connection("default")
+    assert await pruner.maybe_prune(conn) == 1
+    # 按小时与按天汇总的数据不受影响
+    assert await RollupMinute.all().count() == 0
+    assert await RollupDay.all().count() == 1
+
+
+@pytest.mark.asyncio
+async def test_request_with_fallback_is_logged_once():
+    attempts = [
+        AttemptRecord(1, "a", "m1", 503, 0.2, "Attempt 1/3 failed: overloaded"),
+        AttemptRecord(2, "b", "m2", 504, 1.0, "Attempt 2/3 failed: timeout"),
+        AttemptRecord(3, "c", "m3", 200, 0.5),
+    ]
+    await log_request(
+        "c", "chat", "m3", prompt="hi", response="ok", latency=1.8, attempts=attempts
+    )
+    # 只有一次调用的请求不写入调用记录
+    await log_request("a", "chat", "m1", prompt="hi", attempts=attempts[2:])
+
+    assert await RequestLog.all().count() == 2
+    assert await RequestContent.all().count() == 2
+    assert await RequestAttempt.all().count() == 3
+    log = await RequestLog.get(provider="c")
+    assert log.attempt_count == 3
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        detail = (await ac.get(f"/api/logs/{log.id}")).json()
+        analytics = (await ac.get("/api/analytics")).json()
+
+    assert [(a["provider"], a["status_code"]) for a in detail["attempts"]] == [
+        ("a", 503),
+        ("b", 504),
+        ("c", 200),
+    ]
+    assert detail["content"]["prompt"] == "hi"
+    assert analytics["summary"]["total_requests"] == 2
+    assert analytics["summary"]["total_attempts"] == 4
+    assert analytics["summary"]["retried_requests"] == 1
+    assert sorted(
+        (row["provider"], row["status_code"], row["count"])
+        for row in analytics["attempt_failures"]
+    ) == [("a", 503, 1), ("b", 504, 1)]
+
+
+def conversation(turns: int) -> str:
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"Question {i}: how do I sort?"})
+        messages.append({"role": "assistant", "content": f"Answer {i}: use sorted()."})
+    return json.dumps(messages, ensure_ascii=False)
+
+
+@pytest.mark.asyncio
+async def test_content_is_compressed_and_read_back():
+    prompt = conversation(20)
+    response = conversation(10)
+    await log_request("p", "chat", "m", prompt=prompt, response=response)
+
+    content = await RequestContent.get(log__model="m")
+    assert content.codec == "zlib-d1"
+    assert content.response is None
+    assert len(content.response_blob) < len(response) / 4
+    assert content.prompt is None and len(content.prompt_refs) == 41
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        detail = (await ac.get(f"/api/logs/{content.log_id}")).json()
+        export = (await ac.get("/api/export", params={"format": "jsonl"})).text
+    assert detail["content"]["prompt"] == prompt
+    assert detail["content"]["response"] == response
+    assert json.loads(export)["prompt"] == prompt
+
+
+@pytest.mark.asyncio
+async def test_prompt_messages_are_stored_once():
+    await log_request("p", "chat", "m", prompt=conversation(20))
+    # 降级重试记录相同的 prompt，下一轮对话只新增两条消息
+    await log_request("p", "chat", "m", prompt=conversation(20), status_code=500)
+    await log_request("p", "chat", "m", prompt=conversation(21))
+    assert await ContentBlob.all().count() == 43
+
+    async with AsyncClient(
+        transport=ASGITransport(app=app), base_url="http://test"
+    ) as ac:
+        export = (await ac.get("/api/export", params={"format": "jsonl"})).text
+        prompts = [json.loads(line)["prompt"] for line in export.splitlines()]
+        assert prompts == [conversation(20), conversation(20), conversation(21)]
+
+        await ac.delete("/api/logs")
+    assert await ContentBlob.all().count() == 0
+
+
+@pytest.mark.asyncio
+async def test_sweep_during_write_keeps_referenced_blobs():
+    await log_request("p", "chat", "m", prompt=conversation(20))
+    new_blobs = blob_store.new_blobs
+
+    async def sweep_after_check(*args):
+        blobs = await new_blobs(*args)
+        # 检查消息块之后、写入事务之前批量删除了引用这些块的日志
+        await delete_logs(RequestLog.all())
+        await blob_store.sweep()
+        return blobs
+
+    with patch.object(blob_store, "new_blobs", new=sweep_after_check):
+        await log_request("p", "chat", "m", prompt=conversation(21))
+
+    content = await RequestContent.get()
+    loaded = (await blob_store.load_contents([content]))[0]
+    assert loaded["prompt"] == conversation(21)
+
+
+@pytest.mark.asyncio
+async def test_content_migrator_compresses_legacy_rows():
+    prompt = conversation(20)
+    log = await RequestLog.create(
+        provider="p", endpoint="chat", model="m", status_code=200, date="2024-01-01"
+    )
+    legacy = await RequestContent.create(log=log, prompt=prompt, response="ok")
+    assert legacy.codec is None
+
+    assert await content_migrator.migrate_batch(10) is True
+    migrated = await RequestContent.get(id=legacy.id)
+    assert migrated.codec == "zlib-d1" and migrated.prompt is None
+    assert decode_content(migrated) == {
+        "prompt": prompt,
+        "response": "ok",
+        "error": None,
+    }
+
+
+@pytest.mark.asyncio
+async def test_content_migrator_retries_failed_batches():
+    original = settings.compression
+    settings.compression = CompressionConfig(
+        migrate=True, migrate_interval=0.001, migrate_retries=3
+    )
+    results = [RuntimeError("database is locked"), False, True]
+    migrate = AsyncMock(side_effect=results)
+    try:
+        with patch.object(content_migrator, "migrate_batch", new=migrate):
+            content_migrator.start()
+            await asyncio.wait_for(content_migrator._task, 1)
+    finally:
+        settings.compression = original
+    # 失败的批次在退避后重试，直到迁移完成
+    assert migrate.await_count == len(results)
+
+
+@pytest.mark.asyncio
+async def test_sqlite_profile_moves_content_to_separate_file(tmp_path):
+    await Tortoise.close_connections()
+    original = settings.database
+    db_url = f"sqlite://{tmp_path}/alia.db"
+    content_path = str(tmp_path / "content" / "alia-content.db")
+    try:
+        # 旧版本: 内容与日志存储在同一个数据库文件中
+        settings.database = DatabaseConfig(read_pool_size=0)
+        await database.init(db_url)
+        await log_request("p", "chat", "m", prompt=conversation(4), response="ok")
+        await database.close()
+
+        settings.database = DatabaseConfig(
+            sqlite_profile=True, read_pool_size=2, content_path=content_path
+        )
+        await database.init(db_url)
+        writer = Tortoise.get_connection("default")
+        # 内容数据库附加到写连接与只读连接上
+        for conn in (writer, database.reader()):
+            _, rows = await conn.execute_query("PRAGMA database_list")
+            assert {row["name"]: row["file"] for row in rows}["content"] == (
+                content_path
+            )
+        _, rows = await writer.execute_query("PRAGMA journal_mode")
+        assert rows[0][0] == "wal"
+        _, rows = await writer.execute_query("PRAGMA synchronous")
+        assert rows[0][0] == 1
+        _, rows = await writer.execute_query(
+            "SELECT name FROM content.sqlite_master WHERE type = 'table'"
+        )
+        assert {"requestcontent", "contentblob"} <= {row[0] for row in rows}
+        _, rows = await writer.execute_query(
+            "SELECT name FROM main.sqlite_master WHERE name = 'requestcontent'"
+        )
+        assert not rows
+
+        reader = database.reader()
+        assert reader is not writer
+        _, rows = await reader.execute_query("PRAGMA query_only")
+        assert rows[0][0] == 1
+
+        await log_request("p", "chat", "m", prompt=conversation(5), response="ok")
+        async with AsyncClient(
+            transport=ASGITransport(app=app), base_url="http://test"
+        ) as ac:
+            logs = (await ac.get("/api/logs")).json()
+            assert len(logs) == 2
+            for log in logs:
+                detail = (await ac.get(f"/api/logs/{log['id']}")).json()
+                assert detail["content"]["response"] == "ok"
+            # 单条删除直接删除对应的内容 (内容数据库中没有级联删除)
+            await ac.delete(f"/api/logs/{logs[0]['id']}")
+            assert await RequestContent.all().count() == 1
+            await ac.delete("/api/logs")
+        assert await RequestContent.all().count() == 0
+        assert await ContentBlob.all().count() == 0
+    finally:
+        settings.database = original
+        await database.close()
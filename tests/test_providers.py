@@ -0,0 +1,229 @@
+import json
+import httpx
+import pytest
+from alia_proxy.config import settings, ProviderConfig, MappingConfig
+from alia_proxy.providers.anthropic import AnthropicProvider
+from alia_proxy.providers.base import ChatRequest
+from alia_proxy.providers.factory import ProviderFactory
+from alia_proxy.providers.keypool import KeyPool
+from alia_proxy.services.telemetry import telemetry, Telemetry
+
+
+@pytest.fixture
+def provider_settings():
+    original_providers = settings.providers
+    settings.providers = {
+        "pool-test": ProviderConfig(
+            type="openai", api_key="sk-test", max_connections=7
+        ),
+    }
+    ProviderFactory.clear_cache()
+    yield
+    settings.providers = original_providers
+    ProviderFactory.clear_cache()
+
+
+@pytest.mark.asyncio
+async def test_provider_reuses_pooled_client(provider_settings):
+    provider = ProviderFactory.get_provider("pool-test")
+    client = provider.client
+    assert provider.client is client
+    assert ProviderFactory.get_provider("pool-test").client is client
+
+    await ProviderFactory.close_all()
+    assert client.is_closed
+
+
+@pytest.mark.asyncio
+async def test_clear_cache_retires_clients(provider_settings):
+    provider = ProviderFactory.get_provider("pool-test")
+    client = provider.client
+
+    ProviderFactory.clear_cache()
+    assert ProviderFactory.get_provider("pool-test") is not provider
+    # 旧实例在宽限期内保持可用
+    assert not client.is_closed
+
+    await ProviderFactory.close_all()
+    assert client.is_closed
+
+
+def test_key_pool_round_robins_without_observations():
+    pool = KeyPool(["sk-a", "sk-b", "sk-c"])
+    assert [pool.acquire() for _ in range(6)] == ["sk-a", "sk-b", "sk-c"] * 2
+
+
+def test_key_pool_skips_keys_in_cooldown():
+    pool = KeyPool(["sk-a", "sk-b"])
+    pool.report("sk-a", 429, retry_after="120")
+    assert {pool.acquire() for _ in range(4)} == {"sk-b"}
+
+    pool.report("sk-b", 401)
+    # 全部处于冷却期时，返回最早恢复的 Key
+    assert pool.acquire() == "sk-a"
+
+    pool.reset()
+    assert {pool.acquire() for _ in range(4)} == {"sk-a", "sk-b"}
+
+
+def test_key_pool_prefers_fast_healthy_keys():
+    pool = KeyPool(["sk-fast", "sk-slow"])
+    for _ in range(5):
+        pool.report("sk-fast", 200, latency=0.1)
+        pool.report("sk-slow", 200, latency=1.0)
+    picks = [pool.acquire() for _ in range(110)]
+    assert picks.count("sk-fast") == 100
+
+
+@pytest.mark.asyncio
+async def test_provider_reports_key_outcomes(provider_settings):
+    settings.providers["pool-test"].api_key = ["sk-limited", "sk-healthy"]
+    ProviderFactory.clear_cache()
+    provider = ProviderFactory.get_provider("pool-test")
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.headers["Authorization"] == "Bearer sk-limited":
+            return httpx.Response(429, headers={"retry-after": "60"})
+        return httpx.Response(200, json={"data": []})
+
+    provider._client = provider._create_client()
+    provider._client._transport = httpx.MockTransport(handler)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        await provider.list_models()
+    for _ in range(3):
+        assert await provider.list_models() == []
+
+    stats = {s["index"]: s for s in provider.key_pool.snapshot()}
+    assert stats[0]["last_status"] == 429
+    assert stats[0]["cooldown_remaining"] > 0
+    assert stats[1]["successes"] == 3
+    await ProviderFactory.close_all()
+
+
+@pytest.fixture
+def routing_mapping():
+    original_mapping = settings.mapping
+    telemetry.reset()
+
+    def configure(**config):
+        settings.mapping = {
+            "pool": MappingConfig(targets=["fast/m", "slow/m"], **config)
+        }
+
+    yield configure
+    settings.mapping = original_mapping
+    telemetry.reset()
+
+
+def test_least_latency_prefers_fast_target(routing_mapping, monkeypatch):
+    routing_mapping(strategy="least-latency")
+    monkeypatch.setattr("alia_proxy.providers.factory.EXPLORATION_RATE", 0.0)
+    telemetry.observe("fast", "m", 0.1)
+    telemetry.observe("slow", "m", 2.0)
+
+    for _ in range(5):
+        assert ProviderFactory.resolve_model("pool")[0] == "fast"
+
+
+def test_least_latency_penalizes_failures_and_unobserved(routing_mapping, monkeypatch):
+    routing_mapping(strategy="least-latency")
+    monkeypatch.setattr("alia_proxy.providers.factory.EXPLORATION_RATE", 0.0)
+    # 尚无样本的目标以平均延迟为先验，不会总是被选中
+    telemetry.observe("slow", "m", 2.0)
+    telemetry.observe("other", "m", 0.2)
+    assert ProviderFactory.resolve_model("pool")[0] == "fast"
+    telemetry.observe("fast", "m", 0.5)
+    assert ProviderFactory.resolve_model("pool")[0] == "fast"
+    # 持续失败的目标 (从未记录延迟) 不再被选中
+    for _ in range(5):
+        telemetry.observe_failure("fast", "m")
+    assert ProviderFactory.resolve_model("pool")[0] == "slow"
+
+
+def test_telemetry_eviction_keeps_new_target():
+    store = Telemetry(max_targets=2)
+    store.begin("a", "m")
+    store.begin("b", "m")
+    store.observe("c", "m", 0.1)
+    assert store.snapshot()["c/m"]["samples"] == 1
+
+
+def test_least_inflight_prefers_idle_target(routing_mapping, monkeypatch):
+    routing_mapping(strategy="least-inflight")
+    monkeypatch.setattr("alia_proxy.providers.factory.EXPLORATION_RATE", 0.0)
+    telemetry.begin("fast", "m")
+    telemetry.begin("fast", "m")
+    telemetry.begin("slow", "m")
+    assert ProviderFactory.resolve_model("pool")[0] == "slow"
+
+    telemetry.end("fast", "m")
+    telemetry.end("fast", "m")
+    assert ProviderFactory.resolve_model("pool")[0] == "fast"
+
+
+def test_weighted_strategy_requires_matching_weights(routing_mapping):
+    with pytest.raises(ValueError):
+        MappingConfig(targets=["a/m", "b/m"], strategy="weighted", weights=[1.0])
+
+    routing_mapping(strategy="weighted", weights=[1.0, 0.0])
+    for _ in range(5):
+        assert ProviderFactory.resolve_model("pool")[0] == "fast"
+
+
+@pytest.mark.asyncio
+async def test_anthropic_prompt_cache_breakpoints():
+    payloads = []
+
+    def handler(request):
+        payloads.append(json.loads(request.content))
+        return httpx.Response(
+            200,
+            json={
+                "id": "msg_1",
+                "model": "claude-test",
+                "content": [{"type": "text", "text": "ok"}],
+                "stop_reason": "end_turn",
+                "usage": {
+                    "input_tokens": 10,
+                    "output_tokens": 5,
+                    "cache_creation_input_tokens": 0,
+                    "cache_read_input_tokens": 2000,
+                },
+            },
+        )
+
+    provider = AnthropicProvider(
+        ProviderConfig(type="anthropic", api_key="sk-test", prompt_cache=True)
+    )
+    provider._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    system = {"role": "system", "content": "rules " * 2000}
+    turns = [
+        [{"role": "user", "content": "hi"}],
+        [{"role": "user", "content": "other"}],
+        [
+            {"role": "user", "content": "other"},
+            {"role": "assistant", "content": "ok"},
+            {"role": "user", "content": "more"},
+        ],
+    ]
+    for messages in turns:
+        response = await provider.chat(
+            ChatRequest(model="claude-test", messages=[system, *messages])
+        )
+
+    # 首次出现的前缀不插入断点
+    assert isinstance(payloads[0]["system"], str)
+    # 系统提示再次出现后成为稳定前缀
+    assert payloads[1]["system"][-1]["cache_control"] == {"type": "ephemeral"}
+    # 对话延续: 在读取的前缀与最后一条消息处设置断点
+    messages = payloads[2]["messages"]
+    assert messages[0]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert isinstance(messages[1]["content"], str)
+    assert messages[2]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+
+    assert response.usage.prompt_tokens == 2010
+    assert response.usage.cache_read_tokens == 2000
+    assert response.usage.cache_write_tokens == 0
+    # 缓存 Token 数只用于日志，不出现在返回给客户端的响应中
+    assert "cache_read_tokens" not in response.model_dump(exclude_none=True)["usage"]
@@ -0,0 +1,959 @@
+import json
+import asyncio
+import httpx
+import pytest
+from unittest.mock import AsyncMock, patch
+from alia_proxy.config import (
+    settings,
+    ProviderConfig,
+    CircuitBreakerConfig,
+    MappingConfig,
+    LimiterConfig,
+    CacheConfig,
+    EmbeddingsCacheConfig,
+    EmbeddingsBatchConfig,
+    SemanticCacheConfig,
+)
+from alia_proxy.providers.base import (
+    ChatRequest,
+    RawChatResponse,
+    EmbeddingsRequest,
+    Usage,
+)
+from alia_proxy.providers.openai import OpenAIProvider
+from alia_proxy.providers.anthropic import AnthropicProvider
+from alia_proxy.providers.factory import ProviderFactory
+from alia_proxy.routers.deps import watch_disconnect
+from alia_proxy.services.proxy import ProxyService, get_status_code
+from alia_proxy.services.sse import AnthropicStreamTap, ChunkTimer, OpenAIStreamTap
+from alia_proxy.services.cache import response_cache, embedding_cache
+from alia_proxy.services.breaker import circuit_breakers, CircuitOpenError
+from alia_proxy.services.limiter import ConcurrencyLimiter, LimiterRejectedError
+from alia_proxy.services.batcher import split_tokens
+from alia_proxy.services.semantic import semantic_cache
+
+
+def make_provider(handler, **config) -> OpenAIProvider:
+    provider = OpenAIProvider(
+        ProviderConfig(type="openai", api_key="sk-test", **config)
+    )
+    provider._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return provider
+
+
+def sse_body(*chunks) -> bytes:
+    frames = [f"data: {json.dumps(c)}\n\n" for c in chunks]
+    frames.append("data: [DONE]\n\n")
+    return "".join(frames).encode()
+
+
+STREAM_CHUNKS = [
+    {"id": "chatcmpl-1", "choices": [{"index": 0, "delta": {"content": "Hel"}}]},
+    {"id": "chatcmpl-1", "choices": [{"index": 0, "delta": {"content": "lo"}}]},
+    {
+        "id": "chatcmpl-1",
+        "choices": [],
+        "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5},
+    },
+]
+
+
+async def collect(gen) -> bytes:
+    out = b""
+    async for chunk in gen:
+        out += chunk if isinstance(chunk, bytes) else chunk.encode()
+    return out
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_passthrough_relays_raw_bytes():
+    body = sse_body(*STREAM_CHUNKS)
+    provider = make_provider(lambda request: httpx.Response(200, content=body))
+    proxy = ProxyService(provider, "gpt-test", "test")
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        output = await collect(proxy.chat_stream(request))
+
+    assert output == body
+    kwargs = log.call_args.kwargs
+    assert kwargs["response"] == "Hello"
+    assert kwargs["total_tokens"] == 5
+    assert kwargs["request_id"] == "chatcmpl-1"
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_without_passthrough_reencodes():
+    body = sse_body(*STREAM_CHUNKS)
+    provider = make_provider(
+        lambda request: httpx.Response(200, content=body), passthrough=False
+    )
+    proxy = ProxyService(provider, "gpt-test", "test")
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        output = await collect(proxy.chat_stream(request))
+
+    assert output.endswith(b"data: [DONE]\n\n")
+    assert log.call_args.kwargs["response"] == "Hello"
+    assert log.call_args.kwargs["prompt_tokens"] == 3
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_client_disconnect_logs_partial_content():
+    upstream_closed = asyncio.Event()
+
+    class HangingStream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield sse_body(STREAM_CHUNKS[0])[: -len("data: [DONE]\n\n")]
+            await asyncio.Event().wait()
+
+        async def aclose(self):
+            upstream_closed.set()
+
+    provider = make_provider(
+        lambda request: httpx.Response(200, stream=HangingStream())
+    )
+    proxy = ProxyService(provider, "gpt-test", "test")
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        stream = proxy.chat_stream(request)
+        await anext(stream)
+        await stream.aclose()
+
+    assert upstream_closed.is_set()
+    kwargs = log.call_args.kwargs
+    assert kwargs["status_code"] == 499
+    assert kwargs["response"] == "Hel"
+    assert kwargs["completion_tokens"] == 1
+    assert kwargs["metadata"]["cancelled"] is True
+    assert kwargs["metadata"]["estimated_tokens"] is True
+    assert kwargs["metadata"]["stream"]["chunks"] == 1
+    assert kwargs["ttft"] is not None
+
+
+@pytest.mark.asyncio
+async def test_watch_disconnect_cancels_waiting_upstream(monkeypatch):
+    monkeypatch.setattr(settings, "disconnect_poll_interval", 0.01)
+    upstream_closed = asyncio.Event()
+
+    class HangingStream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield sse_body(STREAM_CHUNKS[0])[: -len("data: [DONE]\n\n")]
+            await asyncio.Event().wait()
+
+        async def aclose(self):
+            upstream_closed.set()
+
+    class ClientRequest:
+        disconnected = False
+
+        async def is_disconnected(self):
+            return self.disconnected
+
+    provider = make_provider(
+        lambda request: httpx.Response(200, stream=HangingStream())
+    )
+    proxy = ProxyService(provider, "gpt-test", "test")
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+    client = ClientRequest()
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        stream = watch_disconnect(client, proxy.chat_stream(request))
+        await anext(stream)
+        # 上游没有新的数据块，断开只能由检测任务发现
+        client.disconnected = True
+        with pytest.raises(StopAsyncIteration):
+            await asyncio.wait_for(anext(stream), 1)
+
+    assert upstream_closed.is_set()
+    assert log.call_args.kwargs["status_code"] == 499
+
+
+@pytest.mark.asyncio
+async def test_watch_disconnect_propagates_consumer_cancellation():
+    upstream_closed = asyncio.Event()
+
+    class HangingStream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield sse_body(STREAM_CHUNKS[0])[: -len("data: [DONE]\n\n")]
+            await asyncio.Event().wait()
+
+        async def aclose(self):
+            upstream_closed.set()
+
+    class ClientRequest:
+        async def is_disconnected(self):
+            return False
+
+    provider = make_provider(
+        lambda request: httpx.Response(200, stream=HangingStream())
+    )
+    proxy = ProxyService(provider, "gpt-test", "test")
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+    received = asyncio.Event()
+
+    async def consume():
+        async for _ in watch_disconnect(ClientRequest(), proxy.chat_stream(request)):
+            received.set()
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        consumer = asyncio.create_task(consume())
+        await received.wait()
+        # 转发任务在等待上游时被外部取消 (如服务关闭)
+        consumer.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await consumer
+
+    assert upstream_closed.is_set()
+    assert log.call_args.kwargs["status_code"] == 499
+
+
+@pytest.mark.asyncio
+async def test_anthropic_tap_relays_frames_and_extracts_usage():
+    frames = [
+        b'event: message_start\ndata: {"type":"message_start","message":{"id":"msg_1","usage":{"input_tokens":11,"output_tokens":1}}}\n\n',
+        b'event: content_block_delta\ndata: {"type":"content_block_delta","index":0,"delta":{"type":"text_delta","text":"Hi"}}\n\n',
+        b'event: content_block_delta\ndata: {"type":"content_block_delta","index":1,"delta":{"type":"input_json_delta","partial_json":"{\\"a\\""}}\n\n',
+        # 缺少 event 行时通过 type 字段嗅探
+        b'data: {"type":"content_block_delta","index":0,"delta":{"type":"text_delta","text":" there"}}\n\n',
+        b'event: message_delta\ndata: {"type":"message_delta","delta":{"stop_reason":"end_turn"},"usage":{"output_tokens":7}}\n\n',
+    ]
+
+    async def upstream():
+        for frame in frames:
+            # 模拟网络分片: 帧边界与数据块边界不一致
+            yield frame[:10]
+            yield frame[10:]
+
+    tap = AnthropicStreamTap()
+    relayed = b"".join([chunk async for chunk in tap.relay(upstream())])
+    tap.finish()
+
+    assert relayed == b"".join(frames)
+    assert tap.request_id == "msg_1"
+    assert tap.content == "Hi there"
+    assert tap.input_tokens == 11
+    assert tap.output_tokens == 7
+    # 按 SSE 事件计数，而不是按网络读取的分片
+    assert tap.timer.chunks == len(frames)
+
+
+@pytest.mark.asyncio
+async def test_openai_tap_detects_done_without_space():
+    async def upstream():
+        yield b'data:{"id":"c1","choices":[]}\n\n'
+        yield b"data:[DONE]\n\n"
+
+    tap = OpenAIStreamTap()
+    [chunk async for chunk in tap.relay(upstream())]
+    # 上游省略冒号后的空格时不会再追加一个 [DONE]
+    assert tap.saw_done
+
+
+def test_chunk_timer_counts_events_across_reads():
+    timer = ChunkTimer()
+    # 事件边界跨越两次读取，以及一次读取包含多个事件
+    for data in [b"data: 1\n", b"\ndata: 2\n\ndata: 3\r\n\r\n", b"data: 4"]:
+        timer.feed(data)
+    assert timer.chunks == 3
+
+
+@pytest.mark.asyncio
+async def test_openai_tap_strips_cache_usage_from_frames():
+    async def chunks():
+        yield {
+            "id": "msg_1",
+            "choices": [{"index": 0, "delta": {"content": "Hi"}}],
+            "usage": Usage(
+                prompt_tokens=2010, cache_read_tokens=2000, cache_write_tokens=0
+            ).stream_dict(),
+        }
+
+    tap = OpenAIStreamTap()
+    frames = [frame async for frame in tap.encode(chunks())]
+
+    # 缓存 Token 数记录在旁路解析器上，不发送给客户端
+    assert tap.cache_read_tokens == 2000
+    assert tap.cache_write_tokens == 0
+    assert "cache_read_tokens" not in frames[0]
+    assert json.loads(frames[0][6:])["usage"]["prompt_tokens"] == 2010
+
+
+@pytest.mark.asyncio
+async def test_chat_passthrough_returns_upstream_bytes():
+    body = json.dumps(
+        {
+            "id": "chatcmpl-2",
+            "object": "chat.completion",
+            "created": 1,
+            "model": "gpt-test",
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": "Hi"}}
+            ],
+            "usage": {"prompt_tokens": 4, "completion_tokens": 1, "total_tokens": 5},
+            "system_fingerprint": "fp_upstream",
+        },
+        separators=(",", ":"),
+    ).encode()
+    provider = make_provider(lambda request: httpx.Response(200, content=body))
+    proxy = ProxyService(provider, "gpt-test", "test")
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}]
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        result = await proxy.chat(request)
+
+    assert isinstance(result, RawChatResponse)
+    assert result.body == body
+    kwargs = log.call_args.kwargs
+    assert kwargs["response"] == "Hi"
+    assert kwargs["total_tokens"] == 5
+    assert kwargs["request_id"] == "chatcmpl-2"
+
+
+@pytest.fixture
+def breakers():
+    circuit_breakers.reset()
+    original = settings.circuit_breaker
+    settings.circuit_breaker = CircuitBreakerConfig(
+        failure_threshold=2, recovery_timeout=60.0
+    )
+    yield circuit_breakers
+    settings.circuit_breaker = original
+    circuit_breakers.reset()
+
+
+def test_circuit_opens_after_consecutive_failures(breakers):
+    breakers.record_failure("up", "m", 503, transport_error=False)
+    assert breakers.allows("up", "m")
+    breakers.record_failure("up", "m", 503, transport_error=False)
+    assert not breakers.allows("up", "m")
+    # 5xx 只影响 (提供商, 模型) 级熔断器
+    assert breakers.allows("up", "other-model")
+
+    breakers.record_failure("down", "m", 502, transport_error=True)
+    breakers.record_failure("down", "m", 502, transport_error=True)
+    assert not breakers.allows("down", "other-model")
+
+
+def test_circuit_half_open_probe_closes_on_success(breakers):
+    breakers.record_failure("up", "m", 500, transport_error=False)
+    breakers.record_failure("up", "m", 500, transport_error=False)
+    settings.circuit_breaker.recovery_timeout = 0.0
+
+    assert breakers.allows("up", "m")
+    breakers.on_attempt("up", "m")
+    breakers.record_success("up", "m")
+    assert breakers.snapshot()["up/m"]["state"] == "closed"
+
+
+@pytest.mark.asyncio
+async def test_open_circuit_skips_upstream(breakers):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503)
+
+    provider = make_provider(handler)
+    proxy = ProxyService(provider, "gpt-test", "test")
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}]
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        for _ in range(2):
+            with pytest.raises(httpx.HTTPStatusError):
+                await proxy.chat(request)
+        assert log.call_args.kwargs["status_code"] == 503
+
+        with pytest.raises(CircuitOpenError):
+            await proxy.chat(request)
+        # 熔断拒绝的请求同样记录日志 (503)
+        assert log.call_count == 3
+        assert log.call_args.kwargs["status_code"] == 503
+        assert "circuit open" in log.call_args.kwargs["error"]
+    assert len(calls) == 2
+
+
+def test_get_status_code():
+    request = httpx.Request("GET", "http://upstream")
+    assert get_status_code(httpx.ConnectTimeout("t", request=request)) == 504
+    assert get_status_code(httpx.ConnectError("c", request=request)) == 502
+    assert get_status_code(CircuitOpenError("open")) == 503
+    assert get_status_code(ValueError("bad")) == 500
+
+
+def chat_body(content: str) -> bytes:
+    return json.dumps(
+        {
+            "id": f"chatcmpl-{content}",
+            "object": "chat.completion",
+            "created": 1,
+            "model": "gpt-test",
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": content}}
+            ],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }
+    ).encode()
+
+
+@pytest.fixture
+def backup_provider():
+    """
+    注册名为 backup 的降级提供商，供 fallbacks 解析使用。
+    """
+
+    def register(handler):
+        provider = make_provider(handler)
+        ProviderFactory._instances["backup"] = provider
+        return provider
+
+    yield register
+    ProviderFactory._instances.pop("backup", None)
+
+
+@pytest.mark.asyncio
+async def test_hedge_fires_backup_after_delay(backup_provider):
+    cancelled = asyncio.Event()
+
+    async def slow(request):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return httpx.Response(200, content=chat_body("slow"))
+
+    provider = make_provider(slow)
+    backup_provider(lambda request: httpx.Response(200, content=chat_body("fast")))
+    proxy = ProxyService(
+        provider,
+        "gpt-test",
+        "test",
+        fallbacks=["backup/gpt-test"],
+        mapping=MappingConfig(
+            targets=["test/gpt-test"], dispatch="hedge", hedge_delay=0.05
+        ),
+    )
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}]
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        result = await proxy.chat(request)
+
+    assert result.content == "fast"
+    assert cancelled.is_set()
+    # 一次逻辑请求只记录一条日志，落败的请求作为调用记录附带
+    log.assert_called_once()
+    kwargs = log.call_args.kwargs
+    assert kwargs["provider"] == "backup"
+    assert kwargs["status_code"] == 200
+    assert kwargs["metadata"] == {"dispatch": "hedge", "attempt": 2}
+    attempts = {a.provider: a for a in kwargs["attempts"]}
+    assert attempts["backup"].status_code == 200
+    assert attempts["test"].status_code == 499
+    assert attempts["test"].error == "Attempt 1/2 cancelled"
+
+
+@pytest.mark.asyncio
+async def test_race_stream_takes_first_chunk(backup_provider):
+    body = sse_body(*STREAM_CHUNKS)
+
+    async def slow(request):
+        await asyncio.sleep(5)
+        return httpx.Response(200, content=body)
+
+    provider = make_provider(slow)
+    backup_provider(lambda request: httpx.Response(200, content=body))
+    proxy = ProxyService(
+        provider,
+        "gpt-test",
+        "test",
+        fallbacks=["backup/gpt-test"],
+        mapping=MappingConfig(targets=["test/gpt-test"], dispatch="race"),
+    )
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        output = await asyncio.wait_for(collect(proxy.chat_stream(request)), 2)
+
+    assert output == body
+    log.assert_called_once()
+    assert log.call_args.kwargs["provider"] == "backup"
+    statuses = {a.provider: a.status_code for a in log.call_args.kwargs["attempts"]}
+    assert statuses == {"backup": 200, "test": 499}
+
+
+@pytest.mark.asyncio
+async def test_race_replaces_failed_candidate(backup_provider):
+    provider = make_provider(lambda request: httpx.Response(500))
+    backup_provider(lambda request: httpx.Response(200, content=chat_body("ok")))
+    proxy = ProxyService(
+        provider,
+        "gpt-test",
+        "test",
+        fallbacks=["backup/gpt-test"],
+        mapping=MappingConfig(targets=["test/gpt-test"], dispatch="race", race_count=1),
+    )
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}]
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()):
+        result = await proxy.chat(request)
+    assert result.content == "ok"
+
+
+class StalledStream(httpx.AsyncByteStream):
+    """
+    先输出给定的数据，然后不再产生任何数据块的上游响应体。
+    """
+
+    def __init__(self, data: bytes = b""):
+        self.data = data
+
+    async def __aiter__(self):
+        if self.data:
+            yield self.data
+        await asyncio.Event().wait()
+
+
+@pytest.mark.asyncio
+async def test_first_token_timeout_falls_back(backup_provider):
+    body = sse_body(*STREAM_CHUNKS)
+    provider = make_provider(
+        lambda request: httpx.Response(200, stream=StalledStream())
+    )
+    backup_provider(lambda request: httpx.Response(200, content=body))
+    proxy = ProxyService(
+        provider,
+        "gpt-test",
+        "test",
+        fallbacks=["backup/gpt-test"],
+        mapping=MappingConfig(targets=["test/gpt-test"], first_token_timeout=0.05),
+    )
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        output = await asyncio.wait_for(collect(proxy.chat_stream(request)), 2)
+
+    assert output == body
+    log.assert_called_once()
+    kwargs = log.call_args.kwargs
+    assert kwargs["status_code"] == 200
+    assert [(a.provider, a.status_code) for a in kwargs["attempts"]] == [
+        ("test", 504),
+        ("backup", 200),
+    ]
+    # 端到端的首个数据块延迟包含失败的首次调用
+    assert kwargs["ttft"] >= 0.05
+
+
+@pytest.mark.asyncio
+async def test_idle_timeout_aborts_stalled_stream():
+    first = sse_body(STREAM_CHUNKS[0])[: -len("data: [DONE]\n\n")]
+    provider = make_provider(
+        lambda request: httpx.Response(200, stream=StalledStream(first)),
+        idle_timeout=0.05,
+    )
+    proxy = ProxyService(provider, "gpt-test", "test")
+    request = ChatRequest(
+        model="gpt-test", messages=[{"role": "user", "content": "hi"}], stream=True
+    )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        with pytest.raises(httpx.TimeoutException):
+            await asyncio.wait_for(collect(proxy.chat_stream(request)), 2)
+
+    assert log.call_args.kwargs["status_code"] == 504
+
+
+def make_anthropic_provider(handler, **config) -> AnthropicProvider:
+    provider = AnthropicProvider(
+        ProviderConfig(type="anthropic", api_key="sk-test", **config)
+    )
+    provider._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return provider
+
+
+@pytest.mark.asyncio
+async def test_anthropic_stream_does_not_fall_back_after_first_chunk():
+    first = b'event: message_start\ndata: {"type":"message_start","message":{"id":"msg_1","usage":{"input_tokens":3,"output_tokens":1}}}\n\n'
+    backup_calls = []
+    provider = make_anthropic_provider(
+        lambda request: httpx.Response(200, stream=StalledStream(first)),
+        idle_timeout=0.05,
+    )
+    ProviderFactory._instances["backup"] = make_anthropic_provider(
+        lambda request: backup_calls.append(request) or httpx.Response(200)
+    )
+    proxy = ProxyService(
+        provider, "claude-test", "test", fallbacks=["backup/claude-test"]
+    )
+    body = {"model": "claude-test", "messages": [{"role": "user", "content": "hi"}]}
+
+    try:
+        with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+            output = []
+            with pytest.raises(httpx.TimeoutException):
+                async for chunk in proxy.anthropic_chat_stream(body, "[]", []):
+                    output.append(chunk)
+    finally:
+        ProviderFactory._instances.pop("backup", None)
+
+    # 已转发首个数据块后不再降级到下一个候选项
+    assert output == [first]
+    assert backup_calls == []
+    log.assert_called_once()
+    assert log.call_args.kwargs["status_code"] == 504
+    assert log.call_args.kwargs["request_id"] == "msg_1"
+
+
+@pytest.mark.asyncio
+async def test_anthropic_empty_stream_is_logged():
+    provider = make_anthropic_provider(lambda request: httpx.Response(200))
+    proxy = ProxyService(provider, "claude-test", "test")
+    body = {"model": "claude-test", "messages": [{"role": "user", "content": "hi"}]}
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        output = [chunk async for chunk in proxy.anthropic_chat_stream(body, "[]", [])]
+        await asyncio.sleep(0)
+
+    assert output == []
+    log.assert_called_once()
+    assert log.call_args.kwargs["status_code"] == 200
+
+
+@pytest.mark.asyncio
+async def test_limiter_queues_and_rejects_over_limit():
+    limiter = ConcurrencyLimiter(
+        "up", LimiterConfig(initial_limit=1, queue_size=1, queue_timeout=0.05), 1
+    )
+    acquired_at = await limiter.acquire()
+
+    waiter = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    assert limiter.queued == 1
+    # 队列已满
+    with pytest.raises(LimiterRejectedError):
+        await limiter.acquire()
+
+    limiter.release(acquired_at)
+    second = await waiter
+    assert limiter.inflight == 1
+
+    # 等待超时
+    with pytest.raises(LimiterRejectedError):
+        await limiter.acquire()
+    assert limiter.queued == 0
+    limiter.release(second)
+    assert limiter.snapshot()["rejected"] == 2
+
+
+@pytest.mark.asyncio
+async def test_limiter_adapts_limit():
+    limiter = ConcurrencyLimiter("up", LimiterConfig(initial_limit=4), 8)
+    slots = [await limiter.acquire() for _ in range(4)]
+
+    # 同一批请求的多个过载信号只收缩一次
+    limiter.release(slots[0], overloaded=True)
+    limiter.release(slots[1], overloaded=True)
+    assert limiter.limit == pytest.approx(2.8)
+
+    # 名额用满时成功的请求增加上限
+    limiter.release(slots[2])
+    assert limiter.limit > 2.8
+
+
+@pytest.mark.asyncio
+async def test_coalesce_identical_requests():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, content=chat_body("shared"))
+
+    provider = make_provider(handler)
+
+    def make_proxy():
+        return ProxyService(
+            provider,
+            "gpt-test",
+            "test",
+            mapping=MappingConfig(targets=["test/gpt-test"], coalesce=True),
+        )
+
+    def make_request():
+        return ChatRequest(
+            model="gpt-test", messages=[{"role": "user", "content": "hi"}]
+        )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        results = await asyncio.gather(
+            *[make_proxy().chat(make_request()) for _ in range(3)]
+        )
+
+    assert len(calls) == 1
+    assert [r.content for r in results] == ["shared"] * 3
+    metadata = [c.kwargs["metadata"] for c in log.call_args_list]
+    assert metadata.count(None) == 1
+    assert metadata.count({"coalesced": True}) == 2
+    tokens = sorted(c.kwargs["total_tokens"] for c in log.call_args_list)
+    assert tokens == [0, 0, 2]
+
+
+@pytest.fixture
+def cache_settings(tmp_path):
+    original = settings.cache
+    settings.cache = CacheConfig(enabled=True, disk=True, disk_dir=str(tmp_path))
+    response_cache.clear()
+    yield settings.cache
+    settings.cache = original
+    response_cache.clear()
+
+
+@pytest.mark.asyncio
+async def test_deterministic_chat_is_cached_and_replayed(cache_settings):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, content=chat_body("cached"))
+
+    provider = make_provider(handler)
+    proxy = ProxyService(provider, "gpt-test", "test")
+
+    def make_request(**kwargs):
+        return ChatRequest(
+            model="gpt-test",
+            messages=[{"role": "user", "content": "hi"}],
+            temperature=0,
+            **kwargs,
+        )
+
+    with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+        first = await proxy.chat(make_request())
+        second = await proxy.chat(make_request())
+        assert log.call_args.kwargs["metadata"] == {"cache": "hit"}
+
+        # 重启后 (内存层为空) 从磁盘层命中，并以 SSE 流回放
+        response_cache.clear()
+        output = await collect(proxy.chat_stream(make_request(stream=True)))
+
+        # 非确定性请求不使用缓存
+        await proxy.chat(
+            ChatRequest(model="gpt-test", messages=[{"role": "user", "content": "hi"}])
+        )
+
+    assert len(calls) == 2
+    assert second.body == first.body
+    tap = OpenAIStreamTap()
+    tap._chunks = [output]
+    tap.finish()
+    assert tap.content == "cached"
+    assert tap.total_tokens == 2
+    assert output.endswith(b"data: [DONE]\n\n")
+
+
+@pytest.mark.asyncio
+async def test_embeddings_cache_sends_only_misses():
+    vectors = {"a": [0.5, 1.0], "b": [0.25, -1.0], "c": [2.0, 0.0]}
+    sent = []
+
+    def handler(request):
+        inputs = json.loads(request.content)["input"]
+        sent.append(inputs)
+        return httpx.Response(
+            200,
+            json={
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": vectors[text]}
+                    for i, text in enumerate(inputs)
+                ],
+                "model": "emb-test",
+                "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+            },
+        )
+
+    original = settings.embeddings_cache
+    settings.embeddings_cache = EmbeddingsCacheConfig(enabled=True)
+    embedding_cache.clear()
+    provider = make_provider(handler)
+    proxy = ProxyService(provider, "emb-test", "test")
+    try:
+        with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+            first = await proxy.embeddings(
+                EmbeddingsRequest(model="emb-test", input=["a", "b", "a"])
+            )
+            second = await proxy.embeddings(
+                EmbeddingsRequest(model="emb-test", input=["b", "c"])
+            )
+    finally:
+        settings.embeddings_cache = original
+        embedding_cache.clear()
+
+    assert sent == [["a", "b"], ["c"]]
+    assert [d["embedding"] for d in first["data"]] == [
+        vectors["a"],
+        vectors["b"],
+        vectors["a"],
+    ]
+    assert [d["index"] for d in second["data"]] == [0, 1]
+    assert [d["embedding"] for d in second["data"]] == [vectors["b"], vectors["c"]]
+    assert log.call_args.kwargs["metadata"] == {
+        "embedding_cache": {"hits": 1, "misses": 1, "duplicates": 0}
+    }
+
+
+def test_split_tokens_sums_to_total():
+    assert split_tokens(10, [1, 1, 1]) == [4, 3, 3]
+    assert split_tokens(7, [0, 0]) == [4, 3]
+    assert sum(split_tokens(101, [3, 5, 11, 2])) == 101
+
+
+@pytest.mark.asyncio
+async def test_embeddings_micro_batching():
+    sent = []
+
+    def handler(request):
+        inputs = json.loads(request.content)["input"]
+        sent.append(inputs)
+        return httpx.Response(
+            200,
+            json={
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": [float(len(t))]}
+                    for i, t in reversed(list(enumerate(inputs)))
+                ],
+                "model": "emb-test",
+                "usage": {"prompt_tokens": 9, "total_tokens": 9},
+            },
+        )
+
+    original = settings.embeddings_batch
+    settings.embeddings_batch = EmbeddingsBatchConfig(enabled=True, max_delay=0.01)
+    provider = make_provider(handler)
+    proxy = ProxyService(provider, "emb-test", "test")
+    try:
+        with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+            results = await asyncio.gather(
+                proxy.embeddings(EmbeddingsRequest(model="emb-test", input="a")),
+                proxy.embeddings(EmbeddingsRequest(model="emb-test", input=["bb"])),
+                proxy.embeddings(
+                    EmbeddingsRequest(model="emb-test", input=["ccc", "dddd"])
+                ),
+            )
+    finally:
+        settings.embeddings_batch = original
+
+    assert sent == [["a", "bb", "ccc", "dddd"]]
+    assert [[d["embedding"] for d in r["data"]] for r in results] == [
+        [[1.0]],
+        [[2.0]],
+        [[3.0], [4.0]],
+    ]
+    assert [d["index"] for d in results[2]["data"]] == [0, 1]
+    # 按输入字符数 (1 : 2 : 7) 拆分 9 个 Token
+    assert [r["usage"]["prompt_tokens"] for r in results] == [1, 2, 6]
+    assert all(
+        call.kwargs["metadata"] == {"batch_size": 4} for call in log.call_args_list
+    )
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_returns_similar_response(tmp_path, backup_provider):
+    pytest.importorskip("numpy")
+    vectors = {"hello there": [1.0, 0.0], "hello there!": [0.99, 0.1], "bye": [0, 1]}
+    chat_calls = []
+
+    def embed(request):
+        text = json.loads(request.content)["input"][0]
+        return httpx.Response(
+            200,
+            json={
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": 0, "embedding": vectors[text]}
+                ],
+                "model": "emb-test",
+                "usage": {"prompt_tokens": 1, "total_tokens": 1},
+            },
+        )
+
+    def handler(request):
+        content = json.loads(request.content)["messages"][-1]["content"]
+        chat_calls.append(content)
+        return httpx.Response(200, content=chat_body(f"re: {content}"))
+
+    backup_provider(embed)
+    original = settings.semantic_cache
+    settings.semantic_cache = SemanticCacheConfig(
+        enabled=True,
+        embedding_model="backup/emb-test",
+        persist=True,
+        index_dir=str(tmp_path),
+    )
+    semantic_cache.clear()
+    mapping = MappingConfig(targets=["test/gpt-test"], semantic_threshold=0.95)
+    proxy = ProxyService(
+        make_provider(handler),
+        "gpt-test",
+        "test",
+        original_model="chat",
+        mapping=mapping,
+    )
+
+    def make_request(content, system="be brief"):
+        return ChatRequest(
+            model="chat",
+            messages=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": content},
+            ],
+        )
+
+    try:
+        with patch("alia_proxy.services.proxy.log_request", new=AsyncMock()) as log:
+            await proxy.chat(make_request("hello there"))
+            similar = await proxy.chat(make_request("hello there!"))
+            metadata = log.call_args.kwargs["metadata"]
+            await proxy.chat(make_request("bye"))
+            # 系统提示不同，不在同一命名空间
+            await proxy.chat(make_request("hello there", system="be verbose"))
+
+            # 重启后从内存映射文件恢复
+            await semantic_cache.save()
+            semantic_cache.clear()
+            restored = await proxy.chat(make_request("hello there!"))
+    finally:
+        settings.semantic_cache = original
+        semantic_cache.clear()
+
+    assert chat_calls == ["hello there", "bye", "hello there"]
+    assert similar.content == "re: hello there"
+    assert metadata["cache"] == "semantic"
+    assert metadata["similarity"] >= 0.95
+    assert restored.content == "re: hello there"